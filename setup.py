@@ -14,19 +14,23 @@ setup(
         'smoldyn_process.processes',
         'smoldyn_process.composites',
         'smoldyn_process.experiments',
+        'smoldyn_process.library',
     ],
     author='Eran Agmon, Steve Andrews, Ryan Spangler, Alex Patrie',
     author_email='eagmon@stanford.edu, steven.s.andrews@gmail.com, ryan.spangler@gmail.com, apatrie@uchc.edu',
     url='https://github.com/vivarium-collective/smoldyn-process',
     license='MIT',
     entry_points={
-        'console_scripts': []
+        'console_scripts': [
+            'smoldyn-process=smoldyn_process.cli:main',
+        ]
     },
     short_description='A Process-bigraph wrapper for Smoldyn',
     long_description=long_description,
     long_description_content_type='text/markdown',
     package_data={},
     include_package_data=True,
+    python_requires='>=3.11',
     install_requires=[
         'process-bigraph',
         'biosimulators-simularium',
@@ -0,0 +1,6 @@
+import process_bigraph
+from smoldyn_process.library.array_types import register_array_types
+
+
+# the `count_vector` and `molecule_table` types of the process ports, for every module of the package
+register_array_types(process_bigraph.types)
@@ -0,0 +1,267 @@
+"""
+Command line interface, installed as `smoldyn-process`.
+
+`smoldyn-process run` runs a batch of model files, each with optional `define` overrides and for each of
+a list of seeds, through `SmoldynProcess` in a bounded pool of worker processes, and writes every run
+into one `TrajectoryStore`:
+
+    smoldyn-process run 'smoldyn_process/models/model_files/*_model.txt' -D L_PARAM=3 --seeds 1 2 3 \\
+        --stop 10 --interval 0.5 --workers 4 --output results
+
+Each worker process runs a single job, so Smoldyn's native state never carries over between runs.
+Finished runs are recorded in the store's manifest as they complete, together with a fingerprint of the
+model text and every parameter of the run, so running the same command again after an interruption only
+runs what is missing, and a run whose model file, stop, interval or config has changed since is run again. With `--cache` (or `SMOLDYN_PROCESS_CACHE`),
+seeded runs are also looked up in, and added to, a `ResultCache` shared between batches.
+"""
+
+
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import *
+import numpy as np
+from smoldyn_process.library.cache import ResultCache, cache_key, default_cache_dir, is_seeded
+from smoldyn_process.library.model_file import read_model_text, resolve_model_text
+from smoldyn_process.library.store import TrajectoryStore, frames_to_columns
+from smoldyn_process.processes.smoldyn_server import make_job, run_job
+
+
+def expand_models(patterns: Sequence[str]) -> List[str]:
+    """Model file paths for a list of paths and glob patterns, in order and without duplicates."""
+    models: List[str] = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            raise FileNotFoundError(f'no model file matches {pattern}')
+        models.extend(match for match in matches if match not in models)
+    return models
+
+
+def run_id(model_filepath: str, defines: Dict[str, str], seed: Optional[int]) -> str:
+    """A readable id that is the same every time the same model, defines and seed are run."""
+    stem = os.path.splitext(os.path.basename(model_filepath))[0]
+    digest = hashlib.sha1(json.dumps([os.path.abspath(model_filepath), defines], sort_keys=True).encode()).hexdigest()
+    return f'{stem}-{digest[:8]}' + (f'-seed{seed}' if seed is not None else '')
+
+
+def job_fingerprint(
+        model_text: str,
+        defines: Dict[str, str],
+        seed: Optional[int],
+        stop: float,
+        interval: float,
+        config: Dict[str, Any]) -> str:
+    """A hash of everything a run depends on, which tells whether a run in the store is still current."""
+    return cache_key('job', model_text, defines, seed, stop, interval, config or {})
+
+
+def run_batch_job(job: Dict[str, Any], store_path: str, cache_dir: Optional[str] = None) -> Dict[str, Any]:
+    """Run one job in a worker process (or take it from the cache) and write it to the store. Returns its manifest
+        entry.
+    """
+    start = time.perf_counter()
+    try:
+        cache, key, cached = None, None, None
+        cache_dir = default_cache_dir(cache_dir)
+        model_text = resolve_model_text(None, job['defines'], job['seed'], text=job['model'])
+        if cache_dir and is_seeded(model_text):
+            cache = ResultCache(cache_dir)
+            key = cache_key('run', model_text, job['config'], job['stop'], job['interval'])
+            cached = cache.get(key)
+
+        if cached is not None:
+            columns, meta = cached
+        else:
+            frames = []
+            run_job(job, lambda header, arrays: frames.append({**header, **arrays}))
+            columns, meta = frames_to_columns(frames)
+            meta['intervals'] = len(frames)
+            if cache:
+                cache.put(key, columns, meta)
+        TrajectoryStore(store_path).write_run(job['job_id'], columns, {**meta, 'model': job['model_name']})
+    except Exception as error:
+        return {'status': 'error', 'error': f'{type(error).__name__}: {error}'}
+    return {
+        'status': 'done',
+        'frames': meta['intervals'],
+        'molecules': len(columns['coordinates']),
+        'cached': cached is not None,
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def run_batch(
+        models: Sequence[str],
+        stop: float,
+        interval: float,
+        output: str,
+        defines: Dict[str, str] = None,
+        seeds: Sequence[Optional[int]] = (None,),
+        workers: int = 1,
+        config: Dict[str, Any] = None,
+        cache_dir: Optional[str] = None,
+        log: Callable[[str], None] = print) -> Dict[str, Any]:
+    """Run every model for every seed into the store at `output`, skipping the runs it already holds with the
+        same model text and parameters.
+
+        Returns:
+            `Dict[str, Any]`: the number of runs `done`, `failed` and `skipped`, the wall-clock `seconds`, and the
+                throughput in `runs_per_second` and `simulated_per_second` (simulated time per wall-clock second).
+    """
+    store = TrajectoryStore(output)
+    store.clean()
+    completed = store.completed()
+    manifest = store.manifest()
+    defines = {name: str(value) for name, value in (defines or {}).items()}
+
+    jobs, changed = [], 0
+    for model_filepath in models:
+        model_text = read_model_text(model_filepath)
+        for seed in seeds:
+            job_id = run_id(model_filepath, defines, seed)
+            fingerprint = job_fingerprint(model_text, defines, seed, stop, interval, config)
+            if job_id in completed and manifest[job_id].get('fingerprint') == fingerprint:
+                continue
+            changed += job_id in completed
+            jobs.append((model_filepath, seed, job_id, fingerprint))
+    summary = {'done': 0, 'failed': 0, 'skipped': len(models) * len(seeds) - len(jobs)}
+    if summary['skipped']:
+        log(f'skipping {summary["skipped"]} runs already in {output}')
+    if changed:
+        log(f'running {changed} runs in {output} again, since their model or parameters changed')
+
+    start = time.perf_counter()
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, max_tasks_per_child=1) as pool:
+        running: Dict[Future, Tuple[str, str, Optional[int], str]] = {}
+        pending = iter(jobs)
+        while True:
+            # keep the pool busy without queueing every job (and its model text) at once
+            for model_filepath, seed, job_id, fingerprint in pending:
+                job = make_job(model_filepath, stop, interval, defines, seed, config, job_id)
+                running[pool.submit(run_batch_job, job, output, cache_dir)] = (job_id, model_filepath, seed, fingerprint)
+                if len(running) >= 2 * workers:
+                    break
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                job_id, model_filepath, seed, fingerprint = running.pop(future)
+                entry = future.result()
+                entry.update({
+                    'model': model_filepath,
+                    'defines': defines,
+                    'seed': seed,
+                    'stop': stop,
+                    'interval': interval,
+                    'config': config or {},
+                    'fingerprint': fingerprint,
+                })
+                store.record({job_id: entry})
+                if entry['status'] == 'done':
+                    summary['done'] += 1
+                    log(f'[{summary["done"] + summary["failed"]}/{len(jobs)}] {job_id}: {entry["frames"]} frames, '
+                        f'{entry["molecules"]} molecules in {entry["seconds"]:.2f}s'
+                        + (' (cached)' if entry['cached'] else ''))
+                else:
+                    summary['failed'] += 1
+                    log(f'[{summary["done"] + summary["failed"]}/{len(jobs)}] {job_id} failed: {entry["error"]}')
+
+    seconds = time.perf_counter() - start
+    summary.update({
+        'seconds': seconds,
+        'runs_per_second': summary['done'] / seconds if seconds else 0.0,
+        'simulated_per_second': summary['done'] * stop / seconds if seconds else 0.0,
+    })
+    log(f'{summary["done"]} runs done, {summary["failed"]} failed, {summary["skipped"]} skipped in {seconds:.2f}s '
+        f'({summary["runs_per_second"]:.2f} runs/s, {summary["simulated_per_second"]:.2f} simulated s/s)')
+    return summary
+
+
+def parse_define(definition: str) -> Tuple[str, str]:
+    name, separator, value = definition.partition('=')
+    if not separator:
+        raise argparse.ArgumentTypeError(f'expected NAME=VALUE, got {definition}')
+    return name, value
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog='smoldyn-process')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='run a batch of model files into a columnar store')
+    run.add_argument('models', nargs='+', help='model files or glob patterns')
+    run.add_argument('-D', '--define', action='append', type=parse_define, default=[], metavar='NAME=VALUE',
+                     help='override a define of every model')
+    run.add_argument('--seeds', nargs='+', type=int, default=[None], help="seeds to run each model with")
+    run.add_argument('--stop', type=float, required=True, help='simulated time of each run')
+    run.add_argument('--interval', type=float, required=True, help='simulated time between frames')
+    run.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='size of the process pool')
+    run.add_argument('--config', type=json.loads, default={}, help='extra SmoldynProcess config, as JSON')
+    run.add_argument('--output', required=True, help='directory of the store')
+    run.add_argument('--cache', help='directory of a result cache for seeded runs')
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        run_batch(
+            models=expand_models(args.models),
+            stop=args.stop,
+            interval=args.interval,
+            output=args.output,
+            defines=dict(args.define),
+            seeds=args.seeds,
+            workers=args.workers,
+            config=args.config,
+            cache_dir=args.cache)
+
+
+def test_run_batch(tmp_path):
+    output = str(tmp_path / 'store')
+    batch = {
+        'models': expand_models(['smoldyn_process/models/model_files/c*_model.txt']),
+        'stop': 0.04,
+        'interval': 0.02,
+        'output': output,
+        'seeds': [1, 2],
+        'workers': 2,
+        'cache_dir': str(tmp_path / 'cache'),
+    }
+    summary = run_batch(**batch)
+    assert (summary['done'], summary['failed'], summary['skipped']) == (2, 0, 0)
+
+    store = TrajectoryStore(output)
+    run_ids = sorted(store.completed())
+    run = store.load(run_ids[0])
+    assert run['frame_time'].tolist() == [0.02, 0.04]
+    assert run['counts'].shape[1] == len(run['count_columns']) == 2
+    assert len(run['coordinates']) == run['frame_offsets'][-1]
+
+    # an interrupted batch: only the run missing from the manifest is run again
+    manifest = store.manifest()
+    del manifest[run_ids[1]]
+    os.remove(store.manifest_path)
+    store.record(manifest)
+    summary = run_batch(**batch)
+    assert (summary['done'], summary['skipped']) == (1, 1)
+
+    # runs with another stop are not the same runs, and replace the stale ones
+    summary = run_batch(**{**batch, 'stop': 0.06})
+    assert (summary['done'], summary['skipped']) == (2, 0)
+    assert store.load(run_ids[0])['frame_time'].tolist() == [0.02, 0.04, 0.06]
+    assert run_batch(**{**batch, 'stop': 0.06})['skipped'] == 2
+
+    # another store is filled from the cache
+    run_batch(**{**batch, 'output': str(tmp_path / 'other')})
+    store = TrajectoryStore(str(tmp_path / 'other'))
+    assert all(entry['cached'] for entry in store.manifest().values())
+    assert np.array_equal(store.load(run_ids[0])['counts'], run['counts'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Benchmark the pipelined frames of `SharedSmoldynProcess`.
+
+Runs the minE model on one trajectory of frames and feeds every frame's molecules to an `MSDTracker` and a
+`ClusterAnalysis`, once with `SmoldynProcess.iter_frames`, which simulates, converts and analyzes each frame in
+turn, and once with `SharedSmoldynProcess.iter_frames`, whose worker simulates frame k+1 while this process
+receives and analyzes frame k. Starting the worker is not timed. The overlap needs a second core, so the number
+of usable cores is printed with the timings.
+
+Run with `python -m smoldyn_process.experiments.pipeline_benchmark`.
+"""
+
+
+import os
+import time
+from typing import *
+from smoldyn_process.processes.cluster_analysis import ClusterAnalysis
+from smoldyn_process.processes.msd_tracker import MSDTracker
+from smoldyn_process.processes.smoldyn_process import SmoldynProcess
+from smoldyn_process.processes.smoldyn_worker import SharedSmoldynProcess
+
+
+MIN_E_MODEL = 'smoldyn_process/models/model_files/minE_model.txt'
+
+
+def run_frames(process: SmoldynProcess, frames: int, every: float) -> float:
+    steps = [
+        MSDTracker({'max_lag': 10, 'frame_interval': every, 'model_filepath': MIN_E_MODEL}),
+        ClusterAnalysis({'cutoff': 0.05, 'model_filepath': MIN_E_MODEL}),
+    ]
+    start = time.perf_counter()
+    for frame in process.iter_frames(frames * every, every):
+        for step in steps:
+            step.update({'molecules': frame['molecules']})
+    return time.perf_counter() - start
+
+
+def run_benchmark(frames: int = 20, intervals: Sequence[float] = (0.01, 0.1)) -> Dict[float, Dict[str, float]]:
+    results: Dict[float, Dict[str, float]] = {}
+    for every in intervals:
+        serial = run_frames(SmoldynProcess({'model_filepath': MIN_E_MODEL}), frames, every)
+        process = SharedSmoldynProcess({'model_filepath': MIN_E_MODEL})
+        try:
+            pipelined = run_frames(process, frames, every)
+        finally:
+            process.close()
+        results[every] = {'serial': serial, 'pipelined': pipelined}
+    return results
+
+
+if __name__ == '__main__':
+    print(f'usable cores: {len(os.sched_getaffinity(0))}')
+    print(f'{"frame":>8}  {"serial":>9}  {"pipelined":>9}')
+    for every, timings in run_benchmark().items():
+        print(f'{every:>8}  {timings["serial"]:>8.2f}s  {timings["pipelined"]:>8.2f}s')
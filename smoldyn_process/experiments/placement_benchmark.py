@@ -0,0 +1,66 @@
+"""Benchmark compartment-constrained placement.
+
+Compares placing MinE in the `cell` compartment of the minE model with the vectorized sampler of
+`smoldyn_process.library.geometry` (sampling alone, and sampling plus injection into Smoldyn) against
+Smoldyn's native `addCompartmentMolecules`, called once per molecule and once for the whole batch.
+The Bar30 model is only sampled, since Smoldyn cannot load it without its `ellipse_12_12.txt` surface.
+
+Run with `python -m smoldyn_process.experiments.placement_benchmark`.
+"""
+
+
+import time
+from typing import *
+import numpy as np
+import smoldyn as sm
+from smoldyn._smoldyn import MolecState
+from smoldyn_process.library.geometry import get_region
+
+
+MIN_E_MODEL = 'smoldyn_process/models/model_files/minE_model.txt'
+BAR30_MODEL = 'smoldyn_process/models/model_files/Bar30-with-ellipse_model.txt'
+
+
+def timed(function: Callable[[], Any]) -> float:
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def inject(simulation: sm.Simulation, species_name: str, coordinates: np.ndarray) -> None:
+    for position in coordinates.tolist():
+        simulation.addSolutionMolecules(species_name, 1, position, position)
+
+
+def run_benchmark(counts: Sequence[int] = (1400, 20000)) -> Dict[str, Dict[int, float]]:
+    rng = np.random.default_rng(0)
+    capsule = get_region(MIN_E_MODEL, 'cell')
+    sphere = get_region(BAR30_MODEL, 'cell')
+    results: Dict[str, Dict[int, float]] = {}
+
+    for count in counts:
+        simulation = sm.Simulation.fromFile(MIN_E_MODEL)
+        simulation.runCommand('killmol all(all)')
+        results.setdefault('minE sample', {})[count] = timed(lambda: capsule.sample(count, rng))
+        results.setdefault('Bar30 sample', {})[count] = timed(lambda: sphere.sample(count, rng))
+        results.setdefault('minE sample + inject', {})[count] = timed(
+            lambda: inject(simulation, 'MinE', capsule.sample(count, rng)))
+        assert simulation.getMoleculeCount('MinE', MolecState.all) == count
+
+        simulation.runCommand('killmol all(all)')
+        results.setdefault('native per molecule', {})[count] = timed(
+            lambda: [simulation.addCompartmentMolecules('MinE', 1, 'cell') for _ in range(count)])
+
+        simulation.runCommand('killmol all(all)')
+        results.setdefault('native batch', {})[count] = timed(
+            lambda: simulation.addCompartmentMolecules('MinE', count, 'cell'))
+
+    return results
+
+
+if __name__ == '__main__':
+    benchmark = run_benchmark()
+    counts = list(next(iter(benchmark.values())))
+    print(f"{'method':<24}" + ''.join(f'{count:>12}' for count in counts))
+    for method, times in benchmark.items():
+        print(f'{method:<24}' + ''.join(f'{times[count] * 1e3:>10.2f}ms' for count in counts))
@@ -0,0 +1,98 @@
+"""NumPy-backed types for the ports of `SmoldynProcess`, registered with the process-bigraph type system.
+
+    count_vector    an int64 vector of species counts, in the fixed species order given once by the `_species`
+                    of its schema. Updates are deltas, which are added into the current vector in place.
+    molecule_table  a `MoleculeTable` of molecule columns. Updates replace the table, so applying one swaps a
+                    reference however many molecules it holds.
+
+Applying an update to these ports does not walk a tree with a key per species or per molecule. The types
+are registered on `process_bigraph.types` by `register_array_types`, which importing `smoldyn_process`
+calls.
+"""
+
+
+from typing import *
+import numpy as np
+import process_bigraph
+from smoldyn_process.library.molecules import MoleculeTable
+
+
+def accumulate_array(current, update, bindings=None, types=None):
+    """Add an array `update` into the `current` array, in place when the shape and dtype allow it."""
+    if update is None:
+        return current
+    if current is None:
+        return np.array(update)
+    update = np.asarray(update)
+    if isinstance(current, np.ndarray) and current.shape == update.shape and current.flags.writeable \
+            and np.can_cast(update.dtype, current.dtype, casting='same_kind'):
+        np.add(current, update, out=current)
+        return current
+    return current + update
+
+
+def serialize_count_vector(value, bindings=None, types=None):
+    return np.asarray(value).tolist()
+
+
+def deserialize_count_vector(serialized, bindings=None, types=None):
+    # always a new array, since updates are accumulated into it in place
+    return np.array(serialized, dtype=np.int64)
+
+
+def serialize_molecule_table(value, bindings=None, types=None):
+    return {key: column.tolist() for key, column in value.frame().items()}
+
+
+def deserialize_molecule_table(serialized, bindings=None, types=None):
+    if isinstance(serialized, MoleculeTable):
+        return serialized
+    return MoleculeTable.from_frame(serialized or {})
+
+
+ARRAY_TYPES = {
+    'count_vector': {
+        '_type': 'count_vector',
+        '_default': [],
+        '_apply': 'accumulate_array',
+        '_serialize': 'serialize_count_vector',
+        '_deserialize': 'deserialize_count_vector',
+        '_description': 'int64 vector of species counts, in the order of the `_species` of the schema'},
+
+    'molecule_table': {
+        '_type': 'molecule_table',
+        '_default': {},
+        '_apply': 'set',
+        '_serialize': 'serialize_molecule_table',
+        '_deserialize': 'deserialize_molecule_table',
+        '_description': 'the molecules of a snapshot as columns, replaced by each update'},
+}
+
+
+def register_array_types(types) -> None:
+    """Register the array types and their functions with a type system. Registering them again is a no-op."""
+    types.apply_registry.register('accumulate_array', accumulate_array)
+    types.serialize_registry.register('serialize_count_vector', serialize_count_vector)
+    types.deserialize_registry.register('deserialize_count_vector', deserialize_count_vector)
+    types.serialize_registry.register('serialize_molecule_table', serialize_molecule_table)
+    types.deserialize_registry.register('deserialize_molecule_table', deserialize_molecule_table)
+    for type_key, type_schema in ARRAY_TYPES.items():
+        types.type_registry.register(type_key, type_schema)
+
+
+def test_array_types():
+    types = process_bigraph.types
+    counts = types.default('count_vector')
+    assert counts.dtype == np.int64 and len(counts) == 0
+
+    schema = types.access({'counts': {'_type': 'count_vector', '_species': ['a', 'b']}, 'molecules': 'molecule_table'})
+    state = {'counts': np.array([10, 20], dtype=np.int64), 'molecules': types.default('molecule_table')}
+    counts = state['counts']
+    table = MoleculeTable.from_frame({'coordinates': [[0.0, 0.0, 0.0]], 'species_id': ['a'], 'state': [0]})
+    state = types.apply_update(schema, state, {'counts': np.array([1, -5]), 'molecules': table})
+    # the counts are accumulated in place and the table is swapped in
+    assert state['counts'] is counts and counts.tolist() == [11, 15]
+    assert state['molecules'] is table
+
+    serialized = types.serialize(schema, state)
+    assert serialized['counts'] == [11, 15] and serialized['molecules']['species_id'] == ['a']
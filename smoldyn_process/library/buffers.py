@@ -0,0 +1,36 @@
+"""Fixed-size buffers for the streaming analysis steps, which summarise a run update by update without
+keeping its whole history (see `processes/min_oscillation.py` and `processes/steady_state.py`).
+"""
+
+
+from typing import *
+import numpy as np
+
+
+class RingBuffer:
+    """Fixed-size buffer of the last `size` rows, returned oldest first."""
+
+    def __init__(self, size: int, row_shape: Tuple[int, ...] = ()):
+        self.data = np.zeros((size,) + tuple(row_shape))
+        self.size = size
+        self.count = 0
+
+    def append(self, row: Union[float, np.ndarray]) -> None:
+        self.data[self.count % self.size] = row
+        self.count += 1
+
+    def values(self) -> np.ndarray:
+        if self.count < self.size:
+            return self.data[:self.count].copy()
+        start = self.count % self.size
+        return np.concatenate([self.data[start:], self.data[:start]])
+
+
+def test_ring_buffer():
+    buffer = RingBuffer(3, (2,))
+    for value in range(2):
+        buffer.append([value, -value])
+    assert buffer.values().tolist() == [[0, 0], [1, -1]]
+    for value in range(2, 5):
+        buffer.append([value, -value])
+    assert buffer.values()[:, 0].tolist() == [2, 3, 4]
@@ -0,0 +1,142 @@
+"""A content-addressed disk cache for the results of deterministic Smoldyn runs.
+
+A Smoldyn run is reproducible when its model sets a `random_seed` (or is given a seed), so its results
+are fully determined by the resolved model text (see `model_file.resolve_model_text`), the remaining
+configuration and the intervals it is run for. `cache_key` hashes these, and `ResultCache` keeps one
+`.npz` file of arrays (plus a small JSON document) per key, evicting the least recently used files when
+the cache grows past its size limit. The size of the cache is tracked as entries are added, and the
+cache directory is only scanned when that estimate passes the limit.
+
+The cache is enabled for `SmoldynProcess` and the `smoldyn-process run` batch runner with their cache
+options, or everywhere with the `SMOLDYN_PROCESS_CACHE` environment variable set to a directory.
+Files that a model reads by path are not part of the key.
+"""
+
+
+import hashlib
+import json
+import os
+import uuid
+from typing import *
+import numpy as np
+
+
+CACHE_ENVIRONMENT_VARIABLE = 'SMOLDYN_PROCESS_CACHE'
+DEFAULT_MAX_BYTES = 2 ** 30
+
+
+def cache_key(*parts: Any) -> str:
+    """Hash JSON-serializable `parts` (arrays are hashed by their bytes) into a hex key."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(np.ascontiguousarray(part).tobytes())
+            digest.update(f'{part.dtype.str}{part.shape}'.encode())
+        else:
+            digest.update(json.dumps(part, sort_keys=True, default=str).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def is_seeded(model_text: str) -> bool:
+    """Whether resolved model text sets its random seed, which makes its runs reproducible."""
+    return any(line.split()[:1] == ['random_seed'] for line in model_text.splitlines())
+
+
+def default_cache_dir(cache_dir: Optional[str] = None) -> Optional[str]:
+    """`cache_dir`, or the directory named by the `SMOLDYN_PROCESS_CACHE` environment variable."""
+    return cache_dir or os.environ.get(CACHE_ENVIRONMENT_VARIABLE) or None
+
+
+class ResultCache:
+    """Arrays and a JSON document per key, in `.npz` files under `path`.
+
+        Args:
+            path:`str`: the cache directory.
+            max_bytes:`int`: size above which the least recently used entries are removed. Defaults to 1 GiB.
+    """
+
+    def __init__(self, path: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        # the size found by the last scan, plus the entries added since; other processes sharing the cache are only
+        # accounted for at the next scan
+        self.size: Optional[int] = None
+        os.makedirs(path, exist_ok=True)
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], f'{key}.npz')
+
+    def get(self, key: str) -> Optional[Tuple[Dict[str, np.ndarray], Dict[str, Any]]]:
+        """The arrays and document stored under `key`, or `None`."""
+        entry_path = self.entry_path(key)
+        try:
+            with np.load(entry_path, allow_pickle=False) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+            # the modification time orders the entries by last use
+            os.utime(entry_path)
+        except (OSError, ValueError):
+            return None
+        document = json.loads(str(arrays.pop('__document__')))
+        return arrays, document
+
+    def put(self, key: str, arrays: Dict[str, np.ndarray], document: Dict[str, Any] = None) -> None:
+        """Store `arrays` and a JSON `document` under `key`, then evict entries if the cache has grown past its size
+            limit.
+        """
+        entry_path = self.entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        replaced = os.path.getsize(entry_path) if os.path.exists(entry_path) else 0
+        partial_path = f'{entry_path}.{uuid.uuid4().hex[:8]}.partial'
+        with open(partial_path, 'wb') as file:
+            np.savez(file, __document__=np.array(json.dumps(document or {})), **arrays)
+        added = os.path.getsize(partial_path) - replaced
+        os.replace(partial_path, entry_path)
+        if self.size is not None:
+            self.size += added
+        if self.size is None or self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self) -> None:
+        """Scan the cache and remove the least recently used entries until it fits in `max_bytes`, down to 90% of
+            it so that the next entries do not need another scan straight away.
+        """
+        entries = []
+        for directory, _, names in os.walk(self.path):
+            for name in names:
+                if name.endswith('.npz'):
+                    status = os.stat(os.path.join(directory, name))
+                    entries.append((status.st_mtime, status.st_size, os.path.join(directory, name)))
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes if total <= self.max_bytes else int(0.9 * self.max_bytes)
+        for _, size, entry_path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.size = total
+
+
+def test_result_cache(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=20000)
+    arrays = {'counts': np.arange(1000, dtype=np.int64)}
+    keys = [cache_key('model', {'seed': seed}, 1.0) for seed in range(3)]
+    assert len(set(keys)) == 3 and keys[0] == cache_key('model', {'seed': 0}, 1.0)
+
+    cache.put(keys[0], arrays, {'seed': 0})
+    cache.put(keys[1], arrays, {'seed': 1})
+    os.utime(cache.entry_path(keys[0]), (0, 0))
+    os.utime(cache.entry_path(keys[1]), (1, 1))
+    assert cache.get(keys[0])[1] == {'seed': 0}
+
+    # the cache is scanned once, and then its size is added up as entries are put
+    assert cache.size == sum(os.path.getsize(cache.entry_path(key)) for key in keys[:2])
+
+    # each entry is about 8 kB, so the third evicts the least recently used one
+    cache.put(keys[2], arrays)
+    assert cache.get(keys[1]) is None and cache.size == sum(os.path.getsize(cache.entry_path(key)) for key in keys[::2])
+    stored, document = cache.get(keys[2])
+    assert np.array_equal(stored['counts'], arrays['counts']) and document == {}
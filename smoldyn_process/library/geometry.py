@@ -0,0 +1,244 @@
+"""Compartment geometry for placing molecules without Smoldyn.
+
+The curved panels of a model's surfaces (`sphere`, `cylinder` and `hemi`) are read once with
+`smoldyn_process.library.model_file` and turned into vectorized point-in-volume tests. A `Region` is
+either the inside of one surface or a compartment, and `Region.sample` draws uniform positions inside
+it in batches by rejection from its bounding box, e.g. inside the capsule of
+`../models/model_files/minE_model.txt` or the `cell` sphere of the Bar30 model.
+"""
+
+
+from typing import *
+import numpy as np
+from smoldyn_process.library.model_file import get_boundaries, get_compartments, get_surfaces
+
+
+# Smoldyn's abbreviations for panel shapes, which also prefix the default panel names (`sph0`, `cyl0`, ...)
+PANEL_SHAPES = {'rect': 'rect', 'tri': 'tri', 'sphere': 'sph', 'cylinder': 'cyl', 'hemi': 'hemi', 'disk': 'disk'}
+
+
+def _is_number(token: str) -> bool:
+    try:
+        float(token)
+        return True
+    except ValueError:
+        return False
+
+
+class SurfaceVolume:
+    """The volume enclosed by the curved panels of a surface: the union of the balls of its `sphere` panels, the
+        solid cylinders of its `cylinder` panels and the half balls of its `hemi` panels.
+
+        Flat panels (`rect`, `tri`, `disk`) enclose no volume and are ignored.
+
+        Attributes:
+            panel_shapes:`List[str]`: Smoldyn shape abbreviation of each curved panel, in the order spheres, hemispheres,
+                cylinders.
+            panel_names:`List[str]`: name of each curved panel, in the same order.
+            low:`np.ndarray`: lower corner of the bounding box, `None` if the surface encloses no volume.
+            high:`np.ndarray`: upper corner of the bounding box, `None` if the surface encloses no volume.
+    """
+
+    def __init__(self, panels: List[List[str]], dim: int = 3):
+        self.dim = dim
+        self.spheres: List[Tuple[np.ndarray, float]] = []
+        self.cylinders: List[Tuple[np.ndarray, np.ndarray, float]] = []
+        self.hemis: List[Tuple[np.ndarray, float, np.ndarray]] = []
+        names = {'sphere': [], 'hemi': [], 'cylinder': []}
+        lows, highs = [], []
+
+        shape_counts: Dict[str, int] = {}
+        for panel in panels:
+            shape, values = panel[0], panel[1:]
+            # unnamed panels are numbered within their shape
+            index = shape_counts.get(shape, 0)
+            shape_counts[shape] = index + 1
+            if shape in names:
+                name = values[-1] if not _is_number(values[-1]) else f'{PANEL_SHAPES[shape]}{index}'
+                names[shape].append(name)
+
+            if shape == 'sphere':
+                center = np.array(values[:dim], dtype=float)
+                radius = abs(float(values[dim]))
+                self.spheres.append((center, radius))
+                lows.append(center - radius)
+                highs.append(center + radius)
+            elif shape == 'hemi':
+                center = np.array(values[:dim], dtype=float)
+                radius = abs(float(values[dim]))
+                # the vector points from the center towards the open side of the hemisphere
+                axis = np.array(values[dim + 1:2 * dim + 1], dtype=float)
+                self.hemis.append((center, radius, axis / np.linalg.norm(axis)))
+                lows.append(center - radius)
+                highs.append(center + radius)
+            elif shape == 'cylinder':
+                start = np.array(values[:dim], dtype=float)
+                end = np.array(values[dim:2 * dim], dtype=float)
+                radius = abs(float(values[2 * dim]))
+                self.cylinders.append((start, end, radius))
+                lows.append(np.minimum(start, end) - radius)
+                highs.append(np.maximum(start, end) + radius)
+
+        self.panel_shapes = [PANEL_SHAPES[shape] for shape in names for _ in names[shape]]
+        self.panel_names = names['sphere'] + names['hemi'] + names['cylinder']
+        self.low = np.min(lows, axis=0) if lows else None
+        self.high = np.max(highs, axis=0) if highs else None
+
+    def contains(self, points: np.ndarray) -> np.ndarray:
+        """Return a boolean mask of the `points` (shape `(n, dim)`) that lie inside the volume."""
+        inside = np.zeros(len(points), dtype=bool)
+        for center, radius in self.spheres:
+            delta = points - center
+            inside |= np.einsum('ij,ij->i', delta, delta) <= radius * radius
+        for center, radius, axis in self.hemis:
+            delta = points - center
+            inside |= (np.einsum('ij,ij->i', delta, delta) <= radius * radius) & (delta @ axis <= 0)
+        for start, end, radius in self.cylinders:
+            length = np.linalg.norm(end - start)
+            direction = (end - start) / length
+            delta = points - start
+            along = delta @ direction
+            radial = delta - along[:, None] * direction
+            inside |= (along >= 0) & (along <= length) & (np.einsum('ij,ij->i', radial, radial) <= radius * radius)
+        return inside
+
+    def panel_distances(self, points: np.ndarray) -> np.ndarray:
+        """Distance from each of the `points` to each curved panel, shape `(n, n_panels)`."""
+        distances = []
+        for center, radius in self.spheres:
+            distances.append(np.abs(np.linalg.norm(points - center, axis=1) - radius))
+        for center, radius, axis in self.hemis:
+            delta = points - center
+            along = delta @ axis
+            shell = np.abs(np.linalg.norm(delta, axis=1) - radius)
+            # on the open side the closest point is on the rim
+            rim = np.hypot(np.linalg.norm(delta - along[:, None] * axis, axis=1) - radius, along)
+            distances.append(np.where(along <= 0, shell, rim))
+        for start, end, radius in self.cylinders:
+            length = np.linalg.norm(end - start)
+            direction = (end - start) / length
+            delta = points - start
+            along = delta @ direction
+            radial = np.linalg.norm(delta - along[:, None] * direction, axis=1) - radius
+            overshoot = np.maximum(np.maximum(-along, along - length), 0.0)
+            distances.append(np.hypot(radial, overshoot))
+        return np.column_stack(distances) if distances else np.empty((len(points), 0))
+
+
+class Region:
+    """A part of the simulation volume bounded by surfaces, with vectorized membership tests and sampling.
+
+        Like a Smoldyn compartment, a point belongs to the region if, for some interior-defining point, it is on the
+        same side (inside or outside) of every bounding surface as that point.
+
+        Args:
+            volumes:`List[SurfaceVolume]`: the bounding surfaces.
+            interior:`np.ndarray`: boolean array of shape `(n_points, n_volumes)`, whether each interior-defining
+                point is inside each volume.
+            low:`Sequence[float]`: lower corner of the simulation volume.
+            high:`Sequence[float]`: upper corner of the simulation volume.
+    """
+
+    def __init__(
+            self,
+            volumes: List[SurfaceVolume],
+            interior: np.ndarray,
+            low: Sequence[float],
+            high: Sequence[float]):
+        self.volumes = volumes
+        self.interior = np.asarray(interior, dtype=bool).reshape(-1, len(volumes))
+        self.system_low = np.asarray(low, dtype=float)
+        self.system_high = np.asarray(high, dtype=float)
+
+        # sample from the union over interior points of the boxes of the volumes that contain them
+        lows, highs = [], []
+        for pattern in self.interior:
+            point_low, point_high = self.system_low.copy(), self.system_high.copy()
+            for volume, enclosed in zip(volumes, pattern):
+                if enclosed and volume.low is not None:
+                    point_low = np.maximum(point_low, volume.low)
+                    point_high = np.minimum(point_high, volume.high)
+            lows.append(point_low)
+            highs.append(point_high)
+        self.low = np.min(lows, axis=0) if lows else self.system_low
+        self.high = np.max(highs, axis=0) if highs else self.system_high
+        self.acceptance = 0.5
+
+    def contains(self, points: np.ndarray) -> np.ndarray:
+        """Return a boolean mask of the `points` (shape `(n, dim)`) that lie inside the region."""
+        points = np.asarray(points, dtype=float)
+        enclosed = np.column_stack([volume.contains(points) for volume in self.volumes]) if self.volumes \
+            else np.zeros((len(points), 0), dtype=bool)
+        inside = (enclosed[:, None, :] == self.interior[None]).all(axis=-1).any(axis=-1)
+        return inside & np.all((points >= self.system_low) & (points <= self.system_high), axis=1)
+
+    def sample(self, count: int, rng: Optional[np.random.Generator] = None) -> np.ndarray:
+        """Draw `count` uniformly distributed positions inside the region, shape `(count, dim)`.
+
+            Candidates are drawn in batches from the region's bounding box, sized from the acceptance rate of the
+            previous batch, so only a few batches are needed.
+        """
+        rng = rng or np.random.default_rng()
+        batches = []
+        remaining = count
+        while remaining > 0:
+            size = int(remaining / self.acceptance * 1.1) + 64
+            candidates = rng.uniform(self.low, self.high, size=(size, len(self.low)))
+            accepted = candidates[self.contains(candidates)]
+            self.acceptance = max(len(accepted) / size, self.acceptance / 10)
+            if len(accepted) == 0 and self.acceptance < 1e-6:
+                raise ValueError('cannot place molecules in a region with no volume.')
+            batches.append(accepted[:remaining])
+            remaining -= len(batches[-1])
+        return np.concatenate(batches) if batches else np.empty((0, len(self.low)))
+
+
+def get_region(model_fp: str, name: str, defines: Dict[str, Any] = None) -> Region:
+    """Build the `Region` of the compartment `name`, or of the inside of the surface `name`, of a model file."""
+    boundaries = get_boundaries(model_fp, defines)
+    dim = len(boundaries['low'])
+    surfaces = get_surfaces(model_fp, defines)
+    compartments = get_compartments(model_fp, defines)
+
+    if name in compartments:
+        compartment = compartments[name]
+        volumes = [SurfaceVolume(surfaces.get(surface, []), dim) for surface in compartment['surfaces']]
+        points = np.array(compartment['points'], dtype=float).reshape(-1, dim)
+        interior = np.column_stack([volume.contains(points) for volume in volumes]) if volumes \
+            else np.zeros((len(points), 0), dtype=bool)
+    elif name in surfaces:
+        volumes = [SurfaceVolume(surfaces[name], dim)]
+        interior = np.ones((1, 1), dtype=bool)
+    else:
+        raise ValueError(f'{name} is neither a compartment nor a surface of {model_fp}.')
+
+    return Region(volumes, interior, boundaries['low'], boundaries['high'])
+
+
+def test_capsule_region():
+    region = get_region('smoldyn_process/models/model_files/minE_model.txt', 'cell')
+    positions = region.sample(20000, np.random.default_rng(0))
+    assert positions.shape == (20000, 3)
+
+    # every position is inside the capsule of radius 0.5 whose axis runs from -1.5 to 1.5 along x
+    axial = np.clip(positions[:, 0], -1.5, 1.5)
+    radial = np.linalg.norm(positions - np.column_stack([axial, np.zeros((len(positions), 2))]), axis=1)
+    assert np.all(radial <= 0.5)
+
+    # uniform: the fraction in the cylinder matches its share of the capsule volume
+    cylinder, caps = np.pi * 0.25 * 3.0, 4.0 / 3.0 * np.pi * 0.125
+    assert abs(np.mean(np.abs(positions[:, 0]) <= 1.5) - cylinder / (cylinder + caps)) < 0.01
+
+    sphere = get_region('smoldyn_process/models/model_files/Bar30-with-ellipse_model.txt', 'cell')
+    assert np.all(np.linalg.norm(sphere.sample(1000), axis=1) <= 2.5)
+
+
+def test_panel_distances():
+    surfaces = get_surfaces('smoldyn_process/models/model_files/minE_model.txt')
+    membrane = SurfaceVolume(surfaces['membrane'])
+    assert membrane.panel_names == ['hemi0', 'hemi1', 'cyl0']
+    assert membrane.panel_shapes == ['hemi', 'hemi', 'cyl']
+
+    points = np.array([[0.0, 0.5, 0.0], [-2.0, 0.0, 0.0], [1.5 + 0.3, 0.0, 0.4]])
+    nearest = np.argmin(membrane.panel_distances(points), axis=1)
+    assert [membrane.panel_names[index] for index in nearest] == ['cyl0', 'hemi0', 'hemi1']
@@ -0,0 +1,315 @@
+"""Lightweight readers for Smoldyn model (configuration) files.
+
+These helpers read a model file as a list of tokenized statements with comments removed, `define`
+substitutions applied and `ifdefine`/`ifundefine` blocks resolved, which is enough to pull simple
+parameters (boundaries, binding radii, ...) out of a model without loading it into Smoldyn.
+"""
+
+
+import os
+import re
+from typing import *
+
+
+AXIS_NAMES = {'x': 0, 'y': 1, 'z': 2, '0': 0, '1': 1, '2': 2}
+
+
+def _strip_comments(text: str) -> str:
+    # block comments first, then line comments
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.DOTALL)
+    return '\n'.join(line.split('#', 1)[0] for line in text.splitlines())
+
+
+def _substitute(tokens: List[str], definitions: Dict[str, str]) -> List[str]:
+    # like Smoldyn, replace defined names anywhere in a token (e.g. `-L_PARAM`), longest names first
+    if not definitions:
+        return tokens
+    names = sorted(definitions, key=len, reverse=True)
+    pattern = re.compile('|'.join(re.escape(name) for name in names))
+    return ' '.join(pattern.sub(lambda match: definitions[match.group(0)], token) for token in tokens).split()
+
+
+def read_model_text(model_fp: str) -> str:
+    """Read the text of the Smoldyn model file at `model_fp`, with the files it includes written in (see
+        `include_files`), so that the text can be run from any directory.
+    """
+    with open(model_fp, 'r') as file:
+        return include_files(file.read(), os.path.dirname(model_fp))
+
+
+def include_files(text: str, directory: str) -> str:
+    """Replace the `read_file` statements of model `text` with the statements of the files they read, which are
+        found relative to `directory` as Smoldyn finds them relative to the model file. An included file is read up
+        to its `end_file` statement. Text without `read_file` statements is returned as is; files that do not
+        exist are left for Smoldyn to report.
+    """
+    stripped = _strip_comments(text)
+    if not any(line.split()[:1] == ['read_file'] for line in stripped.splitlines()):
+        return text
+
+    lines = []
+    for line in stripped.splitlines():
+        tokens = line.split()
+        path = os.path.join(directory, tokens[1]) if tokens[:1] == ['read_file'] and len(tokens) > 1 else None
+        if path is None or not os.path.isfile(path):
+            lines.append(line)
+            continue
+        with open(path, 'r') as file:
+            included = include_files(file.read(), directory)
+        for included_line in _strip_comments(included).splitlines():
+            if included_line.split()[:1] == ['end_file']:
+                break
+            lines.append(included_line)
+    return '\n'.join(lines) + '\n'
+
+
+def read_model_statements(model_fp: str, defines: Dict[str, Any] = None) -> List[List[str]]:
+    """Read the Smoldyn model file at `model_fp` as a list of tokenized statements (see `parse_model_statements`)."""
+    return parse_model_statements(read_model_text(model_fp), defines)
+
+
+def parse_model_statements(text: str, defines: Dict[str, Any] = None) -> List[List[str]]:
+    """Parse the text of a Smoldyn model file as a list of tokenized statements.
+
+        Comments are stripped, `define` values are substituted into the statements that follow them and
+        `ifdefine`/`ifundefine`/`else`/`endif` blocks are resolved. The `define` statements themselves are kept
+        (with their own values resolved) so that callers can still read them.
+
+        Args:
+            text:`str`: the model text.
+            defines:`Dict[str, Any]`: optional define overrides. These take precedence over the values
+                given in the file, as they do for `smoldyn -define`.
+
+        Returns:
+            `List[List[str]]`: one list of string tokens per statement, in file order.
+    """
+    text = _strip_comments(text)
+
+    overrides = {name: str(value) for name, value in (defines or {}).items()}
+    definitions: Dict[str, str] = dict(overrides)
+    statements: List[List[str]] = []
+
+    # each entry records whether the enclosing conditional block is active
+    active_blocks: List[bool] = []
+    for line in text.splitlines():
+        tokens = line.split()
+        if not tokens:
+            continue
+
+        keyword = tokens[0]
+        if keyword in ('ifdefine', 'ifundefine'):
+            is_defined = len(tokens) > 1 and tokens[1] in definitions
+            active_blocks.append(is_defined if keyword == 'ifdefine' else not is_defined)
+            continue
+        elif keyword == 'else' and active_blocks:
+            active_blocks[-1] = not active_blocks[-1]
+            continue
+        elif keyword == 'endif' and active_blocks:
+            active_blocks.pop()
+            continue
+        elif not all(active_blocks):
+            continue
+
+        if keyword == 'define' and len(tokens) >= 2:
+            name = tokens[1]
+            value = ' '.join(_substitute(tokens[2:], definitions))
+            if name not in overrides:
+                definitions[name] = value
+            statements.append(['define', name] + definitions[name].split())
+            continue
+        elif keyword == 'undefine' and len(tokens) >= 2:
+            definitions.pop(tokens[1], None)
+            continue
+
+        statements.append(_substitute(tokens, definitions))
+
+    return statements
+
+
+def resolve_model_text(
+        model_fp: Optional[str],
+        defines: Dict[str, Any] = None,
+        seed: Optional[int] = None,
+        text: Optional[str] = None) -> str:
+    """Write the statements of a model file back out as model text, with `defines` applied and, if given, `seed`
+        replacing the model's `random_seed`. Smoldyn reads the result like the original file with `-define` options.
+        The model is read from `model_fp`, with the files it includes written in, or given as `text`.
+    """
+    if text is None:
+        statements = read_model_statements(model_fp, defines)
+    else:
+        statements = parse_model_statements(text, defines)
+    if seed is not None:
+        statements = [['random_seed', str(seed)]] + [
+            statement for statement in statements if statement[0] != 'random_seed']
+    return '\n'.join(' '.join(statement) for statement in statements) + '\n'
+
+
+def query_statements(statements: List[List[str]], keyword: str) -> List[List[str]]:
+    """Return every statement in `statements` whose first token is `keyword`."""
+    return [statement for statement in statements if statement[0] == keyword]
+
+
+def get_boundaries(model_fp: str, defines: Dict[str, Any] = None) -> Dict[str, Any]:
+    """Read the system boundaries declared with `boundaries`, `low` and `high` in a model file.
+
+        Returns:
+            `Dict[str, Any]`: `{'low': [...], 'high': [...], 'periodic': [...]}`, one entry per dimension.
+    """
+    statements = read_model_statements(model_fp, defines)
+    dim = 3
+    for statement in query_statements(statements, 'dim'):
+        dim = int(statement[1])
+
+    low = [0.0] * dim
+    high = [0.0] * dim
+    periodic = [False] * dim
+    for statement in query_statements(statements, 'boundaries'):
+        axis = AXIS_NAMES[statement[1]]
+        low[axis] = float(statement[2])
+        high[axis] = float(statement[3])
+        periodic[axis] = len(statement) > 4 and statement[4] == 'p'
+
+    for key, bounds in (('low', low), ('high', high)):
+        for statement in query_statements(statements, key):
+            values = [float(value) for value in statement[1:dim + 1]]
+            bounds[:len(values)] = values
+            if len(statement) > dim + 1:
+                periodic = [boundary_type == 'p' for boundary_type in statement[dim + 1:]]
+
+    return {'low': low, 'high': high, 'periodic': periodic}
+
+
+def get_species(model_fp: str, defines: Dict[str, Any] = None) -> List[str]:
+    """Return the species names of the model file in Smoldyn's index order, starting with the `empty` species at
+        index 0, as they appear in the species column of `listmols` output.
+    """
+    statements = read_model_statements(model_fp, defines)
+    return ['empty'] + [name for statement in query_statements(statements, 'species') for name in statement[1:]]
+
+
+def get_binding_radii(model_fp: str, defines: Dict[str, Any] = None) -> Dict[str, float]:
+    """Return a dict of reaction name to the `binding_radius` declared for it in the model file."""
+    statements = read_model_statements(model_fp, defines)
+    return {
+        statement[1]: float(statement[2])
+        for statement in query_statements(statements, 'binding_radius')
+    }
+
+
+def get_diffusion_coefficients(model_fp: str, defines: Dict[str, Any] = None) -> Dict[str, float]:
+    """Return the `difc` values declared in the model file.
+
+        Solution (and `all`) diffusion coefficients are keyed by species name, while coefficients declared for a
+        surface-bound state are keyed as `species(state)`, e.g. `{'MinD_ATP': 2.5, 'MinD_ATP(front)': 0.01}`.
+    """
+    statements = read_model_statements(model_fp, defines)
+    coefficients = {}
+    for statement in query_statements(statements, 'difc'):
+        species, _, state = statement[1].rstrip(')').partition('(')
+        key = species if state in ('', 'soln', 'solution', 'all') else f'{species}({state})'
+        coefficients[key] = float(statement[2])
+    return coefficients
+
+
+def get_surfaces(model_fp: str, defines: Dict[str, Any] = None) -> Dict[str, List[List[str]]]:
+    """Return the panels of each surface declared in the model file.
+
+        Panels are read from `panel` statements inside `start_surface` blocks and from one-line
+        `surface <name> panel ...` statements.
+
+        Returns:
+            `Dict[str, List[List[str]]]`: surface name to a list of `[shape, *parameters]` panel statements.
+    """
+    statements = read_model_statements(model_fp, defines)
+    surfaces: Dict[str, List[List[str]]] = {}
+    current = None
+    for statement in statements:
+        keyword = statement[0]
+        if keyword in ('start_surface', 'new_surface') and len(statement) > 1:
+            surfaces.setdefault(statement[1], [])
+            current = statement[1] if keyword == 'start_surface' else current
+        elif keyword == 'end_surface':
+            current = None
+        elif keyword == 'panel' and current is not None:
+            surfaces[current].append(statement[1:])
+        elif keyword == 'surface' and current is None and len(statement) > 3 and statement[2] == 'panel':
+            surfaces.setdefault(statement[1], []).append(statement[3:])
+    return surfaces
+
+
+def get_compartments(model_fp: str, defines: Dict[str, Any] = None) -> Dict[str, Dict[str, list]]:
+    """Return the bounding surfaces and interior-defining points of each compartment declared in the model file.
+
+        Returns:
+            `Dict[str, Dict[str, list]]`: `{compartment: {'surfaces': [name, ...], 'points': [[x, y, z], ...]}}`.
+    """
+    statements = read_model_statements(model_fp, defines)
+    compartments: Dict[str, Dict[str, list]] = {}
+    current = None
+    for statement in statements:
+        keyword = statement[0]
+        if keyword in ('start_compartment', 'new_compartment') and len(statement) > 1:
+            compartments.setdefault(statement[1], {'surfaces': [], 'points': []})
+            current = statement[1] if keyword == 'start_compartment' else current
+            continue
+        elif keyword == 'end_compartment':
+            current = None
+            continue
+        elif keyword == 'compartment' and current is None and len(statement) > 2:
+            name, statement = statement[1], statement[2:]
+        elif current is not None:
+            name = current
+        else:
+            continue
+
+        compartment = compartments.setdefault(name, {'surfaces': [], 'points': []})
+        if statement[0] == 'surface':
+            compartment['surfaces'].append(statement[1])
+        elif statement[0] == 'point':
+            compartment['points'].append([float(value) for value in statement[1:]])
+    return compartments
+
+
+def test_read_model_statements():
+    statements = read_model_statements('smoldyn_process/models/model_files/minE_model.txt')
+    definitions = {statement[1]: statement[2] for statement in query_statements(statements, 'define')}
+    assert definitions['L_PARAM'] == '2'
+
+    # KICK_START is not defined, so only the `all all` surface_mol statement survives
+    surface_mols = query_statements(statements, 'surface_mol')
+    assert surface_mols == [['surface_mol', '4000', 'MinD_ATP(front)', 'membrane', 'all', 'all']]
+
+    boundaries = get_boundaries('smoldyn_process/models/model_files/minE_model.txt', {'L_PARAM': 3})
+    assert boundaries['low'] == [-3.0, -0.5, -0.5]
+    assert boundaries['high'] == [3.0, 0.5, 0.5]
+
+    assert get_species('smoldyn_process/models/model_files/minE_model.txt') == \
+        ['empty', 'MinD_ATP', 'MinD_ADP', 'MinE', 'MinDMinE']
+
+    radii = get_binding_radii('smoldyn_process/models/model_files/crowding_model.txt')
+    assert radii == {'rxn1': 1.0, 'rxn2': 1.5, 'rxn2a': 1.5, 'rxn3': 2.0}
+
+    coefficients = get_diffusion_coefficients('smoldyn_process/models/model_files/minE_model.txt')
+    assert coefficients['MinD_ATP'] == 2.5
+    assert coefficients['MinD_ATP(front)'] == 0.01
+
+    surfaces = get_surfaces('smoldyn_process/models/model_files/minE_model.txt')
+    assert [panel[0] for panel in surfaces['membrane']] == ['cylinder', 'hemi', 'hemi']
+    compartments = get_compartments('smoldyn_process/models/model_files/minE_model.txt')
+    assert compartments == {'cell': {'surfaces': ['membrane'], 'points': [[0.0, 0.0, 0.0]]}}
+
+    text = resolve_model_text('smoldyn_process/models/model_files/minE_model.txt', {'L_PARAM': 3}, seed=7)
+    assert text.startswith('random_seed 7\n') and text.count('random_seed') == 1
+    assert 'boundaries 0 -3 3' in text
+
+
+def test_include_files(tmp_path):
+    (tmp_path / 'panels.txt').write_text('panel sphere 0 0 0 1 10 10 s1  # a sphere\nend_file\nignored\n')
+    (tmp_path / 'model.txt').write_text(
+        'dim 3\nstart_surface membrane\nread_file panels.txt\nend_surface\nread_file missing.txt\n')
+    statements = read_model_statements(str(tmp_path / 'model.txt'))
+    assert statements == [
+        ['dim', '3'], ['start_surface', 'membrane'], ['panel', 'sphere', '0', '0', '0', '1', '10', '10', 's1'],
+        ['end_surface'], ['read_file', 'missing.txt']]
+    assert include_files('dim 3  # no includes\n', str(tmp_path)) == 'dim 3  # no includes\n'
@@ -0,0 +1,381 @@
+"""Columnar helpers for the `molecules` output of `SmoldynProcess`.
+
+Analysis steps work on molecule *frames*: a dict of equal-length numpy arrays with the keys
+`coordinates` (shape `(n, 3)`), `species_id`, `state` (the integer `MolecState` code) and, when the
+process reports it, `serial`.
+
+Inside `SmoldynProcess` species are handled as small integer codes, which are Smoldyn's own species
+indices, and only turned into names through a `SpeciesTable` when they are read. The process emits its
+molecules as a `MoleculeTable`, which keeps the columns of the listed molecules as they came out of
+Smoldyn. It is also a read-only `Mapping` in the shape of the old `molecules` tree, whose entries are
+only built when they are accessed.
+
+`create_listmols_dataframe` builds a pandas DataFrame of listed molecules from `listmols2` rows, a
+`MoleculeTable` or a run of a `TrajectoryStore` without copying their columns.
+"""
+
+
+import collections.abc
+from typing import *
+import numpy as np
+from smoldyn_process.library.model_file import get_boundaries, get_species
+from smoldyn_process.library.store import TrajectoryStore
+
+
+def molecule_arrays(molecules: Union['MoleculeTable', Mapping[str, Dict[str, Any]]]) -> Dict[str, np.ndarray]:
+    """Convert the `molecules` emitted by `SmoldynProcess.update` into a molecule frame.
+
+        Args:
+            molecules:`Union[MoleculeTable, Mapping]`: a `MoleculeTable`, or a tree
+                `{mol_id: {'coordinates': [x, y, z], 'species_id': str, 'state': int, 'serial': int}}`.
+
+        Returns:
+            `Dict[str, np.ndarray]`: the molecule frame.
+    """
+    if isinstance(molecules, MoleculeTable):
+        return molecules.frame()
+    values = list(molecules.values())
+    coordinates = np.array([mol['coordinates'] for mol in values], dtype=float).reshape(len(values), -1) \
+        if values else np.empty((0, 3))
+    frame = {
+        'coordinates': coordinates,
+        'species_id': np.array([mol['species_id'] for mol in values], dtype=str),
+        'state': np.array([mol['state'] for mol in values]).astype(np.int8),
+    }
+    if values and 'serial' in values[0]:
+        frame['serial'] = np.array([mol['serial'] for mol in values], dtype=np.int64)
+    return frame
+
+
+class SpeciesTable:
+    """Mapping between species names and integer species codes, which are Smoldyn's species indices.
+
+        Codes are stored as `int8`, or `int16` for models with more than 127 species, and names are shared `str`
+        objects, so decoding does not create a string per molecule.
+
+        Args:
+            names:`Sequence[str]`: species names in Smoldyn's index order, including the `empty` species at index 0.
+    """
+
+    def __init__(self, names: Sequence[str]):
+        self.names = np.array(list(names), dtype=object)
+        self.dtype = np.int8 if len(self.names) <= np.iinfo(np.int8).max else np.int16
+        self.sorted_index = np.argsort(self.names.astype(str))
+        self.sorted_names = self.names.astype(str)[self.sorted_index]
+
+    def encode(self, names: Iterable[str]) -> np.ndarray:
+        """Return the code of each species name. Raises `KeyError` for names that are not in the table."""
+        names = np.asarray(list(names) if not isinstance(names, np.ndarray) else names, dtype=str)
+        position = np.minimum(np.searchsorted(self.sorted_names, names), len(self.sorted_names) - 1)
+        found = self.sorted_names[position] == names
+        if not np.all(found):
+            raise KeyError(f'unknown species: {sorted(set(names[~found].tolist()))}')
+        return self.sorted_index[position].astype(self.dtype)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        """Return the species name of each code, as an object array of shared strings."""
+        return self.names[np.asarray(codes, dtype=np.int64)]
+
+
+class MoleculeTable(collections.abc.Mapping):
+    """The molecules of one snapshot as columns, which is the value of the `molecule_table` port type.
+
+        As a `Mapping`, the table is keyed by the serial number of each molecule (as a string) and each value is
+        `{'coordinates': [x, y, z], 'species_id': str, 'state': int, 'serial': int}`. A value is created from the
+        columns when it is looked up, and iterating over the keys or taking `len` only reads the serial column.
+
+        Args:
+            coordinates:`np.ndarray`: positions, shape `(n, dim)`.
+            species_code:`np.ndarray`: code of the species of each molecule in `species_table`.
+            state:`np.ndarray`: `MolecState` value of each molecule.
+            serial:`np.ndarray`: Smoldyn serial number of each molecule.
+            species_table:`SpeciesTable`: the species names of the codes.
+    """
+
+    def __init__(
+            self,
+            coordinates: np.ndarray,
+            species_code: np.ndarray,
+            state: np.ndarray,
+            serial: np.ndarray,
+            species_table: SpeciesTable):
+        self.coordinates = coordinates
+        self.species_code = species_code
+        self.state = state
+        self.serial = serial
+        self.species_table = species_table
+        # rows in serial order, for looking molecules up by key
+        self.serial_order: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_rows(cls, rows: np.ndarray, species_table: SpeciesTable) -> 'MoleculeTable':
+        """Wrap `listmols2` rows, `[time, species, state, x, y, z, serial]`, with the coordinates as a view."""
+        rows = np.asarray(rows, dtype=float).reshape(-1, 7)
+        return cls(
+            rows[:, 3:6],
+            rows[:, 1].astype(species_table.dtype),
+            rows[:, 2].astype(np.int8),
+            rows[:, 6].astype(np.int64),
+            species_table)
+
+    @classmethod
+    def from_frame(cls, frame: Dict[str, Any]) -> 'MoleculeTable':
+        """Build a table from a molecule frame (or its columns as lists), with the species names that occur in it."""
+        names, codes = np.unique(np.asarray(frame.get('species_id', []), dtype=str), return_inverse=True)
+        species_table = SpeciesTable(names.tolist())
+        coordinates = np.asarray(frame.get('coordinates', []), dtype=float).reshape(len(codes), -1) \
+            if len(codes) else np.empty((0, 3))
+        serial = frame.get('serial')
+        return cls(
+            coordinates,
+            codes.astype(species_table.dtype),
+            np.asarray(frame.get('state', []), dtype=np.int8),
+            np.asarray(serial if serial is not None else np.arange(len(codes)), dtype=np.int64),
+            species_table)
+
+    @property
+    def species_id(self) -> np.ndarray:
+        """The species name of each molecule."""
+        return self.species_table.decode(self.species_code)
+
+    def row(self, mol_id: str) -> int:
+        """The row of the molecule with the key `mol_id`. Raises `KeyError` if there is none."""
+        try:
+            serial = int(mol_id)
+        except (TypeError, ValueError):
+            raise KeyError(mol_id) from None
+        if self.serial_order is None:
+            self.serial_order = np.argsort(self.serial, kind='stable')
+        position = np.searchsorted(self.serial, serial, sorter=self.serial_order)
+        if position == len(self.serial) or self.serial[self.serial_order[position]] != serial:
+            raise KeyError(mol_id)
+        return int(self.serial_order[position])
+
+    def __getitem__(self, mol_id: str) -> Dict[str, Any]:
+        row = self.row(mol_id)
+        return {
+            'coordinates': self.coordinates[row].tolist(),
+            'species_id': self.species_table.names[self.species_code[row]],
+            'state': int(self.state[row]),
+            'serial': int(self.serial[row]),
+        }
+
+    def __iter__(self) -> Iterator[str]:
+        return map(str, self.serial.tolist())
+
+    def __len__(self) -> int:
+        return len(self.serial)
+
+    def frame(self) -> Dict[str, np.ndarray]:
+        """The molecule frame of the table."""
+        return {
+            'coordinates': self.coordinates,
+            'species_id': self.species_id,
+            'state': self.state,
+            'serial': self.serial,
+        }
+
+
+def last_by_serial(frame: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """Keep only the last row for each serial number, sorted by serial.
+
+        A single update can report the same molecule at several time steps; the last row is its final position.
+    """
+    serial = frame['serial']
+    # `np.unique` returns first occurrences, so search the reversed serials
+    _, reversed_index = np.unique(serial[::-1], return_index=True)
+    rows = len(serial) - 1 - reversed_index
+    return {key: column[rows] for key, column in frame.items()}
+
+
+def select_species(frame: Dict[str, np.ndarray], species_names: Iterable[str]) -> Dict[str, np.ndarray]:
+    """Return the rows of `frame` whose species is in `species_names`. An empty selection keeps every row."""
+    species_names = list(species_names)
+    if not species_names:
+        return frame
+    mask = np.isin(frame['species_id'], species_names)
+    return {key: column[mask] for key, column in frame.items()}
+
+
+def listmols_columns(
+        model_fp: str = None,
+        values: Union[np.ndarray, List[List[Any]], MoleculeTable] = None,
+        store: Union[str, TrajectoryStore] = None,
+        run_id: str = None,
+        dim: int = None) -> Dict[str, Any]:
+    """Return the columns of the molecules of `create_listmols_dataframe` as arrays, with the species as `codes` into
+        a list of `categories`.
+    """
+    if store is not None:
+        store = TrajectoryStore(store) if isinstance(store, str) else store
+        run = store.load(run_id, columns=['frame_time', 'frame_offsets', 'coordinates', 'species_code', 'state', 'serial'])
+        return {
+            'time': np.repeat(run['frame_time'], np.diff(run['frame_offsets'])),
+            'codes': run['species_code'],
+            'categories': run['species_names'],
+            'state': run['state'],
+            'coordinates': run['coordinates'],
+            'serial': run['serial'],
+        }
+    if isinstance(values, MoleculeTable):
+        return {
+            'time': None,
+            'codes': values.species_code,
+            'categories': values.species_table.names.tolist(),
+            'state': values.state,
+            'coordinates': values.coordinates,
+            'serial': values.serial,
+        }
+
+    rows = np.asarray(values if values is not None else np.empty((0, 6)))
+    rows = rows.reshape(len(rows), -1)
+    if rows.dtype.kind in 'OUS':
+        # rows that name their species: [species_id, state, x, ..., serial_number]
+        categories, codes = np.unique(rows[:, 0].astype(str), return_inverse=True)
+        categories = categories.tolist()
+        rows = rows[:, 1:].astype(float)
+        time = None
+    else:
+        # `listmols2` rows, with or without the leading time column: [time, species, state, x, ..., serial]
+        dim = dim or (len(get_boundaries(model_fp)['low']) if model_fp else 3)
+        if rows.shape[1] not in (dim + 3, dim + 4):
+            raise ValueError(f'expected {dim + 3} or {dim + 4} columns of {dim}-dimensional listmols rows, '
+                             f'got {rows.shape[1]}')
+        rows = rows.astype(float, copy=False)
+        time, rows = (rows[:, 0], rows[:, 1:]) if rows.shape[1] == dim + 4 else (None, rows)
+        codes = rows[:, 0].astype(np.int16)
+        rows = rows[:, 1:]
+        # the species indices are decoded with the names of the model, if it is given
+        categories = get_species(model_fp) if model_fp else \
+            [str(index) for index in range(int(codes.max(initial=-1)) + 1)]
+    return {
+        'time': time,
+        'codes': codes,
+        'categories': categories,
+        'state': rows[:, 0].astype(np.int8),
+        'coordinates': rows[:, 1:-1],
+        'serial': rows[:, -1].astype(np.int64),
+    }
+
+
+def create_listmols_dataframe(
+        model_fp: str = None,
+        values: Union[np.ndarray, List[List[Any]], MoleculeTable] = None,
+        store: Union[str, TrajectoryStore] = None,
+        run_id: str = None,
+        backend: str = 'numpy',
+        dim: int = None) -> 'pandas.DataFrame':
+    """Return a DataFrame of listed molecules with the columns `species_id` (categorical), `state`, a coordinate
+        column per dimension (`x`, `y`, `z`) and `serial_number`, and `time` when the source has it.
+
+        The columns wrap the arrays of the source, without copying them where the layout allows it, and species are
+        kept as categorical codes, so a frame of a million molecules is built in milliseconds.
+
+        Args:
+            model_fp:`str`: model whose species names decode the species indices of numeric `values` rows, and whose
+                dimensionality tells whether the rows start with a time column.
+            values:`Union[np.ndarray, List[List[Any]], MoleculeTable]`: `listmols2` rows
+                `[time, species, state, x, y, z, serial]` as output by Smoldyn (with or without the time column, and
+                with species indices or names), or a `MoleculeTable` from `SmoldynProcess`.
+            store:`Union[str, TrajectoryStore]`: a trajectory store (or its path) to read the molecules of every frame
+                of `run_id` from, instead of `values`. Its columns are memory-mapped.
+            run_id:`str`: the run to read from `store`.
+            backend:`str`: `'numpy'` for NumPy-backed columns, or `'arrow'` for Arrow-backed ones (needs `pyarrow`).
+                Defaults to `'numpy'`.
+            dim:`int`: number of coordinates of numeric `values` rows. Defaults to the dimensionality of `model_fp`,
+                or 3.
+
+        Returns:
+            `pandas.DataFrame`: one row per molecule.
+    """
+    import pandas as pd
+
+    columns = listmols_columns(model_fp, values, store, run_id, dim)
+    data = {} if columns['time'] is None else {'time': columns['time']}
+    data['species_id'] = (columns['codes'], columns['categories'])
+    data['state'] = columns['state']
+    for axis, name in enumerate('xyz'[:columns['coordinates'].shape[1]]):
+        data[name] = columns['coordinates'][:, axis]
+    data['serial_number'] = columns['serial']
+
+    if backend == 'arrow':
+        import pyarrow as pa
+        arrays = {
+            name: pa.DictionaryArray.from_arrays(np.asarray(column[0]), pa.array(column[1], type=pa.string()))
+            if name == 'species_id' else pa.array(np.ascontiguousarray(column))
+            for name, column in data.items()
+        }
+        return pa.table(arrays).to_pandas(types_mapper=pd.ArrowDtype)
+    if backend != 'numpy':
+        raise ValueError(f'unknown DataFrame backend: {backend}')
+
+    codes, categories = data['species_id']
+    data['species_id'] = pd.Categorical.from_codes(codes, categories=categories)
+    return pd.DataFrame(data, copy=False)
+
+
+def test_species_table():
+    table = SpeciesTable(['empty', 'red', 'green'])
+    codes = table.encode(['green', 'red', 'green'])
+    assert codes.dtype == np.int8 and codes.tolist() == [2, 1, 2]
+    assert table.decode(codes).tolist() == ['green', 'red', 'green']
+    assert table.decode(codes)[0] is table.decode(codes)[2]
+    assert SpeciesTable([str(index) for index in range(200)]).dtype == np.int16
+
+
+def test_molecule_table():
+    table = MoleculeTable.from_rows(
+        [[0.1, 2, 0, 1.0, 2.0, 3.0, 7], [0.1, 1, 3, 4.0, 5.0, 6.0, 8]], SpeciesTable(['empty', 'red', 'green']))
+    assert len(table) == 2 and table.species_id.tolist() == ['green', 'red']
+    frame = molecule_arrays(table)
+    assert frame['coordinates'].tolist() == [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]] and frame['serial'].tolist() == [7, 8]
+
+    rebuilt = MoleculeTable.from_frame({key: column.tolist() for key, column in frame.items()})
+    assert rebuilt.species_id.tolist() == ['green', 'red'] and rebuilt.state.tolist() == [0, 3]
+    assert len(MoleculeTable.from_frame({})) == 0
+
+    # the tree view over the columns
+    assert list(table) == ['7', '8'] and '9' not in table
+    assert table['8'] == {'coordinates': [4.0, 5.0, 6.0], 'species_id': 'red', 'state': 3, 'serial': 8}
+    assert [molecule['species_id'] for molecule in table.values()] == ['green', 'red']
+
+
+def test_create_listmols_dataframe(tmp_path):
+    from smoldyn_process.library.store import frames_to_columns
+
+    rows = [[0.5, 2, 0, 1.0, 2.0, 3.0, 7], [0.5, 1, 3, 4.0, 5.0, 6.0, 8]]
+    frame = create_listmols_dataframe(values=rows)
+    assert list(frame.columns) == ['time', 'species_id', 'state', 'x', 'y', 'z', 'serial_number']
+    assert frame['species_id'].tolist() == ['2', '1'] and frame['serial_number'].tolist() == [7, 8]
+
+    # the species names come from the model, or from the rows themselves
+    frame = create_listmols_dataframe('smoldyn_process/models/model_files/crowding_model.txt', rows)
+    assert frame['species_id'].tolist() == ['green', 'red']
+    assert create_listmols_dataframe(values=[['red', 0, 1.0, 2.0, 3.0, 1]])['species_id'].tolist() == ['red']
+
+    # the columns are read by the dimensionality: 2-D rows with a time column are 7 wide like 3-D rows without
+    frame = create_listmols_dataframe(values=[[0.5, 1, 0, 1.0, 2.0, 7]], dim=2)
+    assert list(frame.columns) == ['time', 'species_id', 'state', 'x', 'y', 'serial_number']
+    assert frame['y'].tolist() == [2.0] and frame['serial_number'].tolist() == [7]
+    assert 'time' not in create_listmols_dataframe(values=[row[1:] for row in rows]).columns
+
+    table = MoleculeTable.from_rows(np.array(rows), SpeciesTable(['empty', 'red', 'green']))
+    frame = create_listmols_dataframe(values=table)
+    assert frame['species_id'].cat.categories.tolist() == ['empty', 'red', 'green']
+    assert frame['x'].tolist() == [1.0, 4.0]
+
+    store = TrajectoryStore(str(tmp_path))
+    columns, meta = frames_to_columns([{
+        'time': 0.5,
+        'count_time': np.zeros(1),
+        'counts': np.zeros((1, 2), dtype=np.int64),
+        'count_columns': ['red', 'green'],
+        'species_names': ['empty', 'red', 'green'],
+        'coordinates': table.coordinates,
+        'species_code': table.species_code,
+        'state': table.state,
+        'serial': table.serial,
+    }])
+    store.write_run('run', columns, meta)
+    frame = create_listmols_dataframe(store=str(tmp_path), run_id='run')
+    assert frame['time'].tolist() == [0.5, 0.5] and frame['species_id'].tolist() == ['green', 'red']
@@ -0,0 +1,181 @@
+"""Spatiotemporal queries over the runs of a `TrajectoryStore`.
+
+A query selects the molecules of a run by time, species, state and region, e.g. the positions of MinE
+within 0.2 of the pole between t=3 and t=5:
+
+    TrajectoryQuery(store, run_id).select(time=(3.0, 5.0), species=['MinE'], region=Ball([-2.0, 0.0, 0.0], 0.2))
+
+The frames in the time range are found by a binary search of `frame_time`, and only the rows of the grid
+cells that overlap the bounding box of the region are read from the memory-mapped columns, before the
+exact tests are applied. A region is anything with a bounding box (`low`, `high`) and a vectorized
+`contains`: a `Box`, a `Ball`, or a compartment `smoldyn_process.library.geometry.Region`.
+"""
+
+
+from typing import *
+import numpy as np
+from smoldyn_process.library.store import TrajectoryStore, grid_cells
+
+
+class Box:
+    """An axis-aligned box between the corners `low` and `high`."""
+
+    def __init__(self, low: Sequence[float], high: Sequence[float]):
+        self.low = np.asarray(low, dtype=float)
+        self.high = np.asarray(high, dtype=float)
+
+    def contains(self, points: np.ndarray) -> np.ndarray:
+        return np.all((points >= self.low) & (points <= self.high), axis=1)
+
+
+class Ball:
+    """The points within `radius` of `center`."""
+
+    def __init__(self, center: Sequence[float], radius: float):
+        self.center = np.asarray(center, dtype=float)
+        self.radius = float(radius)
+        self.low = self.center - self.radius
+        self.high = self.center + self.radius
+
+    def contains(self, points: np.ndarray) -> np.ndarray:
+        return np.sum((points - self.center) ** 2, axis=1) <= self.radius ** 2
+
+
+def concatenated_ranges(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """The indices of the half-open ranges `[starts[i], ends[i])`, concatenated in order."""
+    lengths = ends - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+    # each range continues from where the previous one ended
+    shifts = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return shifts + np.arange(total)
+
+
+class TrajectoryQuery:
+    """Queries on the molecules of one run of a `TrajectoryStore`, whose columns stay memory-mapped.
+
+        Args:
+            store:`Union[str, TrajectoryStore]`: the store, or its path.
+            run_id:`str`: the run to query.
+    """
+
+    def __init__(self, store: Union[str, TrajectoryStore], run_id: str):
+        store = TrajectoryStore(store) if isinstance(store, str) else store
+        self.run = store.load(
+            run_id, ('frame_time', 'frame_offsets', 'cell_offsets', 'coordinates', 'species_code', 'state', 'serial'))
+        self.grid = self.run['grid']
+        self.species_names: List[str] = self.run['species_names']
+
+    def frames(self, time: Optional[Tuple[float, float]] = None) -> np.ndarray:
+        """The indices of the frames whose time is within the closed range `time` (every frame if `None`)."""
+        frame_time = self.run['frame_time']
+        if time is None:
+            return np.arange(len(frame_time))
+        start, stop = time
+        return np.arange(np.searchsorted(frame_time, start, side='left'), np.searchsorted(frame_time, stop, side='right'))
+
+    def cells(self, region: Any = None) -> np.ndarray:
+        """The indices of the grid cells that overlap the bounding box of `region` (every cell if `None`)."""
+        cells, dim = self.grid['cells'], len(self.grid['low'])
+        if region is None:
+            return np.arange(cells ** dim)
+        # the cells of the box corners bound the cells on every axis
+        corners = grid_cells(np.array([region.low, region.high], dtype=float), self.grid)
+        low, high = np.array(np.unravel_index(corners, (cells,) * dim)).T
+        axes = [np.arange(first, last + 1) for first, last in zip(low, high)]
+        return np.ravel_multi_index(tuple(axis.ravel() for axis in np.meshgrid(*axes, indexing='ij')), (cells,) * dim)
+
+    def rows(self, frames: np.ndarray, cells: np.ndarray) -> np.ndarray:
+        """The rows of the molecules in the given cells of the given frames, in frame order."""
+        cells = np.sort(cells)
+        starts = self.run['frame_offsets'][frames][:, None] + self.run['cell_offsets'][frames][:, cells]
+        ends = self.run['frame_offsets'][frames][:, None] + self.run['cell_offsets'][frames][:, cells + 1]
+        return concatenated_ranges(starts.ravel(), ends.ravel())
+
+    def select(
+            self,
+            time: Optional[Tuple[float, float]] = None,
+            species: Optional[Sequence[str]] = None,
+            states: Optional[Sequence[int]] = None,
+            region: Any = None) -> Dict[str, np.ndarray]:
+        """Select the molecules that match every given predicate.
+
+            Args:
+                time:`Tuple[float, float]`: the range of frame times, both ends included.
+                species:`Sequence[str]`: species names.
+                states:`Sequence[int]`: `MolecState` values.
+                region: a `Box`, `Ball` or `Region` the molecules are in.
+
+            Returns:
+                `Dict[str, np.ndarray]`: the `time`, `coordinates`, `species_id`, `state` and `serial` of each
+                    selected molecule, in frame order.
+        """
+        frames = self.frames(time)
+        rows = self.rows(frames, self.cells(region))
+        frame_offsets = self.run['frame_offsets']
+        frame_of_row = np.searchsorted(frame_offsets, rows, side='right') - 1
+
+        # the cheap columns are filtered first, so fewer coordinates are read
+        keep = np.ones(len(rows), dtype=bool)
+        species_code = self.run['species_code'][rows]
+        if species is not None:
+            codes = [self.species_names.index(name) for name in species if name in self.species_names]
+            keep &= np.isin(species_code, codes)
+        state = self.run['state'][rows]
+        if states is not None:
+            keep &= np.isin(state, list(states))
+        rows, frame_of_row, species_code, state = rows[keep], frame_of_row[keep], species_code[keep], state[keep]
+
+        coordinates = self.run['coordinates'][rows]
+        if region is not None:
+            inside = region.contains(coordinates)
+            rows, frame_of_row, species_code, state = rows[inside], frame_of_row[inside], species_code[inside], state[inside]
+            coordinates = coordinates[inside]
+        return {
+            'time': self.run['frame_time'][frame_of_row],
+            'coordinates': coordinates,
+            'species_id': np.asarray(self.species_names, dtype=object)[species_code.astype(np.int64)],
+            'state': state,
+            'serial': self.run['serial'][rows],
+        }
+
+
+def test_trajectory_query(tmp_path):
+    from smoldyn_process.library.store import frames_to_columns
+
+    rng = np.random.default_rng(0)
+    frames = []
+    for index in range(10):
+        coordinates = rng.uniform(-2.0, 2.0, size=(2000, 3))
+        frames.append({
+            'time': 0.5 * (index + 1),
+            'count_time': np.zeros(1),
+            'counts': np.zeros((1, 2), dtype=np.int64),
+            'count_columns': ['MinD', 'MinE'],
+            'species_names': ['empty', 'MinD', 'MinE'],
+            'coordinates': coordinates,
+            'species_code': rng.integers(1, 3, size=2000).astype(np.int8),
+            'state': rng.integers(0, 2, size=2000).astype(np.int8),
+            'serial': np.arange(2000, dtype=np.int64) + 2000 * index,
+        })
+    store = TrajectoryStore(str(tmp_path))
+    columns, meta = frames_to_columns(frames)
+    store.write_run('run', columns, meta)
+
+    query = TrajectoryQuery(str(tmp_path), 'run')
+    pole = Ball([-2.0, 0.0, 0.0], 0.8)
+    result = query.select(time=(1.5, 2.5), species=['MinE'], states=[0], region=pole)
+
+    # the same selection by brute force over the input frames
+    expected = []
+    for frame in frames[2:5]:
+        match = (frame['species_code'] == 2) & (frame['state'] == 0) & pole.contains(frame['coordinates'])
+        expected.extend(frame['serial'][match].tolist())
+    assert sorted(result['serial'].tolist()) == sorted(expected) and len(expected) > 0
+    assert set(result['time'].tolist()) == {1.5, 2.0, 2.5} and set(result['species_id']) == {'MinE'}
+    # only the cells around the pole are read
+    assert len(query.rows(query.frames((1.5, 2.5)), query.cells(pole))) < 0.1 * 3 * 2000
+
+    box = query.select(region=Box([0.0, 0.0, 0.0], [2.0, 2.0, 2.0]))
+    assert np.all(box['coordinates'] >= 0.0) and len(query.select()['serial']) == 20000
@@ -0,0 +1,207 @@
+"""A columnar on-disk store for the trajectories of many Smoldyn runs.
+
+Each run is a directory of `.npy` columns under `runs/`, so a column can be memory-mapped without reading
+the rest of the run, and a `manifest.json` at the root records every finished run and its metadata.
+A run's directory is written under a temporary name and renamed when complete, and the manifest is
+replaced atomically, so a store interrupted in the middle of a batch only ever lists complete runs.
+
+The molecules of each frame are written sorted by the cell of a coarse grid over the run's bounding box
+(the `grid` of the run's metadata), and `cell_offsets` locates the rows of every cell, so a spatial
+query only reads the rows of the cells it overlaps (see `smoldyn_process.library.query`).
+
+Columns of a run:
+
+    count_time      (n_rows,)           time of each `molcount` row, from the start of the run
+    counts          (n_rows, n_species) molecule count of each species of `count_columns`
+    frame_time      (n_frames,)         time at the end of each interval with listed molecules
+    frame_offsets   (n_frames + 1,)     first molecule row of each frame
+    coordinates     (n_molecules, dim)
+    species_code    (n_molecules,)      index into `species_names`
+    state           (n_molecules,)      `MolecState` value
+    serial          (n_molecules,)
+    cell_offsets    (n_frames, n_cells + 1) first row of each grid cell, from the start of its frame
+"""
+
+
+import json
+import os
+import shutil
+import uuid
+from typing import *
+import numpy as np
+
+
+COLUMNS = ('count_time', 'counts', 'frame_time', 'frame_offsets', 'coordinates', 'species_code', 'state', 'serial')
+MOLECULE_COLUMNS = ('coordinates', 'species_code', 'state', 'serial')
+# cells of the spatial grid index along each axis
+GRID_CELLS = 8
+
+
+def frames_to_columns(frames: Iterable[Dict[str, Any]]) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+    """Concatenate the interval frames of a run (as streamed by `smoldyn_process.processes.smoldyn_server`) into
+        the columns of the store, and return them with the run's `count_columns` and `species_names`.
+    """
+    count_time, counts, frame_time, offsets = [], [], [], [0]
+    molecules: Dict[str, list] = {'coordinates': [], 'species_code': [], 'state': [], 'serial': []}
+    meta: Dict[str, Any] = {'count_columns': [], 'species_names': []}
+    start = 0.0
+    for frame in frames:
+        meta['count_columns'] = frame['count_columns']
+        meta['species_names'] = frame['species_names']
+        # Smoldyn restarts the clock at every interval
+        count_time.append(frame['count_time'] + start)
+        counts.append(frame['counts'])
+        start = frame['time']
+        if 'coordinates' in frame:
+            frame_time.append(frame['time'])
+            offsets.append(offsets[-1] + len(frame['coordinates']))
+            for name in molecules:
+                molecules[name].append(frame[name])
+
+    n_species = len(meta['count_columns'])
+    columns = {
+        'count_time': np.concatenate(count_time) if count_time else np.empty(0),
+        'counts': np.concatenate(counts) if counts else np.empty((0, n_species), dtype=np.int64),
+        'frame_time': np.asarray(frame_time, dtype=float),
+        'frame_offsets': np.asarray(offsets, dtype=np.int64),
+        'coordinates': np.concatenate(molecules['coordinates']) if frame_time else np.empty((0, 3)),
+        'species_code': np.concatenate(molecules['species_code']) if frame_time else np.empty(0, dtype=np.int8),
+        'state': np.concatenate(molecules['state']) if frame_time else np.empty(0, dtype=np.int8),
+        'serial': np.concatenate(molecules['serial']) if frame_time else np.empty(0, dtype=np.int64),
+    }
+    return columns, meta
+
+
+def grid_cells(coordinates: np.ndarray, grid: Dict[str, Any]) -> np.ndarray:
+    """The index of the grid cell of each point, in C order over the cells of every axis."""
+    low, high, cells = np.asarray(grid['low']), np.asarray(grid['high']), grid['cells']
+    width = np.where(high > low, high - low, 1.0)
+    cell = np.clip(((coordinates - low) / width * cells).astype(np.int64), 0, cells - 1)
+    return np.ravel_multi_index(tuple(cell.T), (cells,) * coordinates.shape[1]) if len(cell) \
+        else np.empty(0, dtype=np.int64)
+
+
+def index_columns(
+        columns: Dict[str, np.ndarray],
+        cells: int = GRID_CELLS) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+    """Sort the molecules of each frame by grid cell and add their `cell_offsets`. Returns the columns and the `grid`
+        (bounding box and cells per axis).
+    """
+    coordinates = columns['coordinates']
+    dim = coordinates.shape[1]
+    grid = {
+        'low': coordinates.min(axis=0).tolist() if len(coordinates) else [0.0] * dim,
+        'high': coordinates.max(axis=0).tolist() if len(coordinates) else [0.0] * dim,
+        'cells': cells,
+    }
+    n_frames, n_cells = len(columns['frame_time']), cells ** dim
+    frame = np.repeat(np.arange(n_frames), np.diff(columns['frame_offsets']))
+    key = frame * n_cells + grid_cells(coordinates, grid)
+    order = np.argsort(key, kind='stable')
+
+    cell_counts = np.bincount(key, minlength=n_frames * n_cells).reshape(n_frames, n_cells)
+    cell_offsets = np.zeros((n_frames, n_cells + 1), dtype=np.int64)
+    np.cumsum(cell_counts, axis=1, out=cell_offsets[:, 1:])
+    indexed = {name: column[order] if name in MOLECULE_COLUMNS else column for name, column in columns.items()}
+    indexed['cell_offsets'] = cell_offsets
+    return indexed, grid
+
+
+class TrajectoryStore:
+    """The runs of a batch, stored column by column under `path`."""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.join(path, 'runs'), exist_ok=True)
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.path, 'manifest.json')
+
+    def manifest(self) -> Dict[str, Dict[str, Any]]:
+        """Run id to the metadata of every finished run."""
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, 'r') as file:
+            return json.load(file)
+
+    def run_path(self, run_id: str) -> str:
+        return os.path.join(self.path, 'runs', run_id)
+
+    def write_run(self, run_id: str, columns: Dict[str, np.ndarray], meta: Dict[str, Any]) -> None:
+        """Write the columns and metadata of a run, replacing any earlier run with the same id. The molecules are
+            indexed by grid cell as they are written. The run is not listed in the manifest until `record` is called.
+        """
+        columns, grid = index_columns(columns)
+        meta = {**meta, 'grid': grid}
+        partial_path = os.path.join(self.path, 'runs', f'.partial-{run_id}-{uuid.uuid4().hex[:8]}')
+        os.makedirs(partial_path)
+        for name, column in columns.items():
+            np.save(os.path.join(partial_path, f'{name}.npy'), column)
+        with open(os.path.join(partial_path, 'meta.json'), 'w') as file:
+            json.dump(meta, file)
+        shutil.rmtree(self.run_path(run_id), ignore_errors=True)
+        os.rename(partial_path, self.run_path(run_id))
+
+    def record(self, entries: Dict[str, Dict[str, Any]]) -> None:
+        """Add (or replace) manifest entries."""
+        manifest = self.manifest()
+        manifest.update(entries)
+        partial_path = f'{self.manifest_path}.partial'
+        with open(partial_path, 'w') as file:
+            json.dump(manifest, file, indent=1)
+        os.replace(partial_path, self.manifest_path)
+
+    def completed(self) -> Set[str]:
+        """The ids of the runs that finished and are still on disk."""
+        return {
+            run_id for run_id, entry in self.manifest().items()
+            if entry.get('status') == 'done' and os.path.isdir(self.run_path(run_id))
+        }
+
+    def clean(self) -> None:
+        """Remove the partial runs left behind by an interrupted batch."""
+        runs_path = os.path.join(self.path, 'runs')
+        for name in os.listdir(runs_path):
+            if name.startswith('.partial-'):
+                shutil.rmtree(os.path.join(runs_path, name), ignore_errors=True)
+
+    def load(self, run_id: str, columns: Sequence[str] = COLUMNS, mmap: bool = True) -> Dict[str, Any]:
+        """Read `columns` of a run (memory-mapped by default) together with its metadata."""
+        run_path = self.run_path(run_id)
+        with open(os.path.join(run_path, 'meta.json'), 'r') as file:
+            run = json.load(file)
+        for name in columns:
+            run[name] = np.load(os.path.join(run_path, f'{name}.npy'), mmap_mode='r' if mmap else None)
+        return run
+
+
+def test_trajectory_store(tmp_path):
+    frames = [
+        {
+            'time': 0.5 * (index + 1),
+            'count_time': np.array([0.0, 0.25, 0.5]),
+            'counts': np.full((3, 2), index, dtype=np.int64),
+            'count_columns': ['a', 'b'],
+            'species_names': ['empty', 'a', 'b'],
+            'coordinates': np.full((index + 1, 3), float(index)),
+            'species_code': np.ones(index + 1, dtype=np.int8),
+            'state': np.zeros(index + 1, dtype=np.int8),
+            'serial': np.arange(index + 1, dtype=np.int64),
+        }
+        for index in range(2)]
+    columns, meta = frames_to_columns(frames)
+    assert np.allclose(columns['count_time'], [0.0, 0.25, 0.5, 0.5, 0.75, 1.0])
+    assert columns['frame_offsets'].tolist() == [0, 1, 3]
+
+    store = TrajectoryStore(str(tmp_path))
+    store.write_run('run', columns, meta)
+    assert store.completed() == set()
+    store.record({'run': {'status': 'done'}})
+    assert store.completed() == {'run'}
+    run = store.load('run', COLUMNS + ('cell_offsets',))
+    assert run['species_names'] == ['empty', 'a', 'b']
+    assert np.array_equal(run['coordinates'][run['frame_offsets'][1]:], np.ones((2, 3)))
+    # every molecule of the second frame is in the last cell of the grid over [0, 1]
+    assert run['cell_offsets'].shape == (2, GRID_CELLS ** 3 + 1)
+    assert run['cell_offsets'][1, -2] == 0 and run['cell_offsets'][1, -1] == 2
@@ -0,0 +1,321 @@
+"""
+Cluster Analysis Step
+
+Finds clusters of molecules in each molecule frame emitted by `SmoldynProcess`. Two molecules are
+neighbors when they are closer than a cutoff distance (for example the `binding_radius` of a reaction
+in the model), and clusters are the connected components of that neighbor graph.
+
+The neighbor search uses a uniform cell list whose cells are at least one cutoff wide, so only
+molecules in adjacent cells are compared, and the components are found with a vectorized union-find
+(hooking + pointer jumping). Both are linear in the number of molecules for a fixed density.
+"""
+
+
+from typing import *
+import numpy as np
+from process_bigraph import Step, process_registry
+from smoldyn_process.library.model_file import get_binding_radii, get_boundaries
+from smoldyn_process.library.molecules import molecule_arrays, select_species
+
+
+# the 27 cell offsets (-1, 0, 1)^3 that cover a cell and its neighbors
+NEIGHBOR_OFFSETS = np.stack(np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1], indexing='ij'), -1).reshape(-1, 3)
+
+
+class CellList:
+    """A uniform grid of cells over `low`-`high`, each at least `cutoff` wide, with molecules sorted by cell.
+
+        Attributes:
+            shape:`np.ndarray`: number of cells along each axis.
+            cells:`np.ndarray`: integer cell coordinates of each molecule, shape `(n, dim)`.
+            order:`np.ndarray`: molecule indices sorted by flat cell index.
+            starts:`np.ndarray`: offset of each flat cell into `order`.
+            counts:`np.ndarray`: number of molecules in each flat cell.
+    """
+
+    def __init__(
+            self,
+            coordinates: np.ndarray,
+            cutoff: float,
+            low: Sequence[float],
+            high: Sequence[float],
+            max_cells_per_molecule: int = 8):
+        low = np.asarray(low, dtype=float)
+        high = np.asarray(high, dtype=float)
+        extent = np.maximum(high - low, cutoff)
+
+        # keep the grid linear in the number of molecules by widening the cells of sparse frames
+        cell_size = cutoff
+        max_cells = max(len(coordinates), 1) * max_cells_per_molecule
+        if np.prod(np.floor(extent / cell_size)) > max_cells:
+            cell_size = max(cutoff, (np.prod(extent) / max_cells) ** (1.0 / len(extent)))
+
+        self.shape = np.maximum(np.floor(extent / cell_size).astype(np.int64), 1)
+        self.low = low
+        self.extent = extent
+        scaled = (coordinates - low) / extent * self.shape
+        self.cells = np.clip(np.floor(scaled).astype(np.int64), 0, self.shape - 1)
+
+        flat = np.ravel_multi_index(self.cells.T, self.shape)
+        self.order = np.argsort(flat, kind='stable')
+        self.counts = np.bincount(flat, minlength=int(np.prod(self.shape)))
+        self.starts = np.cumsum(self.counts) - self.counts
+
+    def neighbor_candidates(self, periodic: bool = False) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Yield `(i, j)` index arrays of molecule pairs, `i < j`, that share a cell or sit in adjacent cells."""
+        offsets = NEIGHBOR_OFFSETS
+        if periodic:
+            # on grids narrower than 3 cells several offsets wrap onto the same cell
+            offsets = np.unique(offsets % self.shape, axis=0)
+
+        molecule_index = np.arange(len(self.cells))
+        for offset in offsets:
+            neighbor = self.cells + offset
+            if periodic:
+                neighbor %= self.shape
+                source = molecule_index
+            else:
+                inside = np.all((neighbor >= 0) & (neighbor < self.shape), axis=1)
+                source = molecule_index[inside]
+                neighbor = neighbor[inside]
+            flat_neighbor = np.ravel_multi_index(neighbor.T, self.shape)
+
+            # expand each molecule against every member of its neighbor cell
+            counts = self.counts[flat_neighbor]
+            total = int(counts.sum())
+            if total == 0:
+                continue
+            i = np.repeat(source, counts)
+            within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            j = self.order[np.repeat(self.starts[flat_neighbor], counts) + within]
+            keep = i < j
+            yield i[keep], j[keep]
+
+
+def neighbor_pairs(
+        coordinates: np.ndarray,
+        cutoff: float,
+        low: Sequence[float] = None,
+        high: Sequence[float] = None,
+        periodic: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """Find every pair of molecules closer than `cutoff`.
+
+        Args:
+            coordinates:`np.ndarray`: molecule positions, shape `(n, dim)`.
+            cutoff:`float`: neighbor distance.
+            low:`Sequence[float]`: lower corner of the system. Defaults to the smallest coordinates.
+            high:`Sequence[float]`: upper corner of the system. Defaults to the largest coordinates.
+            periodic:`bool`: apply minimum-image distances across `low`-`high`, which are then required.
+                Defaults to `False`.
+
+        Returns:
+            `Tuple[np.ndarray, np.ndarray]`: index arrays `(i, j)` with `i < j`.
+    """
+    if periodic and (low is None or high is None):
+        raise ValueError('periodic neighbor search requires the `low` and `high` corners of the periodic box.')
+    coordinates = np.asarray(coordinates, dtype=float)
+    if len(coordinates) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+
+    low = coordinates.min(axis=0) if low is None else np.asarray(low, dtype=float)
+    high = coordinates.max(axis=0) if high is None else np.asarray(high, dtype=float)
+    cell_list = CellList(coordinates, cutoff, low, high)
+
+    pairs_i, pairs_j = [], []
+    for i, j in cell_list.neighbor_candidates(periodic):
+        delta = coordinates[j] - coordinates[i]
+        if periodic:
+            delta -= cell_list.extent * np.round(delta / cell_list.extent)
+        close = np.einsum('ij,ij->i', delta, delta) < cutoff * cutoff
+        pairs_i.append(i[close])
+        pairs_j.append(j[close])
+
+    if not pairs_i:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+
+def connected_components(n_nodes: int, i: np.ndarray, j: np.ndarray) -> np.ndarray:
+    """Label the connected components of the graph with edges `(i, j)` using a vectorized union-find.
+
+        Every round hooks the larger root of each edge onto the smaller one, then compresses all paths by
+        pointer jumping, so no Python-level loop runs over nodes or edges.
+
+        Returns:
+            `np.ndarray`: the component label of each node, which is the smallest node index in its component.
+    """
+    labels = np.arange(n_nodes)
+    while True:
+        root_i = labels[i]
+        root_j = labels[j]
+        unmerged = root_i != root_j
+        if not unmerged.any():
+            return labels
+
+        root_i = root_i[unmerged]
+        root_j = root_j[unmerged]
+        np.minimum.at(labels, np.maximum(root_i, root_j), np.minimum(root_i, root_j))
+
+        # pointer jumping until every node points at its root
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+
+
+def find_clusters(
+        coordinates: np.ndarray,
+        cutoff: float,
+        low: Sequence[float] = None,
+        high: Sequence[float] = None,
+        periodic: bool = False) -> Dict[str, np.ndarray]:
+    """Cluster the molecules at `coordinates` by single linkage at `cutoff`.
+
+        Returns:
+            `Dict[str, np.ndarray]`: `labels` (cluster index of each molecule), `sizes` (molecules per cluster),
+                `centroids` (shape `(n_clusters, dim)`) and `size_histogram`, where `size_histogram[k]` is the
+                number of clusters with `k` molecules.
+    """
+    coordinates = np.asarray(coordinates, dtype=float)
+    i, j = neighbor_pairs(coordinates, cutoff, low, high, periodic)
+    roots = connected_components(len(coordinates), i, j)
+    root_ids, labels = np.unique(roots, return_inverse=True)
+    sizes = np.bincount(labels, minlength=len(root_ids))
+
+    # average displacements from each cluster's root so that periodic clusters are not split across the box
+    delta = coordinates - coordinates[roots]
+    if periodic and len(coordinates):
+        extent = np.asarray(high, dtype=float) - np.asarray(low, dtype=float)
+        delta -= extent * np.round(delta / extent)
+    centroids = coordinates[root_ids] + np.stack([
+        np.bincount(labels, weights=delta[:, axis], minlength=len(root_ids))
+        for axis in range(coordinates.shape[1])
+    ], axis=-1) / np.maximum(sizes, 1)[:, None]
+    if periodic and len(coordinates):
+        centroids = low + np.mod(centroids - low, extent)
+
+    return {
+        'labels': labels,
+        'sizes': sizes,
+        'centroids': centroids,
+        'size_histogram': np.bincount(sizes, minlength=2),
+    }
+
+
+class ClusterAnalysis(Step):
+    """Emit cluster-size histograms and per-cluster centroids for each molecule frame.
+
+        Attributes:
+            cutoff:`float`: neighbor distance. If not set, the largest `binding_radius` in `model_filepath` is used.
+            model_filepath:`str`: optional Smoldyn model used for the cutoff and the system boundaries.
+            species:`List[str]`: species to include. Defaults to every species.
+            periodic:`bool`: use periodic (minimum-image) distances. Read from the model boundaries if a model
+                is given, which is required for periodic distances.
+    """
+
+    config_schema = {
+        'cutoff': 'float',
+        'model_filepath': 'string',
+        'species': 'list[string]',
+        'periodic': 'boolean',
+    }
+
+    def __init__(self, config: Dict[str, Any] = None):
+        super().__init__(config)
+
+        self.model_filepath = self.config.get('model_filepath')
+        self.species_names: List[str] = self.config.get('species') or []
+        self.periodic = bool(self.config.get('periodic'))
+        self.low = self.high = None
+        self.cutoff = self.config.get('cutoff')
+
+        if self.model_filepath:
+            boundaries = get_boundaries(self.model_filepath)
+            self.low = boundaries['low']
+            self.high = boundaries['high']
+            self.periodic = self.periodic or all(boundaries['periodic'])
+            if not self.cutoff:
+                binding_radii = get_binding_radii(self.model_filepath)
+                self.cutoff = max(binding_radii.values(), default=0.0)
+
+        if self.periodic and self.low is None:
+            raise ValueError('ClusterAnalysis needs a `model_filepath` for the boundaries of a periodic system.')
+        if not self.cutoff:
+            raise ValueError(
+                'ClusterAnalysis requires a positive `cutoff`, or a `model_filepath` declaring a binding_radius.')
+
+    def schema(self) -> Dict[str, Dict]:
+        array_set = {'_type': 'numpy_array', '_apply': 'set'}
+        return {
+            'inputs': {
+                'molecules': 'tree[any]',
+            },
+            'outputs': {
+                'clusters': {
+                    'size_histogram': array_set,
+                    'sizes': array_set,
+                    'centroids': array_set,
+                },
+            },
+        }
+
+    def update(self, state: Dict) -> Dict:
+        frame = select_species(molecule_arrays(state['molecules']), self.species_names)
+        clusters = find_clusters(
+            frame['coordinates'],
+            self.cutoff,
+            low=self.low,
+            high=self.high,
+            periodic=self.periodic)
+
+        return {
+            'clusters': {
+                'size_histogram': clusters['size_histogram'],
+                'sizes': clusters['sizes'],
+                'centroids': clusters['centroids'],
+            }
+        }
+
+
+process_registry.register('cluster_analysis', ClusterAnalysis)
+
+
+def test_find_clusters():
+    rng = np.random.default_rng(0)
+    coordinates = rng.uniform(0, 10, size=(500, 3))
+    cutoff = 0.8
+    clusters = find_clusters(coordinates, cutoff, low=[0, 0, 0], high=[10, 10, 10])
+
+    # compare against brute force single linkage
+    distances = np.linalg.norm(coordinates[:, None] - coordinates[None], axis=-1)
+    adjacency = distances < cutoff
+    labels = np.arange(len(coordinates))
+    for _ in range(len(coordinates)):
+        labels = np.min(np.where(adjacency, labels[None], len(coordinates)), axis=1)
+    _, expected = np.unique(labels, return_inverse=True)
+    assert np.array_equal(clusters['labels'], expected)
+    assert clusters['sizes'].sum() == len(coordinates)
+    assert np.dot(np.arange(len(clusters['size_histogram'])), clusters['size_histogram']) == len(coordinates)
+
+
+def test_periodic_clusters():
+    # two molecules on opposite faces of a periodic box form one cluster centered on the boundary
+    coordinates = np.array([[0.1, 5.0, 5.0], [9.9, 5.0, 5.0], [5.0, 5.0, 5.0]])
+    clusters = find_clusters(coordinates, 0.5, low=[0, 0, 0], high=[10, 10, 10], periodic=True)
+    assert sorted(clusters['sizes'].tolist()) == [1, 2]
+    paired = clusters['centroids'][clusters['sizes'] == 2][0]
+    assert min(paired[0], 10 - paired[0]) < 1e-9
+
+    # the periodic box is never guessed from the coordinates
+    for call in (
+            lambda: find_clusters(coordinates, 0.5, periodic=True),
+            lambda: neighbor_pairs(coordinates, 0.5, low=[0, 0, 0], periodic=True),
+            lambda: ClusterAnalysis({'cutoff': 0.5, 'periodic': True})):
+        try:
+            call()
+        except ValueError:
+            continue
+        raise AssertionError('expected a ValueError without the periodic box')
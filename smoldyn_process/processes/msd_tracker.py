@@ -0,0 +1,237 @@
+"""
+Mean-Squared Displacement Tracker Step
+
+Follows molecules across molecule frames by their Smoldyn serial number and accumulates per-species
+mean-squared displacement (MSD) curves over lag times, from which apparent diffusion coefficients are
+estimated and reported next to the `difc` values declared in the model.
+
+The molecules have to keep their serial numbers from frame to frame, which a `SmoldynProcess` only does with
+`preserve_molecules` (its default update redistributes the molecules, and re-created molecules get new serials),
+or along the trajectory of its `iter_frames`.
+
+Frames are joined with sorted-array lookups (`np.searchsorted`) on serial numbers. Only the last
+`max_lag` frames are kept, in a ring buffer, and the MSD sums are accumulated in place, so the
+trajectory is never stored.
+"""
+
+
+from collections import deque
+from typing import *
+import numpy as np
+from process_bigraph import Step, process_registry, types
+from smoldyn_process.library.model_file import get_boundaries, get_diffusion_coefficients
+from smoldyn_process.library.molecules import molecule_arrays, last_by_serial
+
+
+def join_by_serial(reference_serials: np.ndarray, serials: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Match `serials` against the sorted array `reference_serials`.
+
+        Returns:
+            `Tuple[np.ndarray, np.ndarray]`: index arrays `(reference_index, index)` of the matching rows.
+    """
+    if len(reference_serials) == 0 or len(serials) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    position = np.searchsorted(reference_serials, serials)
+    position = np.minimum(position, len(reference_serials) - 1)
+    found = reference_serials[position] == serials
+    return position[found], np.flatnonzero(found)
+
+
+class MSDAccumulator:
+    """Streaming per-species MSD sums over lags `1..max_lag` (in frames).
+
+        Each frame is given as serial-sorted arrays. Positions are unwrapped across periodic boundaries by joining
+        each frame with the one before it, so displacements over long lags stay correct.
+    """
+
+    def __init__(self, max_lag: int, extent: Optional[np.ndarray] = None):
+        self.max_lag = max_lag
+        self.extent = extent
+        self.frames = deque(maxlen=max_lag)
+        self.species_names: List[str] = []
+        self.squared_displacement = np.zeros((0, max_lag))
+        self.counts = np.zeros((0, max_lag), dtype=np.int64)
+
+    def _species_codes(self, species_ids: np.ndarray) -> np.ndarray:
+        names, inverse = np.unique(species_ids, return_inverse=True)
+        for name in names:
+            if name not in self.species_names:
+                self.species_names.append(str(name))
+        n_new = len(self.species_names) - len(self.squared_displacement)
+        if n_new:
+            self.squared_displacement = np.vstack([self.squared_displacement, np.zeros((n_new, self.max_lag))])
+            self.counts = np.vstack([self.counts, np.zeros((n_new, self.max_lag), dtype=np.int64)])
+        lookup = np.array([self.species_names.index(name) for name in names], dtype=np.int64)
+        return lookup[inverse]
+
+    def add_frame(self, serial: np.ndarray, coordinates: np.ndarray, species_ids: np.ndarray) -> None:
+        order = np.argsort(serial, kind='stable')
+        serial = serial[order]
+        coordinates = coordinates[order]
+        species = self._species_codes(species_ids[order])
+
+        # unwrap against the previous frame
+        if self.frames and self.extent is not None:
+            previous_serial, previous_coordinates, _ = self.frames[-1]
+            previous_index, index = join_by_serial(previous_serial, serial)
+            delta = coordinates[index] - previous_coordinates[previous_index]
+            delta -= self.extent * np.round(delta / self.extent)
+            coordinates = coordinates.copy()
+            coordinates[index] = previous_coordinates[previous_index] + delta
+
+        # the most recent frame in the buffer is lag 1, the oldest is lag len(frames)
+        for lag, (past_serial, past_coordinates, _) in enumerate(reversed(self.frames), 1):
+            past_index, index = join_by_serial(past_serial, serial)
+            delta = coordinates[index] - past_coordinates[past_index]
+            squared = np.einsum('ij,ij->i', delta, delta)
+            codes = species[index]
+            self.squared_displacement[:, lag - 1] += np.bincount(
+                codes, weights=squared, minlength=len(self.species_names))
+            self.counts[:, lag - 1] += np.bincount(codes, minlength=len(self.species_names))
+
+        self.frames.append((serial, coordinates, species))
+
+    def msd(self) -> np.ndarray:
+        """MSD per species and lag, shape `(n_species, max_lag)`; `nan` where no displacement was observed."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.counts > 0, self.squared_displacement / self.counts, np.nan)
+
+
+def fit_diffusion_coefficients(msd: np.ndarray, lag_times: np.ndarray, dim: int) -> np.ndarray:
+    """Least-squares fit of `MSD = 2 * dim * D * t` through the origin for each row of `msd`."""
+    observed = ~np.isnan(msd)
+    weighted = np.where(observed, msd * lag_times, 0.0).sum(axis=1)
+    normalization = np.where(observed, lag_times * lag_times, 0.0).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(normalization > 0, weighted / (2 * dim * normalization), np.nan)
+
+
+class MSDTracker(Step):
+    """Track molecules by serial number and report per-species MSD curves and apparent diffusion coefficients.
+        Molecules whose serial is not in the earlier frames are not counted, see the module docstring for sources.
+
+        Attributes:
+            max_lag:`int`: number of frame lags to accumulate. Defaults to 10.
+            frame_interval:`float`: simulation time between frames, i.e. the interval of the Smoldyn process.
+                Defaults to 1.
+            dim:`int`: dimensionality of the motion. Use 2 for surface-bound species. Defaults to 3.
+            model_filepath:`str`: optional Smoldyn model, used for periodic boundaries and the reported `difc` values.
+    """
+
+    config_schema = {
+        'max_lag': 'int',
+        'frame_interval': 'float',
+        'dim': 'int',
+        'model_filepath': 'string',
+    }
+
+    def __init__(self, config: Dict[str, Any] = None):
+        super().__init__(config)
+        self.max_lag = self.config.get('max_lag') or 10
+        self.frame_interval = self.config.get('frame_interval') or 1.0
+        self.dim = self.config.get('dim') or 3
+        self.model_filepath = self.config.get('model_filepath')
+
+        extent = None
+        self.model_difc: Dict[str, float] = {}
+        if self.model_filepath:
+            boundaries = get_boundaries(self.model_filepath)
+            if all(boundaries['periodic']):
+                extent = np.subtract(boundaries['high'], boundaries['low'])
+            self.model_difc = get_diffusion_coefficients(self.model_filepath)
+
+        self.accumulator = MSDAccumulator(self.max_lag, extent)
+        self.lag_times = self.frame_interval * np.arange(1, self.max_lag + 1)
+
+    def schema(self) -> Dict[str, Dict]:
+        tree_set = {'_type': 'tree[any]', '_apply': 'set'}
+        return {
+            'inputs': {
+                'molecules': 'tree[any]',
+            },
+            'outputs': {
+                'diffusion': {
+                    'lag_times': {'_type': 'numpy_array', '_apply': 'set'},
+                    'msd': tree_set,
+                    'diffusion_coefficients': tree_set,
+                    'model_difc': tree_set,
+                },
+            },
+        }
+
+    def update(self, state: Dict) -> Dict:
+        if state['molecules']:
+            frame = last_by_serial(molecule_arrays(state['molecules']))
+            self.accumulator.add_frame(frame['serial'], frame['coordinates'], frame['species_id'])
+
+        msd = self.accumulator.msd()
+        coefficients = fit_diffusion_coefficients(msd, self.lag_times, self.dim)
+        species_names = self.accumulator.species_names
+
+        return {
+            'diffusion': {
+                'lag_times': self.lag_times,
+                'msd': {name: msd[index] for index, name in enumerate(species_names)},
+                'diffusion_coefficients': {
+                    name: float(coefficients[index]) for index, name in enumerate(species_names)},
+                'model_difc': dict(self.model_difc),
+            }
+        }
+
+
+process_registry.register('msd_tracker', MSDTracker)
+
+
+def test_msd_accumulator():
+    rng = np.random.default_rng(0)
+    n_molecules, n_frames, difc, dt = 2000, 30, 0.5, 0.1
+    coordinates = rng.uniform(0, 10, size=(n_molecules, 3))
+    serial = rng.permutation(n_molecules * 3)[:n_molecules]
+    species = np.where(np.arange(n_molecules) % 2, 'a', 'b')
+
+    # wrap into a periodic box to exercise the unwrapping
+    extent = np.full(3, 10.0)
+    accumulator = MSDAccumulator(max_lag=5, extent=extent)
+    for _ in range(n_frames):
+        shuffle = rng.permutation(n_molecules)
+        accumulator.add_frame(serial[shuffle], np.mod(coordinates[shuffle], 10.0), species[shuffle])
+        coordinates = coordinates + rng.normal(scale=np.sqrt(2 * difc * dt), size=coordinates.shape)
+
+    lag_times = dt * np.arange(1, 6)
+    estimate = fit_diffusion_coefficients(accumulator.msd(), lag_times, dim=3)
+    assert np.allclose(estimate, difc, rtol=0.05)
+
+
+def test_join_by_serial():
+    reference = np.array([2, 5, 9, 11])
+    reference_index, index = join_by_serial(reference, np.array([11, 3, 2, 12]))
+    assert reference_index.tolist() == [3, 0]
+    assert index.tolist() == [0, 2]
+
+
+def test_tracker_on_smoldyn_process():
+    from smoldyn_process.processes.smoldyn_process import SmoldynProcess
+    # the molecules of the crowding model move on the surface of its ball
+    model_filepath = 'smoldyn_process/models/model_files/crowding_model.txt'
+    process = SmoldynProcess({'model_filepath': model_filepath, 'preserve_molecules': True})
+    tracker = MSDTracker({'max_lag': 3, 'frame_interval': 0.02, 'dim': 2, 'model_filepath': model_filepath})
+    schema = types.access(process.schema())
+    state = process.initial_state()
+    serials = []
+    for _ in range(6):
+        state = types.apply_update(schema, state, process.update(state, 0.02))
+        serials.append(set(molecule_arrays(state['molecules'])['serial'].tolist()))
+        diffusion = tracker.update({'molecules': state['molecules']})['diffusion']
+    # after the first update the molecules are the ones of the update before
+    assert len(serials[-1] & serials[-2]) > 0.9 * len(serials[-1])
+    estimate = diffusion['diffusion_coefficients']
+    assert np.isclose(estimate['red'], diffusion['model_difc']['red'], rtol=0.2)
+    assert np.isfinite(estimate['green'])
+
+    # the frames of iter_frames follow one trajectory as well
+    process = SmoldynProcess({'model_filepath': model_filepath})
+    tracker = MSDTracker({'max_lag': 3, 'frame_interval': 0.02, 'dim': 2, 'model_filepath': model_filepath})
+    for frame in process.iter_frames(0.12, 0.02):
+        diffusion = tracker.update({'molecules': frame['molecules']})['diffusion']
+    assert np.isclose(diffusion['diffusion_coefficients']['red'], diffusion['model_difc']['red'], rtol=0.2)
@@ -0,0 +1,211 @@
+"""
+Polymer Analysis Step
+
+Chain conformation metrics for polymer models such as `../models/model_files/polymer-mid_model.txt`.
+Molecules are grouped into chains either by species (every molecule of a species belongs to one chain)
+or by serial ordering (consecutive blocks of `chain_length` serial numbers), ordered along each chain
+by serial number, and unwrapped across periodic boundaries bond by bond.
+
+Radius of gyration and end-to-end distance are computed for all chains at once with segment reductions,
+and contact maps are computed batched over all chains of the same length. Only these summary arrays are
+emitted.
+"""
+
+
+from typing import *
+import numpy as np
+from process_bigraph import Step, process_registry
+from smoldyn_process.library.model_file import get_boundaries
+from smoldyn_process.library.molecules import molecule_arrays, last_by_serial, select_species
+
+
+def group_chains(
+        species_ids: np.ndarray,
+        serial: np.ndarray,
+        grouping: str = 'species',
+        chain_length: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """Order molecules along chains.
+
+        Args:
+            species_ids:`np.ndarray`: species of each molecule.
+            serial:`np.ndarray`: serial number of each molecule, which orders the monomers of a chain.
+            grouping:`str`: `'species'` or `'serial'`.
+            chain_length:`int`: number of monomers per chain when grouping by serial. Trailing molecules that do not
+                fill a whole chain are dropped.
+
+        Returns:
+            `Tuple[np.ndarray, np.ndarray]`: `order`, the molecule indices sorted chain by chain, and `starts`, the
+                offset of each chain into `order`.
+    """
+    if grouping == 'species':
+        _, chain_ids = np.unique(species_ids, return_inverse=True)
+        order = np.lexsort((serial, chain_ids))
+        sorted_chains = chain_ids[order]
+        starts = np.flatnonzero(np.r_[True, sorted_chains[1:] != sorted_chains[:-1]]) if len(order) else order
+    elif grouping == 'serial':
+        if chain_length < 1:
+            raise ValueError('grouping chains by serial requires a positive `chain_length`.')
+        n_chains = len(serial) // chain_length
+        order = np.argsort(serial, kind='stable')[:n_chains * chain_length]
+        starts = np.arange(n_chains) * chain_length
+    else:
+        raise ValueError(f'unknown chain grouping: {grouping}')
+    return order, starts
+
+
+def unwrap_chains(coordinates: np.ndarray, starts: np.ndarray, extent: Optional[np.ndarray] = None) -> np.ndarray:
+    """Make chains contiguous across periodic boundaries by applying the minimum image to every bond."""
+    if extent is None or len(coordinates) < 2:
+        return coordinates
+    bonds = np.diff(coordinates, axis=0)
+    bonds -= extent * np.round(bonds / extent)
+    # bonds that cross from one chain to the next restart at the next chain's first monomer
+    first = np.zeros(len(coordinates), dtype=bool)
+    first[starts] = True
+    steps = np.vstack([coordinates[:1], bonds])
+    steps[first] = coordinates[first]
+    unwrapped = np.cumsum(steps, axis=0)
+    # remove the running offset carried over from the previous chains
+    chain_index = np.cumsum(first) - 1
+    offset = unwrapped[starts] - coordinates[starts]
+    return unwrapped - offset[chain_index]
+
+
+def chain_metrics(coordinates: np.ndarray, starts: np.ndarray) -> Dict[str, np.ndarray]:
+    """Radius of gyration and end-to-end distance of each chain of chain-ordered `coordinates`."""
+    lengths = np.diff(np.r_[starts, len(coordinates)])
+    sums = np.add.reduceat(coordinates, starts, axis=0)
+    squares = np.add.reduceat(np.einsum('ij,ij->i', coordinates, coordinates), starts)
+    centers = sums / lengths[:, None]
+    radius_of_gyration = np.sqrt(np.maximum(squares / lengths - np.einsum('ij,ij->i', centers, centers), 0.0))
+    ends = starts + lengths - 1
+    end_to_end = np.linalg.norm(coordinates[ends] - coordinates[starts], axis=1)
+    return {
+        'chain_lengths': lengths,
+        'radius_of_gyration': radius_of_gyration,
+        'end_to_end': end_to_end,
+    }
+
+
+def contact_maps(
+        coordinates: np.ndarray,
+        starts: np.ndarray,
+        cutoff: float,
+        max_length: int) -> Dict[int, np.ndarray]:
+    """Mean contact map for each chain length up to `max_length`, batched over all chains of that length.
+
+        Returns:
+            `Dict[int, np.ndarray]`: chain length to the fraction of chains in which monomers `i` and `j` are closer
+                than `cutoff`.
+    """
+    lengths = np.diff(np.r_[starts, len(coordinates)])
+    maps = {}
+    for length in np.unique(lengths):
+        if length > max_length:
+            continue
+        chain_starts = starts[lengths == length]
+        chains = coordinates[chain_starts[:, None] + np.arange(length)]
+        delta = chains[:, :, None, :] - chains[:, None, :, :]
+        contacts = np.einsum('cijk,cijk->cij', delta, delta) < cutoff * cutoff
+        maps[int(length)] = contacts.mean(axis=0)
+    return maps
+
+
+class PolymerAnalysis(Step):
+    """Per-frame radius of gyration, end-to-end distance and contact maps for polymer chains.
+
+        Attributes:
+            grouping:`str`: `'species'` (default) or `'serial'`.
+            chain_length:`int`: monomers per chain when grouping by serial.
+            contact_cutoff:`float`: distance below which two monomers are in contact. Defaults to 1.
+            max_contact_length:`int`: longest chain for which a contact map is computed. Defaults to 64.
+            species:`List[str]`: species to include. Defaults to every species.
+            model_filepath:`str`: optional Smoldyn model, used to unwrap chains across periodic boundaries.
+    """
+
+    config_schema = {
+        'grouping': 'string',
+        'chain_length': 'int',
+        'contact_cutoff': 'float',
+        'max_contact_length': 'int',
+        'species': 'list[string]',
+        'model_filepath': 'string',
+    }
+
+    def __init__(self, config: Dict[str, Any] = None):
+        super().__init__(config)
+        self.grouping = self.config.get('grouping') or 'species'
+        self.chain_length = self.config.get('chain_length') or 0
+        self.contact_cutoff = self.config.get('contact_cutoff') or 1.0
+        self.max_contact_length = self.config.get('max_contact_length') or 64
+        self.species_names: List[str] = self.config.get('species') or []
+
+        self.extent = None
+        if self.config.get('model_filepath'):
+            boundaries = get_boundaries(self.config['model_filepath'])
+            if all(boundaries['periodic']):
+                self.extent = np.subtract(boundaries['high'], boundaries['low'])
+
+    def schema(self) -> Dict[str, Dict]:
+        array_set = {'_type': 'numpy_array', '_apply': 'set'}
+        return {
+            'inputs': {
+                'molecules': 'tree[any]',
+            },
+            'outputs': {
+                'polymers': {
+                    'chain_lengths': array_set,
+                    'radius_of_gyration': array_set,
+                    'end_to_end': array_set,
+                    'contact_maps': {'_type': 'tree[any]', '_apply': 'set'},
+                },
+            },
+        }
+
+    def update(self, state: Dict) -> Dict:
+        frame = molecule_arrays(state['molecules'])
+        if 'serial' in frame:
+            frame = last_by_serial(frame)
+        else:
+            frame['serial'] = np.arange(len(frame['coordinates']))
+        frame = select_species(frame, self.species_names)
+
+        order, starts = group_chains(frame['species_id'], frame['serial'], self.grouping, self.chain_length)
+        coordinates = unwrap_chains(frame['coordinates'][order], starts, self.extent)
+        if len(starts) == 0:
+            metrics = {key: np.empty(0) for key in ('chain_lengths', 'radius_of_gyration', 'end_to_end')}
+            maps = {}
+        else:
+            metrics = chain_metrics(coordinates, starts)
+            maps = contact_maps(coordinates, starts, self.contact_cutoff, self.max_contact_length)
+
+        return {
+            'polymers': {
+                **metrics,
+                'contact_maps': {str(length): contact_map for length, contact_map in maps.items()},
+            }
+        }
+
+
+process_registry.register('polymer_analysis', PolymerAnalysis)
+
+
+def test_chain_metrics():
+    # a straight chain of 5 monomers one unit apart, wrapped into a periodic box of width 3
+    straight = np.column_stack([np.arange(5.0), np.zeros(5), np.zeros(5)])
+    # a second chain folded back on itself
+    folded = np.array([[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0], [0, 0, 0.5]], dtype=float) + 0.25
+    coordinates = np.mod(np.vstack([straight, folded]), 3.0)
+    serial = np.r_[np.arange(5), np.arange(5, 10)][::-1].copy()
+
+    order, starts = group_chains(np.array(['a'] * 10), serial, 'serial', chain_length=5)
+    unwrapped = unwrap_chains(coordinates[order], starts, np.full(3, 3.0))
+    metrics = chain_metrics(unwrapped, starts)
+
+    # serials are reversed, so the folded chain comes first
+    assert np.allclose(metrics['end_to_end'], [0.5, 4.0])
+    assert np.isclose(metrics['radius_of_gyration'][1], np.sqrt(2.0))
+
+    maps = contact_maps(unwrapped, starts, cutoff=1.1, max_length=5)
+    assert maps[5].shape == (5, 5)
+    assert maps[5][0, 4] == 0.5 and maps[5][1, 2] == 1.0
@@ -47,14 +47,25 @@
 
 
 """
+import asyncio
 import os
+import tempfile
 from typing import *
 from uuid import uuid4
 import numpy as np
 import smoldyn as sm
-from smoldyn._smoldyn import MolecState
+from smoldyn._smoldyn import MolecState, PanelShape
 from process_bigraph import Process, Composite, process_registry, types
 from smoldyn_process.sed2 import pf
+from smoldyn_process.library.cache import ResultCache, cache_key, default_cache_dir, is_seeded
+from smoldyn_process.library.geometry import PANEL_SHAPES, Region, SurfaceVolume, get_region
+from smoldyn_process.library.model_file import get_compartments, get_surfaces, query_statements, read_model_statements, \
+    resolve_model_text
+from smoldyn_process.library.molecules import MoleculeTable, SpeciesTable, molecule_arrays
+
+
+# the states of surface-bound molecules, keyed by their value in the `listmols2` state column
+SURFACE_STATES = {int(state): state for state in (MolecState.front, MolecState.back, MolecState.up, MolecState.down)}
 
 
 class SmoldynProcess(Process):
@@ -94,6 +105,43 @@ class SmoldynProcess(Process):
     Attributes:
         model_filepath:`str`: filepath to the smoldyn model you want to reference in this Process
         animate:`bool`: Displays graphical simulation output from smoldyn if set to `True`. Defaults to `False`.
+        preserve_molecules:`bool`: re-create the incoming `molecules` exactly (species and coordinates) at each
+            `update` with `set_molecules`, instead of redistributing the species counts uniformly. When the incoming
+            table is the one this process emitted last, its molecules are still in the simulation and are kept as
+            they are, serial numbers included. Defaults to `False`.
+        compartments:`Dict[str, str]`: species name to the compartment (or closed surface) of the model that its
+            molecules are redistributed in by `set_compartment`. Smoldyn places the molecules of a compartment
+            itself; the inside of a surface that no compartment is declared for is sampled in Python. Other species
+            are redistributed over the whole bounding box by `set_uniform`.
+        output_species:`List[str]`: species whose molecules are emitted in `molecules`. Defaults to every species.
+        region_of_interest:`Dict[str, List[float]]`: `{'low': [...], 'high': [...]}` corners of an axis-aligned box;
+            only molecules inside it are emitted. Defaults to the whole simulation volume.
+        counts_every:`int`: simulation iterations between the rows of `species_count_series`. Defaults to 1.
+        molecules_every:`int`: updates between emitted `molecules` snapshots. Molecules are only listed by Smoldyn at
+            the end of the updates that emit them. Defaults to 1.
+        species_every:`Dict[str, int]`: per-species override of `molecules_every`.
+        chunk_steps:`int`: run each interval as a series of Smoldyn runs of at most this many time steps (rounded up
+            to a multiple of `counts_every`). The count rows of each run are folded into running statistics and
+            dropped: `species_count_statistics` holds the number of rows and the `mean`, `std`, `min` and `max` count
+            over the interval, in the order of `species_names`, and `species_count_series` only holds the last row.
+            Molecules are only listed at the end of the last run, so memory stays bounded however long the interval
+            is. Defaults to 0, a single run per interval.
+        triggers:`List[Dict]`: rules that take a `molecules` snapshot (of every output species) when they fire, e.g.
+            `{'species': 'red', 'above': 100}` or `{'species': 'red', 'below': 10}` when the count crosses the threshold,
+            or `{'species': 'red', 'change': 0.2}` when it has changed by more than 20% since the last snapshot.
+            Triggers are checked on the species counts at the start of each update, before Smoldyn lists anything,
+            so a snapshot is taken at the end of the interval after the counts crossed over. With triggers, the
+            fixed `molecules_every` schedule is off unless it is given as well.
+        defines:`Dict[str, str]`: overrides of the model's `define` values, as with `smoldyn -define`.
+        seed:`int`: random seed replacing the model's `random_seed`. Defaults to the model's own seed.
+        cache_dir:`str`: directory of a `ResultCache` for the output of each interval. Defaults to the
+            `SMOLDYN_PROCESS_CACHE` environment variable, or no cache. Only seeded models are cached. A process that
+            finds its intervals in the cache does not run them. Smoldyn's random state cannot be restored from the
+            cache, so the skipped intervals are replayed in Smoldyn at the first interval that is not cached: only
+            the cached intervals after the last miss (all of them, for a run that is entirely cached) save
+            simulation time.
+        cache_replay_limit:`int`: most cached intervals held for a replay. Reaching it replays them right away,
+            which bounds the inputs kept for the replay. Defaults to 1024.
 
 
     """
@@ -102,6 +150,22 @@ class SmoldynProcess(Process):
     config_schema = {
         'model_filepath': 'string',
         'animate': 'bool',
+        'preserve_molecules': 'boolean',
+        'compartments': 'tree[string]',
+        'output_species': 'list[string]',
+        'region_of_interest': {
+            'low': 'list[float]',
+            'high': 'list[float]',
+        },
+        'counts_every': 'int',
+        'molecules_every': 'int',
+        'species_every': 'tree[int]',
+        'chunk_steps': 'int',
+        'triggers': 'list[tree[any]]',
+        'defines': 'tree[string]',
+        'seed': 'maybe[int]',
+        'cache_dir': 'string',
+        'cache_replay_limit': 'int',
     }
 
     def __init__(self, config: Dict[str, Any] = None):
@@ -129,28 +193,83 @@ class SmoldynProcess(Process):
                 '''
             )
 
+        # load a copy of the model with the define overrides and seed applied, which the model readers also use
+        self.model_directory: Optional[tempfile.TemporaryDirectory] = None
+        if self.config.get('defines') or self.config.get('seed') is not None:
+            self.model_directory = tempfile.TemporaryDirectory(prefix='smoldyn-model-')
+            resolved_filepath = os.path.join(self.model_directory.name, os.path.basename(self.model_filepath))
+            with open(resolved_filepath, 'w') as file:
+                file.write(resolve_model_text(self.model_filepath, self.config.get('defines'), self.config.get('seed')))
+            self.model_filepath = resolved_filepath
+
         # initialize the simulator from a Smoldyn model.txt file.
         self.simulation: sm.Simulation = sm.Simulation.fromFile(self.model_filepath)
 
         # get a list of the simulation species
         species_count = self.simulation.count()['species']
+        # the species codes used internally are Smoldyn's own species indices (index 0 is the `empty` species)
+        self.species_table = SpeciesTable([self.simulation.getSpeciesName(index) for index in range(species_count)])
         self.species_names: List[str] = []
-        for index in range(species_count):
-            species_name = self.simulation.getSpeciesName(index)
+        for species_name in self.species_table.names:
             if 'empty' not in species_name.lower():
                 self.species_names.append(species_name)
-        # sort for logistical mapping to species names (i.e: ['a', 'b', c'] == ['0', '1', '2']
+        # the columns of `molcount` follow Smoldyn's species indices
+        self.count_columns: List[str] = list(self.species_names)
+        # the species ports are listed alphabetically; every lookup by index goes through `self.species_table`
         self.species_names.sort()
 
         # make species counts of molecules dataset for output
         self.simulation.addOutputData('species_counts')
-        # write molcounts to counts dataset at every timestep (shape=(n_timesteps, 1+n_species <-- one for time)): [timestep, countSpec1, countSpec2, ...]
-        self.simulation.addCommand(cmd='molcount species_counts', cmd_type='E')
+        # write molcounts to counts dataset every `counts_every` iterations (shape=(n_rows, 1+n_species <-- one for time)): [timestep, countSpec1, countSpec2, ...]
+        self.counts_every: int = self.config.get('counts_every') or 1
+        self.simulation.addCommand(cmd='molcount species_counts', cmd_type='N', step=self.counts_every)
 
         # make molecules dataset (molecule information) for output
         self.simulation.addOutputData('molecules')
-        # write coords to dataset at every timestep (shape=(n_output_molecules, 7)): seven being [timestep, smol_id(species), mol_state, x, y, z, mol_serial_num]
-        self.simulation.addCommand(cmd='listmols2 molecules', cmd_type='E')
+        # write coords to dataset at the end of each run (shape=(n_output_molecules, 7)): seven being [timestep, smol_id(species), mol_state, x, y, z, mol_serial_num]
+        # the listing only happens when Smoldyn's global flag is set, which `update` does when a snapshot is due.
+        # listmols3 writes the same columns for a single species, so only the requested species are listed
+        self.output_species: List[str] = self.config.get('output_species') or []
+        if self.output_species:
+            for species_name in self.output_species:
+                self.simulation.addCommand(cmd=f'ifflag = 1 listmols3 {species_name}(all) molecules', cmd_type='A')
+        else:
+            self.simulation.addCommand(cmd='ifflag = 1 listmols2 molecules', cmd_type='A')
+
+        # snapshots triggered by the counts replace the fixed schedule (a cadence of 0 never lists molecules)
+        self.triggers: List[Dict[str, Any]] = list(self.config.get('triggers') or [])
+        for trigger in self.triggers:
+            rules = [rule for rule in TRIGGER_RULES if rule in trigger]
+            if trigger.get('species') not in self.species_names or len(rules) != 1:
+                raise ValueError(f'a trigger needs one of the species {self.species_names} and exactly one of '
+                                 f'{list(TRIGGER_RULES)}, got {trigger}')
+        self.trigger_counts: Optional[Dict[str, int]] = None
+        self.snapshot_counts: Optional[Dict[str, int]] = None
+
+        # long intervals are run in chunks whose count rows are reduced as they come in
+        chunk_steps = self.config.get('chunk_steps') or 0
+        self.chunk_steps: int = -(-chunk_steps // self.counts_every) * self.counts_every
+        # the columns of `molcount` in the order of the counts port
+        self.count_order = np.array([self.count_columns.index(name) for name in self.species_names], dtype=int)
+
+        self.molecules_every: int = self.config.get('molecules_every') or (0 if self.triggers else 1)
+        self.species_every: Dict[str, int] = dict(self.config.get('species_every') or {})
+        self.update_count = 0
+        # the molecules table of the last update, whose molecules `preserve_molecules` keeps in the simulation
+        self.emitted_molecules: Optional[MoleculeTable] = None
+        if self.config['preserve_molecules'] and (self.molecules_every != 1 or self.species_every):
+            raise ValueError('`preserve_molecules` needs a molecules snapshot at every update.')
+
+        # molecules outside the region of interest are dropped before the output tree is built
+        region_of_interest = self.config.get('region_of_interest') or {}
+        self.region_of_interest: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        if region_of_interest.get('low') and region_of_interest.get('high'):
+            self.region_of_interest = (
+                np.asarray(region_of_interest['low'], dtype=float),
+                np.asarray(region_of_interest['high'], dtype=float))
+            if self.config['preserve_molecules']:
+                raise ValueError('`preserve_molecules` re-creates the emitted molecules, so it cannot be combined '
+                                 'with a `region_of_interest`.')
 
         # initialize the molecule ids based on the species names. We need this value to properly emit the schema, which expects a single value from this to be a str(int)
         # the format for molecule_ids is expected to be: 'speciesId_moleculeNumber'
@@ -160,6 +279,47 @@ class SmoldynProcess(Process):
         # TODO: add a verification method to ensure that the boundaries do not change on the next step...
         self.boundaries: Dict[str, List[float]] = dict(zip(['low', 'high'], self.simulation.getBoundaries()))
 
+        # Smoldyn places molecules in the compartments it defines; the geometry is only precomputed for the surfaces
+        # that have no compartment, whose insides are sampled in Python
+        model_compartments = get_compartments(self.model_filepath)
+        self.compartments: Dict[str, str] = {}
+        self.regions: Dict[str, Region] = {}
+        for species_name, compartment in (self.config.get('compartments') or {}).items():
+            if compartment in model_compartments:
+                self.compartments[species_name] = compartment
+            else:
+                self.regions[species_name] = get_region(self.model_filepath, compartment)
+        statements = read_model_statements(self.model_filepath)
+        seeds = query_statements(statements, 'random_seed')
+        self.rng = np.random.default_rng(int(seeds[-1][1]) if seeds else None)
+
+        # the surfaces and panels that surface-bound states are placed on, from the model's `surface_mol` statements
+        dim = len(self.boundaries['low'])
+        self.surfaces: Dict[str, SurfaceVolume] = {
+            name: SurfaceVolume(panels, dim) for name, panels in get_surfaces(self.model_filepath).items()
+        }
+        self.surface_placements: Dict[str, Dict[MolecState, Tuple[str, PanelShape, str]]] = {}
+        for statement in query_statements(statements, 'surface_mol'):
+            species_name, _, state_name = statement[2].rstrip(')').partition('(')
+            shape = PanelShape.__members__[PANEL_SHAPES.get(statement[4], statement[4])]
+            self.surface_placements.setdefault(species_name, {})[MolecState.__members__[state_name]] = \
+                (statement[3], shape, statement[5])
+
+        # the output of each interval is cached under a key chained from the model, the config and every earlier
+        # interval and input state, since the simulation carries its random state from one interval to the next
+        self.cache: Optional[ResultCache] = None
+        self.cache_key: Optional[str] = None
+        self.skipped_intervals: List[Tuple[Dict, float]] = []
+        self.cache_replay_limit: int = self.config.get('cache_replay_limit') or 1024
+        cache_dir = default_cache_dir(self.config.get('cache_dir'))
+        model_text = resolve_model_text(self.model_filepath)
+        if cache_dir and is_seeded(model_text):
+            self.cache = ResultCache(cache_dir)
+            keyed_config = {
+                key: value for key, value in self.config.items()
+                if key not in ('model_filepath', 'animate', 'cache_dir', 'cache_replay_limit')}
+            self.cache_key = cache_key('smoldyn_process', model_text, keyed_config)
+
         # set graphics (defaults to False)
         if self.config['animate']:
             self.simulation.addGraphics('opengl_better')
@@ -183,20 +343,154 @@ class SmoldynProcess(Process):
                 kill_mol:`bool`: kills the molecule based on the `name` argument, which effectively
                     removes the molecule from simulation memory.
         """
-        # kill the mol, effectively resetting it
+        state_counts = self.state_counts(species_name, configuration_parameters['count'])
+
+        # kill the mol in every state, effectively resetting it
         if kill_mol:
-            self.simulation.runCommand(f'killmol {species_name}')
+            self.simulation.runCommand(f'killmol {species_name}(all)')
 
         # TODO: eventually allow for an expanding boundary ie in the configuration parameters (pymunk?), which is defies the methodology of smoldyn
 
-        # redistribute the molecule according to the bounds
+        # surface-bound molecules go back onto their surfaces, the rest is redistributed according to the bounds
+        self.set_surface_states(species_name, state_counts)
         self.simulation.addSolutionMolecules(
             species=species_name,
-            number=configuration_parameters['count'],
+            number=state_counts[MolecState.soln],
             highpos=self.boundaries['high'],
             lowpos=self.boundaries['low']
         )
 
+    def set_compartment(
+            self,
+            species_name: str,
+            kill_mol: bool = True,
+            **configuration_parameters: Dict[str, Union[List[float], int]]
+            ) -> None:
+        """Redistribute a species uniformly inside its compartment (see the `compartments` config). A compartment
+            of the model is filled by Smoldyn in a single `addCompartmentMolecules` call. The inside of a bare
+            surface is sampled in batches against its precomputed geometry and added with `add_molecules`.
+
+            Args:
+                species_name:`str`: name of the given molecule.
+                **configuration_parameters:`Dict`: kwargs are as such: 'count'
+                kill_mol:`bool`: kills the molecule based on the `name` argument before redistributing it.
+        """
+        state_counts = self.state_counts(species_name, configuration_parameters['count'])
+        if kill_mol:
+            self.simulation.runCommand(f'killmol {species_name}(all)')
+
+        self.set_surface_states(species_name, state_counts)
+        if species_name in self.compartments:
+            if state_counts[MolecState.soln]:
+                self.simulation.addCompartmentMolecules(
+                    species_name, state_counts[MolecState.soln], self.compartments[species_name])
+        else:
+            coordinates = self.regions[species_name].sample(state_counts[MolecState.soln], self.rng)
+            self.add_molecules([species_name] * len(coordinates), coordinates)
+
+    def state_counts(self, species_name: str, count: int) -> Dict[MolecState, int]:
+        """Split `count` molecules of a species over the solution and surface-bound states in proportion to the
+            molecules of that species currently in the simulation. Species with no molecules go to solution.
+        """
+        states = [MolecState.soln] + list(SURFACE_STATES.values())
+        current = np.array([self.simulation.getMoleculeCount(species_name, state) for state in states], dtype=float)
+        if current.sum() == 0:
+            current[0] = 1.0
+
+        # largest remainder rounding, so the split adds up to `count`
+        shares = count * current / current.sum()
+        counts = np.floor(shares).astype(int)
+        remainder = count - counts.sum()
+        counts[np.argsort(counts - shares)[:remainder]] += 1
+        return dict(zip(states, counts.tolist()))
+
+    def set_surface_states(self, species_name: str, state_counts: Dict[MolecState, int]) -> None:
+        """Add the surface-bound molecules of `state_counts` at random positions on their surface, using the
+            surface and panels of the species' `surface_mol` statement or else every panel of the first surface.
+        """
+        for state, count in state_counts.items():
+            if state == MolecState.soln or count == 0:
+                continue
+            placement = self.surface_placements.get(species_name, {}).get(state)
+            surface, shape, panel = placement or (next(iter(self.surfaces)), PanelShape.all, 'all')
+            self.simulation.addSurfaceMolecules(species_name, state, count, surface, shape, panel, [])
+
+    def add_molecules(self, species_ids: Sequence[str], coordinates: np.ndarray) -> None:
+        """Add solution molecules at exactly the given positions.
+
+            The Smoldyn API has no array-valued placement, so molecules are grouped by species and each one is
+            added at its own position with a zero-width `addSolutionMolecules` box.
+
+            Args:
+                species_ids:`Sequence[str]`: species name of each molecule.
+                coordinates:`np.ndarray`: positions of each molecule, shape `(n, dim)`.
+        """
+        species_ids = np.asarray(species_ids)
+        coordinates = np.asarray(coordinates, dtype=float)
+        order = np.argsort(species_ids, kind='stable')
+        names, starts = np.unique(species_ids[order], return_index=True)
+        for name, group in zip(names, np.split(order, starts[1:])):
+            for position in coordinates[group].tolist():
+                self.simulation.addSolutionMolecules(str(name), 1, position, position)
+
+    def add_surface_molecules(self, species_ids: Sequence[str], states: Sequence[int], coordinates: np.ndarray) -> None:
+        """Add surface-bound molecules at exactly the given positions, each on the closest curved panel of the
+            model's surfaces.
+
+            Args:
+                species_ids:`Sequence[str]`: species name of each molecule.
+                states:`Sequence[int]`: surface state of each molecule, as in the `listmols2` state column.
+                coordinates:`np.ndarray`: positions of each molecule, shape `(n, dim)`.
+        """
+        coordinates = np.asarray(coordinates, dtype=float)
+        panel_surfaces, panel_shapes, panel_names, distances = [], [], [], []
+        for surface_name, surface in self.surfaces.items():
+            panel_surfaces += [surface_name] * len(surface.panel_names)
+            panel_shapes += [PanelShape.__members__[shape] for shape in surface.panel_shapes]
+            panel_names += surface.panel_names
+            distances.append(surface.panel_distances(coordinates))
+        nearest = np.argmin(np.hstack(distances), axis=1)
+
+        for species_name, state, panel, position in zip(species_ids, states, nearest.tolist(), coordinates.tolist()):
+            self.simulation.addSurfaceMolecules(
+                str(species_name),
+                SURFACE_STATES[int(state)],
+                1,
+                panel_surfaces[panel],
+                panel_shapes[panel],
+                panel_names[panel],
+                position)
+
+    def set_molecules(
+            self,
+            species_ids: Sequence[str],
+            states: Sequence[int],
+            coordinates: np.ndarray
+            ) -> None:
+        """Replace every molecule (of the `output_species`, if given) in the simulation memory with exactly the
+            molecules given as arrays, so that positions are handed off between updates (or from another process)
+            without re-equilibration.
+
+            Surface-bound molecules keep their state and are placed on the closest panel of the model's surfaces.
+
+            Args:
+                species_ids:`Sequence[str]`: species name of each molecule.
+                states:`Sequence[int]`: state (`MolecState` value) of each molecule.
+                coordinates:`np.ndarray`: positions of each molecule, shape `(n, dim)`.
+        """
+        self.emitted_molecules = None
+        # only the emitted species are replaced
+        for species_name in self.output_species or ['all']:
+            self.simulation.runCommand(f'killmol {species_name}(all)')
+
+        species_ids = np.asarray(species_ids)
+        states = np.asarray(states).astype(int)
+        coordinates = np.asarray(coordinates, dtype=float)
+        bound = np.isin(states, list(SURFACE_STATES))
+        self.add_molecules(species_ids[~bound], coordinates[~bound])
+        if bound.any():
+            self.add_surface_molecules(species_ids[bound], states[bound], coordinates[bound])
+
     def initial_state(self) -> Dict[str, Union[int, Dict]]:
         """Set the initial parameter state of the simulation. This method should return an implementation of
             that which is returned by `self.schema()`.
@@ -210,16 +504,48 @@ class SmoldynProcess(Process):
 
             NOTE: This method should provide an implementation of the structure denoted in `self.schema`.
         """
-        # get the initial species counts
-        initial_species_counts = {
-            spec_name: self.simulation.getMoleculeCount(spec_name, MolecState.all)
-            for spec_name in self.species_names
-        }
-
-        return {
-            'species_counts': initial_species_counts,
-            'molecules': {}
+        state = {
+            'species_counts': self.molecule_counts(),
+            'species_count_series': {},
+            'molecules': MoleculeTable.from_rows(np.empty((0, 7)), self.species_table)
         }
+        if self.chunk_steps:
+            state['species_count_statistics'] = {}
+        return state
+
+    def molecule_counts(self) -> np.ndarray:
+        """Return the current count of each species of `species_names`, as the int64 vector of the counts port."""
+        return np.array(
+            [self.simulation.getMoleculeCount(name, MolecState.all) for name in self.species_names], dtype=np.int64)
+
+    def due_species(self) -> List[str]:
+        """Return the species whose molecules are emitted by the current update, according to `molecules_every`
+            and `species_every`.
+        """
+        due_species = []
+        for species_name in self.output_species or self.species_names:
+            every = self.species_every.get(species_name, self.molecules_every)
+            if every and self.update_count % every == 0:
+                due_species.append(species_name)
+        return due_species
+
+    def check_triggers(self) -> Tuple[bool, Dict[str, int]]:
+        """Check the `triggers` on the current species counts of the simulation. Returns whether any fired, and the
+            counts.
+        """
+        counts = dict(zip(self.species_names, self.molecule_counts().tolist()))
+        # before the first snapshot, changes are measured from the first counts checked
+        fired = fired_triggers(self.triggers, counts, self.trigger_counts, self.snapshot_counts or counts)
+        self.trigger_counts = counts
+        self.snapshot_counts = self.snapshot_counts or counts
+        return bool(fired), counts
+
+    def stretch_cadence(self, factor: int) -> None:
+        """Emit `molecules` snapshots `factor` times less often from now on, e.g. once the counts are steady."""
+        if self.config['preserve_molecules'] and factor > 1:
+            raise ValueError('`preserve_molecules` needs a molecules snapshot at every update.')
+        self.molecules_every *= factor
+        self.species_every = {name: every * factor for name, every in self.species_every.items()}
 
     def schema(self) -> Dict[str, Union[Dict[str, str], Dict[str, Dict[str, str]]]]:
         """Return a dictionary of molecule names and the expected input/output schema at simulation
@@ -228,27 +554,32 @@ class SmoldynProcess(Process):
 
             PLEASE NOTE: the key 'counts' refers to the count of molecules for each molecular species. The number of
                 species_types in this regard does not change, even if that number drops to 0.
+
+            The species counts are an int64 vector in the order of `species_names`, which the schema lists once as
+                the `_species` of the port. Updates are deltas, added to the vector in a single operation.
         """
         counts_type = {
-            species_name: 'int'
-            for species_name in self.species_names
+            '_type': 'count_vector',
+            '_species': list(self.species_names),
         }
 
-        molecules_type = {
-            mol_id: {
-                'coordinates': 'list[float]',
-                'species_id': 'string',
-                'state': 'string'
-            } for mol_id in self.molecule_ids
-        }
-
-        # TODO: include velocity and state to this schema (add to constructor as well)
+        # TODO: include velocity to this schema (add to constructor as well)
 
-        # return a generic tree of string for molecules
-        return {
+        # the molecules are a `MoleculeTable` of columns, which each update replaces as a whole
+        schema = {
             'species_counts': counts_type,
-            'molecules': 'tree[string]'  #molecules_type
+            'species_count_series': {
+                '_type': 'tree[any]',
+                '_apply': 'set'
+            },
+            'molecules': 'molecule_table'
         }
+        if self.chunk_steps:
+            schema['species_count_statistics'] = {
+                '_type': 'tree[any]',
+                '_apply': 'set'
+            }
+        return schema
 
     def update(self, state: Dict, interval: int) -> Dict:
         """Callback method to be evoked at each Process interval. We want to get the
@@ -268,60 +599,335 @@ class SmoldynProcess(Process):
             TODO: We must account for the mol_ids that are generated in the output based on the interval run,
                 i.e: Shorter intervals will yield both less output molecules and less unique molecule ids.
         """
-        # reset the molecules, distribute the mols according to self.boundaries
-        for name in self.species_names:
-            self.set_uniform(
-                species_name=name,
-                count=state['species_counts'][name],
-            )
+        simulation_state = self.convert_output(self.interval_output(state, interval))
+        self.emitted_molecules = simulation_state.get('molecules')
 
-        # run the simulation for a given interval
-        self.simulation.run(
-            stop=interval,
-            dt=self.simulation.dt
-        )
+        # the final counts are emitted as a change from the current state
+        simulation_state['species_counts'] = simulation_state['species_counts'] - state['species_counts']
+
+        # TODO -- post processing to get effective rates
+
+        return simulation_state
 
-        # get the counts data, clear the buffer
-        counts_data = self.simulation.getOutputData('species_counts')
+    def interval_output(self, state: Dict, interval: float) -> Dict[str, Any]:
+        """The `run_interval` output of an update from `state`, taken from the cache when it has it."""
+        output = self.recall_interval(state, interval) if self.cache else None
+        if output is None:
+            self.reseed(state)
+            output = self.run_interval(interval)
+            if self.cache:
+                self.store_interval(output)
+        return output
+
+    def reseed(self, state: Dict) -> None:
+        """Set the molecules of the simulation from `state` before an interval is run."""
+        if self.config['preserve_molecules']:
+            # re-create the molecules from another process (or an earlier update) at their positions; those of the
+            # last update are still there
+            if state['molecules'] and not self.kept_molecules(state):
+                frame = molecule_arrays(state['molecules'])
+                self.set_molecules(frame['species_id'], frame['state'], frame['coordinates'])
+        else:
+            # reset the molecules, distribute the mols in their compartment or according to self.boundaries
+            for name, count in zip(self.species_names, np.asarray(state['species_counts']).tolist()):
+                in_compartment = name in self.compartments or name in self.regions
+                set_species = self.set_compartment if in_compartment else self.set_uniform
+                set_species(
+                    species_name=name,
+                    count=count,
+                )
+
+    def kept_molecules(self, state: Dict) -> bool:
+        """Whether the `molecules` of `state` are the table of the last update, which the simulation still holds."""
+        return self.emitted_molecules is not None and state['molecules'] is self.emitted_molecules
+
+    def recall_interval(self, state: Dict, interval: float) -> Optional[Dict[str, Any]]:
+        """Look up the `run_interval` output of this interval in the cache. On a miss, first bring the simulation up
+            to date by replaying the intervals that were found in the cache (see `replay_skipped`).
+        """
+        state_key = cache_key(np.asarray(state['species_counts'], dtype=np.int64))
+        if self.config['preserve_molecules'] and state['molecules']:
+            frame = molecule_arrays(state['molecules'])
+            state_key = [
+                state_key,
+                cache_key(frame['species_id'].astype(str), frame['state'], frame['coordinates']),
+                self.kept_molecules(state)]
+        # the listed molecules depend on the cadence (which `stretch_cadence` changes) and the trigger state
+        schedule = [self.molecules_every, sorted(self.species_every.items()), self.trigger_counts, self.snapshot_counts]
+        self.cache_key = cache_key(self.cache_key, interval, state_key, schedule)
+
+        cached = self.cache.get(self.cache_key)
+        if cached is not None:
+            arrays, document = cached
+            # the triggers move on as if the interval had been run
+            self.trigger_counts, self.snapshot_counts = document['trigger_counts'], document['snapshot_counts']
+            # only the part of the state that `reseed` reads is kept; the counts are updated in place, so as a copy
+            skipped_state = {'species_counts': np.array(state['species_counts'])}
+            if self.config['preserve_molecules']:
+                # kept molecules are left as they are when the interval is replayed
+                skipped_state['molecules'] = {} if self.kept_molecules(state) else state['molecules']
+            self.skipped_intervals.append((skipped_state, interval))
+            self.update_count += 1
+            if len(self.skipped_intervals) >= self.cache_replay_limit:
+                self.replay_skipped()
+            return {
+                'counts_data': arrays['counts_data'],
+                'final_counts': np.array(document['final_counts'], dtype=np.int64),
+                'due_species': document['due_species'],
+                'molecules_data': arrays.get('molecules_data'),
+                'count_statistics': {
+                    name[len('statistics_'):]: array for name, array in arrays.items() if name.startswith('statistics_')
+                } or None,
+            }
 
-        # get the final counts for the update
-        final_count = counts_data[-1]
-        # remove the timestep from the list
-        final_count.pop(0)
+        self.replay_skipped()
+        return None
+
+    def replay_skipped(self) -> None:
+        """Run the intervals that were taken from the cache, so that the simulation is where it would be without it."""
+        # `run_interval` counts the replayed updates again
+        self.update_count -= len(self.skipped_intervals)
+        for skipped_state, skipped_interval in self.skipped_intervals:
+            self.reseed(skipped_state)
+            self.run_interval(skipped_interval)
+        self.skipped_intervals = []
+
+    def store_interval(self, output: Dict[str, Any]) -> None:
+        arrays = {'counts_data': output['counts_data']}
+        if output['molecules_data'] is not None:
+            arrays['molecules_data'] = output['molecules_data']
+        for name, array in (output['count_statistics'] or {}).items():
+            arrays[f'statistics_{name}'] = array
+        document = {
+            'final_counts': output['final_counts'].tolist(),
+            'due_species': output['due_species'],
+            'trigger_counts': self.trigger_counts,
+            'snapshot_counts': self.snapshot_counts,
+        }
+        self.cache.put(self.cache_key, arrays, document)
 
-        # get the data based on the commands added in the constructor, clear the buffer
-        molecules_data = self.simulation.getOutputData('molecules')
+    def iter_frames(self, stop: float, every: float) -> Iterator[Dict[str, Any]]:
+        """Run the simulation on from its current state until `stop`, yielding a frame every `every` time units.
 
+            Unlike `update`, the molecules are not reseeded between frames, so the frames follow one trajectory, and
+            only the current frame is held. Molecules are listed according to the cadence and triggers of the config.
+
+            Yields:
+                `Dict[str, Any]`: the `time` at the end of the frame, the `species_counts` vector, the
+                    `species_count_series` of the frame (timed from the start of the trajectory), the
+                    `species_count_statistics` with `chunk_steps`, and the `molecules` table when they were listed.
+        """
+        frames = int(np.ceil(stop / every - 1e-9))
+        for index in range(frames):
+            start, end = index * every, min((index + 1) * every, stop)
+            frame = self.convert_output(self.run_frame(end - start))
+            frame['species_count_series']['time'] = frame['species_count_series']['time'] + start
+            yield {'time': end, **frame}
+
+    def run_frame(self, interval: float) -> Dict[str, Any]:
+        """Run the simulation on for `interval` without reseeding it, after replaying the intervals that were
+            taken from the cache. The frame becomes part of the cache key, so the updates after it are keyed on it.
+        """
+        self.replay_skipped()
+        self.emitted_molecules = None
+        if self.cache:
+            self.cache_key = cache_key(self.cache_key, 'frame', interval)
+        return self.run_interval(interval)
+
+    async def aiter_frames(self, stop: float, every: float) -> AsyncIterator[Dict[str, Any]]:
+        """`iter_frames` as an async generator, which gives the other tasks of the event loop a turn after each frame.
+            Smoldyn holds the GIL while it runs, so simulations that should run at the same time need an
+            `AsyncSmoldynProcess` each.
+        """
+        for frame in self.iter_frames(stop, every):
+            yield frame
+            await asyncio.sleep(0)
+
+    def run_interval(self, interval: float) -> Dict[str, Any]:
+        """Run the simulation for `interval` and collect its raw output buffers.
+
+            Returns:
+                `Dict[str, Any]`: `counts_data` (the `molcount` rows, only the last one with `chunk_steps`),
+                    `count_statistics` (with `chunk_steps`, else `None`), `final_counts` (the count vector at the end of
+                    the interval), `due_species` and `molecules_data` (the listed molecule rows, `None` if no
+                    snapshot was due).
+        """
+        # only list the molecules at the end of this run if a snapshot of any species is due or triggered
+        due_species = self.due_species()
+        if self.triggers:
+            fired, counts = self.check_triggers()
+            if fired:
+                due_species = list(self.output_species or self.species_names)
+        listed = bool(due_species) and sum(
+            self.simulation.getMoleculeCount(name, MolecState.all) for name in due_species) > 0
+        if listed and self.triggers:
+            self.snapshot_counts = counts
+
+        count_statistics = None
+        if self.chunk_steps:
+            counts_data, count_statistics = self.run_chunks(interval, listed)
+        else:
+            self.simulation.runCommand(f'setflag {int(listed)}')
+            # run the simulation for a given interval
+            self.simulation.run(
+                stop=interval,
+                dt=self.simulation.dt
+            )
+            # get the counts data, clear the buffer
+            counts_data = np.array(self.simulation.getOutputData('species_counts'), dtype=float)
+        self.update_count += 1
+
+        output = {
+            'counts_data': counts_data,
+            'count_statistics': count_statistics,
+            'final_counts': self.molecule_counts(),
+            'due_species': due_species,
+            'molecules_data': None,
+        }
+        if listed:
+            # get the data based on the commands added in the constructor (the final frame of the run), clear the buffer
+            output['molecules_data'] = np.array(self.simulation.getOutputData('molecules'), dtype=float)
+        elif due_species:
+            # NOTE: reading an empty output dataset crashes Smoldyn, so there is nothing to read
+            output['molecules_data'] = np.empty((0, 7))
+        return output
+
+    def run_chunks(self, interval: float, listed: bool) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """Run `interval` as a series of runs of at most `chunk_steps` time steps, draining the count rows of each
+            run into running statistics.
+
+            Returns:
+                `Tuple[np.ndarray, Dict[str, np.ndarray]]`: the last `molcount` row, and the `rows`, `mean`, `std`,
+                    `min` and `max` of the counts over the interval, in the order of `species_names`.
+        """
+        dt = self.simulation.dt
+        total_steps = max(1, int(round(interval / dt)))
+        statistics = CountStatistics(len(self.count_columns))
+        last_row = None
+        for first_step in range(0, total_steps, self.chunk_steps):
+            steps = min(self.chunk_steps, total_steps - first_step)
+            # the molecules are only listed at the end of the last chunk
+            self.simulation.runCommand(f'setflag {int(listed and first_step + steps == total_steps)}')
+            self.simulation.run(stop=steps * dt, dt=dt)
+
+            rows = np.array(self.simulation.getOutputData('species_counts'), dtype=float).reshape(
+                -1, len(self.count_columns) + 1)
+            # every run restarts the clock at 0 and repeats the last row of the previous run
+            rows[:, 0] += first_step * dt
+            if first_step:
+                rows = rows[1:]
+            if len(rows):
+                statistics.add(rows[:, 1:])
+                last_row = rows[-1]
+        return last_row.reshape(1, -1), statistics.result(self.count_order)
+
+    def convert_output(self, output: Dict[str, Any]) -> Dict:
+        """Convert the raw output buffers of `run_interval` into an update, with absolute final `species_counts`.
+            This does not call into Smoldyn, so it only depends on the buffers and on the config.
+        """
         # create an empty simulation state mirroring that which is specified in the schema
         simulation_state = {
-            'species_counts': {},
-            'molecules': {}
+            'species_counts': output['final_counts'],
+            'species_count_series': count_series(output['counts_data'], self.count_columns),
         }
+        if output['count_statistics'] is not None:
+            simulation_state['species_count_statistics'] = output['count_statistics']
+        if output['molecules_data'] is None:
+            return simulation_state
 
-        # get and populate the species counts
-        for index, name in enumerate(self.species_names):
-            simulation_state['species_counts'][name] = int(final_count[index]) - state['species_counts'][name]
-
-        # clear the list of known molecule ids and update the list of known molecule ids (convert to an intstring)
-        self.molecule_ids.clear()
-        for molecule in molecules_data:
-            self.molecule_ids.append(str(uuid4()))
-
-        # get and populate the output molecules
-        mols = []
-        for index, mol_id in enumerate(self.molecule_ids):
-            single_molecule_data = molecules_data[index]
-            single_molecule_species_index = int(single_molecule_data[1]) - 1
-            mols.append(single_molecule_species_index)
-            simulation_state['molecules'][mol_id] = {
-                'coordinates': single_molecule_data[3:6],
-                'species_id': self.species_names[single_molecule_species_index],
-                'state': str(int(single_molecule_data[2]))
-            }
+        # the listed rows are wrapped as columns, without a Python object per molecule
+        simulation_state['molecules'] = MoleculeTable.from_rows(self.select_molecules(output), self.species_table)
+        return simulation_state
 
-        # TODO -- post processing to get effective rates
+    def select_molecules(self, output: Dict[str, Any]) -> np.ndarray:
+        """Return the listed molecule rows of `run_interval` output that are due and inside the region of interest."""
+        due_species = output['due_species']
+        molecules_data = output['molecules_data'].reshape(-1, 7)
+        if self.region_of_interest is not None:
+            low, high = self.region_of_interest
+            inside = np.all((molecules_data[:, 3:6] >= low) & (molecules_data[:, 3:6] <= high), axis=1)
+            molecules_data = molecules_data[inside]
+        if len(due_species) < len(self.output_species or self.species_names):
+            molecules_data = molecules_data[np.isin(molecules_data[:, 1], self.species_table.encode(due_species))]
+        return molecules_data
+
+
+# the kinds of trigger rule, each comparing a species count with the rule's value
+TRIGGER_RULES = ('above', 'below', 'change')
+
+
+def fired_triggers(
+        triggers: Sequence[Dict[str, Any]],
+        counts: Dict[str, int],
+        previous: Optional[Dict[str, int]],
+        reference: Dict[str, int]) -> List[int]:
+    """Return the indices of the `triggers` that fire on the species `counts`.
+
+        Args:
+            triggers:`Sequence[Dict]`: the trigger rules (see `SmoldynProcess`).
+            counts:`Dict[str, int]`: the current count of each species.
+            previous:`Dict[str, int]`: the counts when the triggers were last checked, `None` the first time. A
+                threshold only fires when the count crosses it, so never on the first check.
+            reference:`Dict[str, int]`: the counts at the last snapshot, which `change` is relative to.
+    """
+    fired = []
+    for index, trigger in enumerate(triggers):
+        name = trigger['species']
+        count = counts[name]
+        if 'above' in trigger:
+            fire = previous is not None and previous[name] <= trigger['above'] < count
+        elif 'below' in trigger:
+            fire = previous is not None and previous[name] >= trigger['below'] > count
+        else:
+            fire = abs(count - reference[name]) > trigger['change'] * max(reference[name], 1)
+        if fire:
+            fired.append(index)
+    return fired
+
+
+class CountStatistics:
+    """Running number of rows, mean, variance, minimum and maximum of each column of count rows, in constant
+        memory. Batches of rows are merged with Chan's parallel update of the mean and squared deviations.
+    """
 
-        return simulation_state
+    def __init__(self, columns: int):
+        self.rows = 0
+        self.mean = np.zeros(columns)
+        self.squared_deviations = np.zeros(columns)
+        self.minimum = np.full(columns, np.inf)
+        self.maximum = np.full(columns, -np.inf)
+
+    def add(self, counts: np.ndarray) -> None:
+        """Fold a batch of count rows, shape `(n, columns)`, into the statistics."""
+        rows = len(counts)
+        mean = counts.mean(axis=0)
+        total = self.rows + rows
+        delta = mean - self.mean
+        self.mean = self.mean + delta * rows / total
+        self.squared_deviations = self.squared_deviations + ((counts - mean) ** 2).sum(axis=0) \
+            + delta ** 2 * self.rows * rows / total
+        self.rows = total
+        self.minimum = np.minimum(self.minimum, counts.min(axis=0))
+        self.maximum = np.maximum(self.maximum, counts.max(axis=0))
+
+    def result(self, order: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+        """The statistics, with the columns picked (and reordered) by `order`."""
+        order = np.arange(len(self.mean)) if order is None else order
+        return {
+            'rows': np.int64(self.rows),
+            'mean': self.mean[order],
+            'std': np.sqrt(self.squared_deviations[order] / max(self.rows, 1)),
+            'min': self.minimum[order].astype(np.int64),
+            'max': self.maximum[order].astype(np.int64),
+        }
+
+
+def count_series(counts_data: np.ndarray, columns: Sequence[str]) -> Dict[str, np.ndarray]:
+    """Turn the rows of the `molcount` output into a time column and one count column per species of `columns`."""
+    series = {'time': counts_data[:, 0]}
+    for index, name in enumerate(columns):
+        series[name] = counts_data[:, index + 1].astype(np.int64)
+    return series
 
 
 # register the process above as the name passed in the first argument below
@@ -382,6 +988,274 @@ def test_process():
     print(f'RESULTS: {pf(results)}')
 
 
+def test_preserve_molecules():
+    """Molecules emitted by one update are kept, or re-created exactly, at the start of the next."""
+    process = SmoldynProcess({
+        'model_filepath': 'smoldyn_process/models/model_files/crowding_model.txt',
+        'preserve_molecules': True,
+    })
+    process.set_molecules(
+        species_ids=['red', 'red', 'green'],
+        states=[0, 0, 0],
+        coordinates=np.array([[10.0, 10.0, 1.0], [10.0, 10.0, 19.0], [1.0, 10.0, 10.0]]))
+    assert process.simulation.getMoleculeCount('red', MolecState.all) == 2
+    assert process.simulation.getMoleculeCount('green', MolecState.all) == 1
+
+    state = process.initial_state()
+    update = process.update(state, 0.01)
+    update = process.update({'species_counts': state['species_counts'], 'molecules': update['molecules']}, 0.01)
+    frame = molecule_arrays(update['molecules'])
+    assert sorted(frame['species_id'].tolist()) == ['green', 'red', 'red']
+
+    # the molecules of the last update stay in the simulation with their serials, a copy of them is re-created
+    kept = process.update({'species_counts': state['species_counts'], 'molecules': update['molecules']}, 0.01)
+    assert set(molecule_arrays(kept['molecules'])['serial']) == set(frame['serial'])
+    copied = dict(kept['molecules'])
+    recreated = process.update({'species_counts': state['species_counts'], 'molecules': copied}, 0.01)
+    assert not set(molecule_arrays(recreated['molecules'])['serial']) & set(frame['serial'])
+
+
+def test_surface_reseeding():
+    """Reseeding keeps the `up` state of the crowding model's molecules on the `ball` surface."""
+    process = SmoldynProcess({'model_filepath': 'smoldyn_process/models/model_files/crowding_model.txt'})
+    process.set_uniform('red', count=100)
+    assert process.simulation.getMoleculeCount('red', MolecState.up) == 100
+    assert process.simulation.getMoleculeCount('red', MolecState.soln) == 0
+
+    # positions handed back in keep their state and stay on the sphere of radius 10 around (10, 10, 10)
+    coordinates = np.array([[10.0, 10.0, 20.0], [0.0, 10.0, 10.0]])
+    process.set_molecules(['red', 'green'], [int(MolecState.up)] * 2, coordinates)
+    assert process.simulation.getMoleculeCount('red', MolecState.up) == 1
+    assert process.simulation.getMoleculeCount('green', MolecState.up) == 1
+
+
+def test_output_filters():
+    process = SmoldynProcess({
+        'model_filepath': 'smoldyn_process/models/model_files/minE_model.txt',
+        'output_species': ['MinE'],
+        'region_of_interest': {'low': [0.0, -0.5, -0.5], 'high': [2.0, 0.5, 0.5]},
+    })
+    update = process.update(process.initial_state(), 0.01)
+    frame = molecule_arrays(update['molecules'])
+    assert 0 < len(frame['species_id']) < 1400
+    assert set(frame['species_id'].tolist()) == {'MinE'}
+    assert np.all(frame['coordinates'][:, 0] >= 0.0)
+
+
+def test_output_cadence():
+    process = SmoldynProcess({
+        'model_filepath': 'smoldyn_process/models/model_files/crowding_model.txt',
+        'counts_every': 2,
+        'molecules_every': 2,
+        'species_every': {'green': 3},
+    })
+    state = process.initial_state()
+    emitted = []
+    for _ in range(4):
+        update = process.update(state, 0.02)
+        emitted.append(sorted(set(molecule_arrays(update['molecules'])['species_id'].tolist()))
+                       if 'molecules' in update else None)
+        # rows at iterations 0, 2 and 4 of the 4 steps
+        assert np.allclose(update['species_count_series']['time'], [0.0, 0.01, 0.02])
+    assert emitted == [['green', 'red'], None, ['red'], ['green']]
+
+
+def test_ports():
+    process = SmoldynProcess({'model_filepath': 'smoldyn_process/models/model_files/crowding_model.txt'})
+    state = process.initial_state()
+    counts = state['species_counts']
+    assert counts.dtype == np.int64 and process.schema()['species_counts']['_species'] == ['green', 'red']
+    # the molecules of the crowding model do not react, so the counts of the state come back unchanged
+    update = process.update({**state, 'species_counts': np.array([10, 200])}, 0.01)
+    assert update['species_counts'].tolist() == [0, 0] and len(update['molecules']) == 210
+    update = process.update(state, 0.01)
+    assert isinstance(update['molecules'], MoleculeTable) and len(update['molecules']) == 255
+
+    # the count delta is added into the state's vector in place, and the table is swapped in as a whole
+    state = types.apply_update(types.access(process.schema()), state, {**update, 'species_counts': np.array([1, -1])})
+    assert state['species_counts'] is counts and counts.tolist() == [6, 249]
+    assert state['molecules'] is update['molecules']
+
+
+def test_fired_triggers():
+    triggers = [{'species': 'a', 'above': 10}, {'species': 'a', 'below': 5}, {'species': 'b', 'change': 0.5}]
+    assert fired_triggers(triggers, {'a': 20, 'b': 10}, None, {'a': 20, 'b': 10}) == []
+    assert fired_triggers(triggers, {'a': 20, 'b': 10}, {'a': 8, 'b': 10}, {'a': 8, 'b': 10}) == [0]
+    assert fired_triggers(triggers, {'a': 4, 'b': 16}, {'a': 20, 'b': 10}, {'a': 8, 'b': 10}) == [1, 2]
+
+
+def test_triggered_snapshots():
+    process = SmoldynProcess({
+        'model_filepath': 'smoldyn_process/models/model_files/crowding_model.txt',
+        'triggers': [{'species': 'red', 'below': 100}, {'species': 'green', 'change': 0.5}],
+    })
+    state = process.initial_state()
+    # the counts of the state are reseeded into the simulation, where the triggers see them
+    counts = [[5, 250], [5, 50], [6, 50], [12, 50]]
+    snapshots = []
+    for species_counts in counts:
+        update = process.update({**state, 'species_counts': np.array(species_counts)}, 0.01)
+        snapshots.append('molecules' in update)
+    assert snapshots == [False, True, False, True]
+    assert process.snapshot_counts == {'red': 50, 'green': 12}
+
+
+def test_count_statistics():
+    rng = np.random.default_rng(0)
+    counts = rng.integers(0, 100, size=(50, 3)).astype(float)
+    statistics = CountStatistics(3)
+    for batch in np.array_split(counts, [1, 20, 21]):
+        statistics.add(batch)
+    result = statistics.result(np.array([2, 0, 1]))
+    assert result['rows'] == 50
+    assert np.allclose(result['mean'], counts.mean(axis=0)[[2, 0, 1]])
+    assert np.allclose(result['std'], counts.std(axis=0)[[2, 0, 1]])
+    assert result['max'].tolist() == counts.max(axis=0)[[2, 0, 1]].astype(int).tolist()
+
+
+def test_chunked_update():
+    config = {'model_filepath': 'smoldyn_process/models/model_files/crowding_model.txt', 'chunk_steps': 3}
+    process = SmoldynProcess(config)
+    update = process.update(process.initial_state(), 0.05)
+    # 10 steps in chunks of 3, 3, 3 and 1 step, with a count row at every step
+    statistics = update['species_count_statistics']
+    assert statistics['rows'] == 11
+    assert statistics['mean'].tolist() == [5.0, 250.0] and statistics['std'].tolist() == [0.0, 0.0]
+    assert np.allclose(update['species_count_series']['time'], [0.05])
+    assert len(update['molecules']) == 255
+
+
+def test_iter_frames():
+    process = SmoldynProcess({
+        'model_filepath': 'smoldyn_process/models/model_files/crowding_model.txt',
+        'molecules_every': 2,
+    })
+    frames = list(process.iter_frames(stop=0.05, every=0.02))
+    assert np.allclose([frame['time'] for frame in frames], [0.02, 0.04, 0.05])
+    assert ['molecules' in frame for frame in frames] == [True, False, True]
+    assert frames[-1]['species_counts'].tolist() == [5, 250]
+    assert np.allclose(frames[1]['species_count_series']['time'][[0, -1]], [0.02, 0.04])
+
+    async def collect():
+        return [frame['time'] async for frame in process.aiter_frames(stop=0.04, every=0.02)]
+    assert np.allclose(asyncio.run(collect()), [0.02, 0.04])
+
+
+def test_defines_and_seed():
+    config = {
+        'model_filepath': 'smoldyn_process/models/model_files/minE_model.txt',
+        'defines': {'L_PARAM': '3'},
+        'seed': 11,
+    }
+    process = SmoldynProcess(config)
+    assert process.boundaries['low'][0] == -3.0
+    assert process.simulation.getMoleculeCount('MinE', MolecState.all) == 1400
+
+    # the same seed gives the same trajectory
+    frames = [
+        molecule_arrays(SmoldynProcess(config).update(process.initial_state(), 0.01)['molecules'])['coordinates']
+        for _ in range(2)]
+    assert np.array_equal(frames[0], frames[1])
+
+
+def test_cached_update(tmp_path):
+    config = {
+        'model_filepath': 'smoldyn_process/models/model_files/minE_model.txt',
+        'cache_dir': str(tmp_path),
+    }
+
+    def run(process, intervals):
+        state = process.initial_state()
+        return [process.update(state, 0.01) for _ in range(intervals)]
+
+    run(SmoldynProcess(config), 2)
+    uncached = run(SmoldynProcess({**config, 'cache_dir': ''}), 3)
+
+    # the first two intervals come from the cache, the third is run after replaying them
+    process = SmoldynProcess(config)
+    state = process.initial_state()
+    cached = [process.update(state, 0.01) for _ in range(2)]
+    assert len(process.skipped_intervals) == 2
+    cached.append(process.update(state, 0.01))
+    for update, expected in zip(cached, uncached):
+        assert np.array_equal(update['species_counts'], expected['species_counts'])
+        assert np.array_equal(
+            molecule_arrays(update['molecules'])['coordinates'], molecule_arrays(expected['molecules'])['coordinates'])
+    assert process.update_count == 3 and not process.skipped_intervals
+
+    # with a replay limit of 2, the second cached interval is replayed right away
+    process = SmoldynProcess({**config, 'cache_replay_limit': 2})
+    state = process.initial_state()
+    process.update(state, 0.01)
+    assert len(process.skipped_intervals) == 1 and list(process.skipped_intervals[0][0]) == ['species_counts']
+    process.update(state, 0.01)
+    assert process.update_count == 2 and not process.skipped_intervals
+    update = process.update(state, 0.01)
+    assert np.array_equal(
+        molecule_arrays(update['molecules'])['coordinates'], molecule_arrays(uncached[2]['molecules'])['coordinates'])
+
+    # a frame after cached updates runs on from where the simulation would be without the cache
+    process = SmoldynProcess(config)
+    state = process.initial_state()
+    process.update(state, 0.01)
+    process.update(state, 0.01)
+    frame = next(process.iter_frames(0.01, 0.01))
+    expected = SmoldynProcess({**config, 'cache_dir': ''})
+    expected.update(state, 0.01)
+    expected.update(state, 0.01)
+    expected_frame = next(expected.iter_frames(0.01, 0.01))
+    assert not process.skipped_intervals
+    assert np.array_equal(
+        molecule_arrays(frame['molecules'])['coordinates'], molecule_arrays(expected_frame['molecules'])['coordinates'])
+
+
+    # a stretched cadence gets its own entries, rather than replaying the snapshots of the unstretched run
+    process = SmoldynProcess(config)
+    process.stretch_cadence(2)
+    state = process.initial_state()
+    assert ['molecules' in process.update(state, 0.01) for _ in range(3)] == [True, False, True]
+    process = SmoldynProcess(config)
+    assert all('molecules' in process.update(state, 0.01) for _ in range(3))
+
+    # the trigger state is restored from the cache
+    triggered = {**config, 'triggers': [{'species': 'MinE', 'change': 0.5}]}
+    first = SmoldynProcess(triggered)
+    first.update(first.initial_state(), 0.01)
+    process = SmoldynProcess(triggered)
+    process.update(process.initial_state(), 0.01)
+    assert process.skipped_intervals and process.trigger_counts == first.trigger_counts
+
+def test_set_compartment():
+    process = SmoldynProcess({
+        'model_filepath': 'smoldyn_process/models/model_files/minE_model.txt',
+        'compartments': {'MinE': 'cell'},
+    })
+    process.set_compartment('MinE', count=500)
+    assert process.simulation.getMoleculeCount('MinE', MolecState.all) == 500
+    # the cell compartment is filled by Smoldyn, the inside of the bare membrane surface is sampled
+    assert process.compartments == {'MinE': 'cell'} and not process.regions
+    capsule = get_region('smoldyn_process/models/model_files/minE_model.txt', 'cell')
+    coordinates = molecule_arrays(process.convert_output(process.run_interval(process.simulation.dt))['molecules'])
+    assert np.all(capsule.contains(coordinates['coordinates'][coordinates['species_id'] == 'MinE']))
+
+    process = SmoldynProcess({
+        'model_filepath': 'smoldyn_process/models/model_files/minE_model.txt',
+        'compartments': {'MinE': 'membrane'},
+    })
+    process.set_compartment('MinE', count=500)
+    assert 'MinE' in process.regions and process.simulation.getMoleculeCount('MinE', MolecState.all) == 500
+
+    # update reseeds the species into its compartment as well
+    process = SmoldynProcess({
+        'model_filepath': 'smoldyn_process/models/model_files/minE_model.txt',
+        'compartments': {'MinE': 'cell'},
+    })
+    update = process.update(process.initial_state(), process.simulation.dt)
+    coordinates = molecule_arrays(update['molecules'])
+    placed = coordinates['coordinates'][coordinates['species_id'] == 'MinE']
+    assert len(placed) and np.all(capsule.contains(placed))
+
+
 def manually_test_process():
     config = {
         'model_filepath': 'smoldyn_process/models/model_files/minE_model.txt',
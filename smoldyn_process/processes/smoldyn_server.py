@@ -0,0 +1,396 @@
+"""
+Smoldyn Job Server
+
+A worker server and client scheduler for running ensembles of Smoldyn jobs on several nodes over TCP or
+Unix sockets.
+
+Every message is length-prefixed: an 8-byte body length and a 4-byte header length (both big-endian),
+a UTF-8 JSON header, and the raw bytes of the arrays the header lists by name, dtype and shape, so
+results are never pickled. A job carries the model text (and file name), `define` overrides, seed,
+`stop`, `interval` and any other `SmoldynProcess` config. The server answers with one `frame` per
+interval, whose arrays hold the count series and the listed molecules as columns, then `done` (or
+`error` if the job fails).
+
+A server runs one job at a time, since Smoldyn keeps native state per process; run one server per core.
+The `Scheduler` keeps one job in flight per server and stops reading from the servers while its bounded
+result queue is full, so slow consumers hold the servers back through TCP flow control. Jobs that were
+in flight on a server that disconnects are retried on the remaining servers, and the intervals already
+delivered are not repeated. Jobs of models without a `random_seed` are given a seed before they are first
+sent, so that a rerun is the same trajectory as the frames already delivered.
+
+Run a server with `python -m smoldyn_process.processes.smoldyn_server /tmp/smoldyn.sock` (or `host:port`),
+which listens on `127.0.0.1:7600` if no address is given.
+
+WARNING: a server runs whatever model text it is sent, with no authentication, and Smoldyn model files
+can write files and run commands. Only listen on a Unix socket or on localhost, and reach servers on
+other machines through an SSH tunnel or a private network, never on a public interface.
+"""
+
+
+import argparse
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+import warnings
+from typing import *
+import numpy as np
+from smoldyn_process.library.cache import is_seeded
+from smoldyn_process.library.model_file import read_model_text, resolve_model_text
+from smoldyn_process.library.molecules import MoleculeTable
+from smoldyn_process.processes.smoldyn_process import SmoldynProcess
+
+
+# body length, header length
+MESSAGE_PREFIX = struct.Struct('!QI')
+
+DEFAULT_ADDRESS = '127.0.0.1:7600'
+
+Address = Union[str, Tuple[str, int]]
+
+
+def parse_address(address: str) -> Address:
+    """`'host:port'` to a TCP address, anything else to a Unix socket path."""
+    host, _, port = address.rpartition(':')
+    return (host, int(port)) if host and port.isdigit() else address
+
+
+def send_message(connection: socket.socket, header: Dict[str, Any], arrays: Dict[str, np.ndarray] = None) -> None:
+    """Send `header` and the raw bytes of `arrays` as one message."""
+    arrays = {name: np.ascontiguousarray(array) for name, array in (arrays or {}).items()}
+    header = {**header, 'arrays': [[name, array.dtype.str, list(array.shape)] for name, array in arrays.items()]}
+    header_bytes = json.dumps(header).encode()
+    body_length = len(header_bytes) + sum(array.nbytes for array in arrays.values())
+    connection.sendall(MESSAGE_PREFIX.pack(body_length, len(header_bytes)) + header_bytes)
+    for array in arrays.values():
+        connection.sendall(memoryview(array).cast('B'))
+
+
+def receive_exactly(connection: socket.socket, size: int) -> bytearray:
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = connection.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError('connection closed')
+        received += count
+    return buffer
+
+
+def receive_message(connection: socket.socket) -> Tuple[Dict[str, Any], Dict[str, np.ndarray]]:
+    """Receive one message. The arrays are views into the received body."""
+    body_length, header_length = MESSAGE_PREFIX.unpack(receive_exactly(connection, MESSAGE_PREFIX.size))
+    body = receive_exactly(connection, body_length)
+    header = json.loads(body[:header_length].decode())
+    arrays = {}
+    offset = header_length
+    for name, dtype, shape in header.pop('arrays'):
+        count = int(np.prod(shape))
+        arrays[name] = np.frombuffer(body, dtype=dtype, count=count, offset=offset).reshape(shape)
+        offset += arrays[name].nbytes
+    return header, arrays
+
+
+def make_job(
+        model_filepath: str,
+        stop: float,
+        interval: float,
+        defines: Dict[str, Any] = None,
+        seed: Optional[int] = None,
+        config: Dict[str, Any] = None,
+        job_id: Optional[str] = None) -> Dict[str, Any]:
+    """Build a job message for the model file at `model_filepath`. The files the model includes with `read_file`
+        are written into the model text, since the server runs it from another directory.
+    """
+    model = read_model_text(model_filepath)
+    return {
+        'type': 'job',
+        'job_id': job_id or model_filepath,
+        'model': model,
+        'model_name': os.path.basename(model_filepath),
+        'defines': {name: str(value) for name, value in (defines or {}).items()},
+        'seed': seed,
+        'stop': stop,
+        'interval': interval,
+        'config': config or {},
+    }
+
+
+def run_job(job: Dict[str, Any], send: Callable[[Dict, Dict[str, np.ndarray]], None]) -> None:
+    """Run a job and `send` a frame header and its columnar arrays at the end of every interval."""
+    config = job.get('config') or {}
+    if config.get('preserve_molecules'):
+        raise ValueError('jobs do not support `preserve_molecules`.')
+
+    with tempfile.TemporaryDirectory(prefix='smoldyn-job-') as directory:
+        model_filepath = os.path.join(directory, os.path.basename(job.get('model_name') or 'model.txt'))
+        with open(model_filepath, 'w') as file:
+            file.write(job['model'])
+        process = SmoldynProcess({
+            **config,
+            'model_filepath': model_filepath,
+            'defines': job.get('defines') or {},
+            'seed': job.get('seed'),
+        })
+
+        state = process.initial_state()
+        species_names = process.species_table.names.tolist()
+        time, index = 0.0, 0
+        while time < job['stop'] - 1e-12:
+            step = min(job['interval'], job['stop'] - time)
+            process.reseed(state)
+            output = process.run_interval(step)
+            time += step
+            state['species_counts'] = output['final_counts']
+
+            counts_data = output['counts_data'].reshape(-1, len(process.count_columns) + 1)
+            arrays = {'count_time': counts_data[:, 0], 'counts': counts_data[:, 1:].astype(np.int64)}
+            if output['molecules_data'] is not None:
+                table = MoleculeTable.from_rows(process.select_molecules(output), process.species_table)
+                arrays.update({
+                    'coordinates': table.coordinates,
+                    'species_code': table.species_code,
+                    'state': table.state,
+                    'serial': table.serial,
+                })
+            header = {
+                'type': 'frame',
+                'job_id': job['job_id'],
+                'index': index,
+                'seed': job.get('seed'),
+                'time': time,
+                'species_counts': dict(zip(process.species_names, output['final_counts'].tolist())),
+                'count_columns': process.count_columns,
+                'species_names': species_names,
+            }
+            send(header, arrays)
+            index += 1
+
+
+class JobHandler(socketserver.BaseRequestHandler):
+    """Run the jobs sent on one connection, one after the other, until the client disconnects."""
+
+    def handle(self) -> None:
+        while True:
+            try:
+                job, _ = receive_message(self.request)
+            except ConnectionError:
+                return
+            try:
+                run_job(job, lambda header, arrays: send_message(self.request, header, arrays))
+                reply = {'type': 'done', 'job_id': job.get('job_id')}
+            except ConnectionError:
+                return
+            except Exception as error:
+                reply = {'type': 'error', 'job_id': job.get('job_id'), 'message': f'{type(error).__name__}: {error}'}
+            try:
+                send_message(self.request, reply)
+            except ConnectionError:
+                return
+
+
+class TCPJobServer(socketserver.TCPServer):
+    allow_reuse_address = True
+
+
+def make_server(address: Address) -> socketserver.BaseServer:
+    """A job server listening on a TCP `(host, port)` or a Unix socket path."""
+    if isinstance(address, str):
+        return socketserver.UnixStreamServer(address, JobHandler)
+    return TCPJobServer(tuple(address), JobHandler)
+
+
+def connect(address: Address, timeout: Optional[float] = None) -> socket.socket:
+    if isinstance(address, str):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(address)
+    else:
+        connection = socket.create_connection(tuple(address))
+    connection.settimeout(timeout)
+    return connection
+
+
+class Scheduler:
+    """Distribute jobs over job servers and stream back their frames.
+
+        Args:
+            addresses:`List[Address]`: the servers, TCP `(host, port)` tuples or Unix socket paths.
+            queue_size:`int`: frames buffered before the servers are held back. Defaults to 16.
+            max_attempts:`int`: times a job is sent to a server before it is given up. Defaults to 3.
+            timeout:`float`: seconds without data after which a server counts as lost. Defaults to no timeout.
+    """
+
+    def __init__(
+            self,
+            addresses: Sequence[Address],
+            queue_size: int = 16,
+            max_attempts: int = 3,
+            timeout: Optional[float] = None):
+        self.addresses = list(addresses)
+        self.queue_size = queue_size
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+
+    def work(self, address: Address, pending: queue.Queue, results: queue.Queue) -> None:
+        """Send jobs from `pending` to the server at `address` one at a time until it is told to stop or is lost."""
+        try:
+            connection = connect(address, self.timeout)
+        except OSError:
+            results.put(('exit', None, None))
+            return
+        with connection:
+            while True:
+                job = pending.get()
+                if job is None:
+                    break
+                try:
+                    send_message(connection, job)
+                    while True:
+                        header, arrays = receive_message(connection)
+                        # blocks while the consumer is behind
+                        results.put((header['type'], header, arrays))
+                        if header['type'] != 'frame':
+                            break
+                except OSError:
+                    results.put(('lost', job, None))
+                    break
+        results.put(('exit', None, None))
+
+    def run(self, jobs: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """Run `jobs` (from `make_job`) and yield their frames as they arrive.
+
+            A frame is a `Dict` with the `type`, `job_id`, `index`, `seed`, `time`, `species_counts`, `count_columns`
+            and `species_names` (indexed by species code) of the header, the `count_time` and `counts` (one column per
+            `count_columns`) arrays and, if molecules were listed, the `coordinates`, `species_code`, `state` and
+            `serial` arrays. A job that fails yields `{'job_id': ..., 'error': message}` instead.
+        """
+        pending: queue.Queue = queue.Queue()
+        results: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        attempts: Dict[str, int] = {}
+        rng = np.random.default_rng()
+        for job in jobs:
+            # a retry continues from the frames already delivered, so it has to follow the same trajectory
+            if job.get('seed') is None and not is_seeded(resolve_model_text(None, job.get('defines'), text=job['model'])):
+                job = {**job, 'seed': int(rng.integers(2 ** 31))}
+            attempts[job['job_id']] = 0
+            pending.put(job)
+        remaining = len(attempts)
+        delivered: Dict[str, int] = {}
+
+        for address in self.addresses:
+            threading.Thread(target=self.work, args=(address, pending, results), daemon=True).start()
+        alive = len(self.addresses)
+
+        try:
+            while remaining and alive:
+                kind, header, arrays = results.get()
+                if kind == 'frame':
+                    # frames already delivered by an earlier attempt of the job
+                    if header['index'] < delivered.get(header['job_id'], 0):
+                        continue
+                    delivered[header['job_id']] = header['index'] + 1
+                    yield {**header, **arrays}
+                elif kind == 'done':
+                    remaining -= 1
+                elif kind == 'error':
+                    remaining -= 1
+                    yield {'job_id': header['job_id'], 'error': header['message']}
+                elif kind == 'lost':
+                    job_id = header['job_id']
+                    attempts[job_id] += 1
+                    if attempts[job_id] < self.max_attempts:
+                        pending.put(header)
+                    else:
+                        remaining -= 1
+                        yield {'job_id': job_id, 'error': f'gave up after {attempts[job_id]} lost attempts'}
+                elif kind == 'exit':
+                    alive -= 1
+
+            # every server was lost before the remaining jobs could run
+            while remaining:
+                job = pending.get_nowait()
+                remaining -= 1
+                yield {'job_id': job['job_id'], 'error': 'no job server left'}
+        finally:
+            for _ in self.addresses:
+                pending.put(None)
+
+
+def serve(address: Address) -> None:
+    with make_server(address) as server:
+        server.serve_forever()
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='Serve Smoldyn jobs over a TCP or Unix socket.')
+    parser.add_argument('address', nargs='?', default=DEFAULT_ADDRESS,
+                        help=f"'host:port' to listen on TCP, or the path of a Unix socket. Defaults to {DEFAULT_ADDRESS}")
+    args = parser.parse_args(argv)
+    address = parse_address(args.address)
+    if not isinstance(address, str) and address[0] not in ('127.0.0.1', 'localhost', '::1'):
+        warnings.warn(f'listening on {address[0]}: anyone who can connect can run arbitrary model text on this host.')
+    serve(address)
+
+
+def test_scheduler_retry():
+    import multiprocessing
+    import time
+
+    directory = tempfile.mkdtemp()
+    server_address = os.path.join(directory, 'server.sock')
+    server = multiprocessing.get_context('spawn').Process(target=serve, args=(server_address,), daemon=True)
+    server.start()
+
+    # a server that is lost during the first job it receives
+    listener = socket.create_server(('127.0.0.1', 0))
+    lost_address = listener.getsockname()
+
+    def lose_job():
+        connection, _ = listener.accept()
+        receive_message(connection)
+        connection.close()
+        listener.close()
+
+    threading.Thread(target=lose_job, daemon=True).start()
+    try:
+        while not os.path.exists(server_address):
+            time.sleep(0.05)
+        jobs = [
+            make_job(
+                'smoldyn_process/models/model_files/crowding_model.txt',
+                stop=0.04,
+                interval=0.02,
+                seed=index if index < 2 else None,
+                config={'output_species': ['red']},
+                job_id=f'crowding-{index}')
+            for index in range(3)]
+
+        frames: Dict[str, List[Dict]] = {}
+        for frame in Scheduler([lost_address, server_address], queue_size=2).run(jobs):
+            assert 'error' not in frame
+            frames.setdefault(frame['job_id'], []).append(frame)
+
+        assert sorted(frames) == ['crowding-0', 'crowding-1', 'crowding-2']
+        for job_frames in frames.values():
+            assert [frame['index'] for frame in job_frames] == [0, 1]
+            frame = job_frames[-1]
+            assert frame['counts'].shape[1] == len(frame['count_columns'])
+            assert len(frame['coordinates']) == frame['species_counts']['red']
+            assert set(np.asarray(frame['species_names'])[frame['species_code']].tolist()) == {'red'}
+            # the unseeded job is given a seed before it is first sent, the others keep theirs
+            assert all(job_frame['seed'] == frame['seed'] for job_frame in job_frames)
+            if frame['job_id'] == 'crowding-2':
+                assert frame['seed'] is not None
+            else:
+                assert frame['seed'] == int(frame['job_id'][-1])
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
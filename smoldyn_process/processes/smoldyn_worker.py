@@ -0,0 +1,421 @@
+"""
+Smoldyn Worker Process
+
+Runs a `SmoldynProcess` in a dedicated OS process, so that the native `simulation.run` of several Smoldyn
+nodes can use separate cores instead of taking turns on the GIL of one interpreter.
+
+`SmoldynWorker` owns the worker process and sends it method calls over a pipe, and `AsyncSmoldynProcess`
+is the `Process` that sits in a composite in place of a `SmoldynProcess`. Its `invoke` only sends the
+request and defers waiting for the reply until the composite applies the update, so all the Smoldyn nodes
+of a composite step run at the same time. `async_update` returns an awaitable for use with asyncio, and
+`advance` / `run_nodes` drive several nodes concurrently, synchronizing them at interval boundaries.
+
+`SharedSmoldynProcess` returns the molecule rows and count series of each interval through
+`multiprocessing.shared_memory` blocks owned by the worker, so only a small header goes through the pipe.
+Its `iter_frames` is pipelined: the worker runs frame k+1 while this process receives and uses frame k, which
+a thread could not do, since Smoldyn holds the GIL while it runs.
+"""
+
+
+import asyncio
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing.connection import Connection
+from multiprocessing.shared_memory import SharedMemory
+from typing import *
+import numpy as np
+from process_bigraph import Process, process_registry, types
+from smoldyn_process.library.molecules import MoleculeTable, SpeciesTable, molecule_arrays
+from smoldyn_process.processes.smoldyn_process import SmoldynProcess, count_series
+
+
+# where an array is in shared memory: its key, block name, shape and dtype
+ArraySpec = Tuple[str, str, Tuple[int, ...], str]
+
+
+class SharedArrays:
+    """Shared-memory blocks holding the latest array of each key, reused between calls and grown when needed.
+
+        The writer owns (and finally unlinks) the blocks; readers attach to them by name and copy the arrays out
+        before the next write. Both hold one block per key, so a reader closes the block of a key once the writer
+        has replaced it.
+    """
+
+    def __init__(self):
+        self.blocks: Dict[str, SharedMemory] = {}
+
+    def write(self, key: str, array: np.ndarray) -> ArraySpec:
+        array = np.ascontiguousarray(array)
+        block = self.blocks.get(key)
+        if block is None or block.size < array.nbytes:
+            if block is not None:
+                block.close()
+                block.unlink()
+            # leave room to grow, so that a block is not replaced at every interval
+            block = self.blocks[key] = SharedMemory(create=True, size=max(2 * array.nbytes, 4096))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+        return key, block.name, array.shape, array.dtype.str
+
+    def read(self, spec: ArraySpec) -> np.ndarray:
+        key, name, shape, dtype = spec
+        block = self.blocks.get(key)
+        if block is None or block.name != name:
+            if block is not None:
+                # the writer has unlinked the replaced block, this drops the last mapping of it
+                block.close()
+            # the worker shares the resource tracker of this process, which forgets the block once the writer unlinks it
+            block = self.blocks[key] = SharedMemory(name=name)
+        return np.ndarray(shape, dtype, buffer=block.buf).copy()
+
+    def close(self, unlink: bool = False) -> None:
+        for block in self.blocks.values():
+            block.close()
+            if unlink:
+                block.unlink()
+        self.blocks = {}
+
+
+def write_output(process: SmoldynProcess, arrays: SharedArrays, output: Dict[str, Any], slot: int = 0) -> Dict:
+    """Write the count and molecule rows of a `run_interval` output to the arrays of `slot`.
+
+        Returns:
+            `Dict`: the final `species_counts`, the `count_statistics` (with `chunk_steps`) and the `ArraySpec` of
+                `counts_data` and (if listed) `molecules_data`.
+    """
+    header = {
+        'species_counts': output['final_counts'],
+        'counts_data': arrays.write(f'counts_data/{slot}', output['counts_data']),
+    }
+    if output['count_statistics'] is not None:
+        header['count_statistics'] = output['count_statistics']
+    if output['molecules_data'] is not None:
+        header['molecules_data'] = arrays.write(f'molecules_data/{slot}', process.select_molecules(output))
+    return header
+
+
+def shared_update(process: SmoldynProcess, arrays: SharedArrays, state: Dict, interval: float) -> Dict:
+    """Run one interval of `process` (or take it from its cache) and write its output to `arrays`, with the
+        `species_counts` as the update.
+    """
+    header = write_output(process, arrays, process.interval_output(state, interval))
+    header['species_counts'] = header['species_counts'] - state['species_counts']
+    return header
+
+
+def shared_frame(process: SmoldynProcess, arrays: SharedArrays, interval: float, slot: int) -> Dict:
+    """Run the next frame of `process` (see `SmoldynProcess.run_frame`) and write its output to the arrays of
+        `slot`, so that the previous frame can still be read from the other slot.
+    """
+    return write_output(process, arrays, process.run_frame(interval), slot)
+
+
+def serve(config: Dict[str, Any], connection: Connection) -> None:
+    """Worker loop: build a `SmoldynProcess` and answer `(method, args)` requests until `close`."""
+    process = SmoldynProcess(config)
+    arrays = SharedArrays()
+    methods = {
+        'shared_update': lambda state, interval: shared_update(process, arrays, state, interval),
+        'shared_frame': lambda interval, slot: shared_frame(process, arrays, interval, slot),
+        'describe': lambda: {'count_columns': process.count_columns, 'species': process.species_table.names.tolist()},
+    }
+    while True:
+        method, args = connection.recv()
+        if method == 'close':
+            break
+        try:
+            handler = methods.get(method) or getattr(process, method)
+            connection.send(('ok', handler(*args)))
+        except Exception as error:
+            connection.send(('error', error))
+    arrays.close(unlink=True)
+    connection.close()
+
+
+class SmoldynWorker:
+    """A `SmoldynProcess` living in its own OS process.
+
+        `submit` sends calls from a single background thread, so it never blocks the caller and the requests of
+        one worker are answered in order. Each request and its reply go through the pipe under a lock, so `call`
+        can also be used from any other thread.
+
+        Args:
+            config:`Dict[str, Any]`: the `SmoldynProcess` config.
+            start_method:`str`: `multiprocessing` start method. Defaults to `'spawn'`, so the worker does not inherit
+                any Smoldyn state of the parent.
+    """
+
+    def __init__(self, config: Dict[str, Any], start_method: str = 'spawn'):
+        context = multiprocessing.get_context(start_method)
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=serve, args=(config, child_connection), daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='smoldyn-worker')
+        self.lock = threading.Lock()
+
+    def call(self, method: str, *args) -> Any:
+        """Call `method` of the worker's `SmoldynProcess` and wait for the result."""
+        with self.lock:
+            self.connection.send((method, args))
+            status, result = self.connection.recv()
+        if status == 'error':
+            raise result
+        return result
+
+    def submit(self, method: str, *args) -> Future:
+        """Call `method` of the worker's `SmoldynProcess` without waiting for the result."""
+        return self.executor.submit(self.call, method, *args)
+
+    def close(self) -> None:
+        # let the submitted calls finish first
+        self.executor.shutdown()
+        if self.process.is_alive():
+            with self.lock:
+                self.connection.send(('close', ()))
+            self.process.join()
+        self.connection.close()
+
+
+class FutureUpdate:
+    """The update of an `invoke` that is still running in a worker, resolved when the composite applies it."""
+
+    def __init__(self, future: Future):
+        self.future = future
+
+    def get(self) -> Dict:
+        return self.future.result()
+
+
+class AsyncSmoldynProcess(Process):
+    """A proxy for a `SmoldynProcess` that runs in a `SmoldynWorker`. It takes the same config and has the same
+        ports and initial state.
+    """
+
+    config_schema = SmoldynProcess.config_schema
+
+    def __init__(self, config: Dict[str, Any] = None):
+        super().__init__(config)
+        self.worker = SmoldynWorker(self.config)
+        self.ports = self.worker.call('schema')
+
+    def initial_state(self) -> Dict:
+        return self.worker.call('initial_state')
+
+    def schema(self) -> Dict:
+        return self.ports
+
+    def submit_update(self, state: Dict, interval: float) -> Future:
+        return self.worker.submit('update', state, interval)
+
+    def invoke(self, state: Dict, interval: float) -> FutureUpdate:
+        return FutureUpdate(self.submit_update(state, interval))
+
+    def update(self, state: Dict, interval: float) -> Dict:
+        return self.submit_update(state, interval).result()
+
+    def async_update(self, state: Dict, interval: float) -> Awaitable[Dict]:
+        """Start the update in the worker and return an awaitable of it."""
+        return asyncio.wrap_future(self.submit_update(state, interval))
+
+    def close(self) -> None:
+        self.worker.close()
+
+
+class SharedSmoldynProcess(AsyncSmoldynProcess):
+    """An `AsyncSmoldynProcess` whose worker returns the molecule rows and count series in shared memory. The
+        update is built from them in this process, so it is the same as that of a `SmoldynProcess`.
+    """
+
+    def __init__(self, config: Dict[str, Any] = None):
+        super().__init__(config)
+        description = self.worker.call('describe')
+        self.count_columns = description['count_columns']
+        self.species_table = SpeciesTable(description['species'])
+        self.arrays = SharedArrays()
+
+    def submit_update(self, state: Dict, interval: float) -> Future:
+        # the input molecules are only read by the worker to preserve them
+        sent_state = {
+            'species_counts': state['species_counts'],
+            'molecules': state['molecules'] if self.config['preserve_molecules'] else {},
+        }
+        # the arrays are read on the worker's thread, before its next call can overwrite them
+        return self.worker.executor.submit(lambda: self.receive(self.worker.call('shared_update', sent_state, interval)))
+
+    def iter_frames(self, stop: float, every: float) -> Iterator[Dict[str, Any]]:
+        """`SmoldynProcess.iter_frames`, with the worker running each next frame while the current one is received
+            and used by the caller. Frames alternate between two slots of shared arrays, and a frame is only requested
+            once the frame before it in its slot has been read.
+        """
+        frames = int(np.ceil(stop / every - 1e-9))
+        bounds = [(index * every, min((index + 1) * every, stop)) for index in range(frames)]
+
+        def submit(index: int) -> Future:
+            start, end = bounds[index]
+            return self.worker.submit('shared_frame', end - start, index % 2)
+
+        pending = deque(submit(index) for index in range(min(2, frames)))
+        for index, (start, end) in enumerate(bounds):
+            frame = self.receive(pending.popleft().result())
+            if index + 2 < frames:
+                pending.append(submit(index + 2))
+            frame['species_count_series']['time'] = frame['species_count_series']['time'] + start
+            yield {'time': end, **frame}
+
+    def receive(self, header: Dict) -> Dict:
+        """Build the update from a `shared_update` header and the arrays it points to."""
+        update = {
+            'species_counts': header['species_counts'],
+            'species_count_series': count_series(self.arrays.read(header['counts_data']), self.count_columns),
+        }
+        if 'count_statistics' in header:
+            update['species_count_statistics'] = header['count_statistics']
+        if 'molecules_data' in header:
+            update['molecules'] = MoleculeTable.from_rows(self.arrays.read(header['molecules_data']), self.species_table)
+        return update
+
+    def close(self) -> None:
+        super().close()
+        self.arrays.close()
+
+
+process_registry.register('async_smoldyn_process', AsyncSmoldynProcess)
+process_registry.register('shared_smoldyn_process', SharedSmoldynProcess)
+
+
+async def advance(nodes: Dict[str, Tuple[AsyncSmoldynProcess, Dict]], interval: float) -> Dict[str, Dict]:
+    """Advance every `(process, state)` node by `interval` concurrently and return their updates by name."""
+    updates = await asyncio.gather(*(process.async_update(state, interval) for process, state in nodes.values()))
+    return dict(zip(nodes, updates))
+
+
+async def run_nodes(
+        processes: Dict[str, AsyncSmoldynProcess],
+        stop: float,
+        interval: float) -> Dict[str, List[Dict]]:
+    """Run several Smoldyn nodes side by side until `stop`, applying all their updates at every interval boundary.
+
+        Returns:
+            `Dict[str, List[Dict]]`: the update of every interval, by node name.
+    """
+    states = {name: process.initial_state() for name, process in processes.items()}
+    schemas = {name: types.access(process.schema()) for name, process in processes.items()}
+    results: Dict[str, List[Dict]] = {name: [] for name in processes}
+    time = 0.0
+    while time < stop:
+        step = min(interval, stop - time)
+        updates = await advance({name: (processes[name], states[name]) for name in processes}, step)
+        for name, update in updates.items():
+            states[name] = types.apply_update(schemas[name], states[name], update)
+            results[name].append(update)
+        time += step
+    return results
+
+
+def test_run_nodes():
+    config = {'model_filepath': 'smoldyn_process/models/model_files/crowding_model.txt'}
+    processes = {'left': AsyncSmoldynProcess(config), 'right': AsyncSmoldynProcess(config)}
+    try:
+        results = asyncio.run(run_nodes(processes, stop=0.04, interval=0.02))
+        for updates in results.values():
+            assert len(updates) == 2
+            assert updates[-1]['species_counts'].shape == (2,)
+            assert len(updates[-1]['molecules']) > 0
+
+        # invoke only starts the update, the result arrives on get
+        left = processes['left']
+        deferred = left.invoke(left.initial_state(), 0.02)
+        assert set(deferred.get()) == {'species_counts', 'species_count_series', 'molecules'}
+    finally:
+        for process in processes.values():
+            process.close()
+
+
+def test_worker_calls_from_threads():
+    worker = SmoldynWorker({'model_filepath': 'smoldyn_process/models/model_files/crowding_model.txt'})
+    try:
+        # calls from this thread go between the submitted ones, and every reply reaches its own caller
+        futures = [worker.submit('initial_state') for _ in range(20)]
+        for _ in range(20):
+            assert worker.call('schema')['species_counts']['_type'] == 'count_vector'
+        for future in futures:
+            assert future.result()['species_counts'].shape == (2,)
+    finally:
+        worker.close()
+
+
+def test_shared_memory_transport():
+    config = {
+        'model_filepath': 'smoldyn_process/models/model_files/crowding_model.txt',
+        'output_species': ['red'],
+    }
+    process = SharedSmoldynProcess(config)
+    try:
+        state = process.initial_state()
+        for _ in range(2):
+            update = process.update(state, 0.02)
+            assert update['species_counts'].tolist() == [0, 0]
+            assert np.isclose(update['species_count_series']['time'][-1], 0.02)
+            assert update['species_count_series']['red'].dtype == np.int64
+            molecules = list(update['molecules'].values())
+            assert len(molecules) == state['species_counts'][process.schema()['species_counts']['_species'].index('red')]
+            assert {molecule['species_id'] for molecule in molecules} == {'red'}
+            assert len(molecules[0]['coordinates']) == 3
+    finally:
+        process.close()
+
+
+def test_pipelined_frames():
+    config = {'model_filepath': 'smoldyn_process/models/model_files/minE_model.txt'}
+    process = SharedSmoldynProcess(config)
+    try:
+        frames = list(process.iter_frames(0.05, 0.01))
+    finally:
+        process.close()
+    # the model is seeded, so the frames are those of the same trajectory run in this process
+    expected = list(SmoldynProcess(config).iter_frames(0.05, 0.01))
+    assert len(frames) == len(expected) == 5
+    for frame, expected_frame in zip(frames, expected):
+        assert np.isclose(frame['time'], expected_frame['time'])
+        assert np.array_equal(frame['species_counts'], expected_frame['species_counts'])
+        assert np.allclose(frame['species_count_series']['time'], expected_frame['species_count_series']['time'])
+        assert np.array_equal(
+            molecule_arrays(frame['molecules'])['coordinates'],
+            molecule_arrays(expected_frame['molecules'])['coordinates'])
+
+
+def test_shared_cached_update(tmp_path):
+    config = {'model_filepath': 'smoldyn_process/models/model_files/minE_model.txt', 'cache_dir': str(tmp_path)}
+
+    def run(config, intervals):
+        process = SharedSmoldynProcess(config)
+        try:
+            state = process.initial_state()
+            return [process.update(state, 0.01) for _ in range(intervals)]
+        finally:
+            process.close()
+
+    uncached = run({**config, 'cache_dir': ''}, 3)
+    run(config, 2)
+    assert any(tmp_path.iterdir())
+    # the worker takes the first two intervals from the cache, and replays them before running the third
+    for update, expected in zip(run(config, 3), uncached):
+        assert np.array_equal(update['species_counts'], expected['species_counts'])
+        assert np.array_equal(
+            molecule_arrays(update['molecules'])['coordinates'], molecule_arrays(expected['molecules'])['coordinates'])
+
+
+def test_shared_arrays():
+    writer, reader = SharedArrays(), SharedArrays()
+    try:
+        assert reader.read(writer.write('rows', np.arange(4))).tolist() == [0, 1, 2, 3]
+        first = reader.blocks['rows'].name
+        # a larger array replaces the block, and the reader lets go of the old one
+        rows = np.arange(4096, dtype=np.int64)
+        assert np.array_equal(reader.read(writer.write('rows', rows)), rows)
+        assert list(reader.blocks) == ['rows'] and reader.blocks['rows'].name != first
+    finally:
+        reader.close()
+        writer.close(unlink=True)
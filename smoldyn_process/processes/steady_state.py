@@ -0,0 +1,227 @@
+"""
+Steady State Monitor Step
+
+Watches the `species_counts` stream of a `SmoldynProcess` for convergence. The counts of the last
+`window` updates are kept in a ring buffer, which is split into an older and a newer half. A species is
+steady when the difference of the half means is small compared to its standard error (the drift test)
+and the ratio of the half variances is close to one (the variance ratio test). Once every monitored
+species has been steady for `patience` consecutive updates, the monitor reports convergence and
+suggests a longer output cadence.
+
+Counts of successive updates are autocorrelated, which inflates the drift statistic, so the tests err
+on the side of running longer.
+
+`run_until_steady` drives a process and a monitor together and either stops the run at convergence or
+stretches the process's molecule output cadence. In a composite, check `SteadyStateMonitor.converged`
+between calls to `Composite.run` to stop early.
+"""
+
+
+from typing import *
+import numpy as np
+from process_bigraph import Step, process_registry, types
+from smoldyn_process.library.buffers import RingBuffer
+from smoldyn_process.processes.smoldyn_process import SmoldynProcess
+
+
+def drift_statistic(older: np.ndarray, newer: np.ndarray) -> np.ndarray:
+    """Difference of the column means of two windows over its standard error, per column."""
+    difference = np.abs(newer.mean(axis=0) - older.mean(axis=0))
+    error = np.sqrt(older.var(axis=0, ddof=1) / len(older) + newer.var(axis=0, ddof=1) / len(newer))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(error > 0, difference / error, np.where(difference > 0, np.inf, 0.0))
+
+
+def variance_ratio(older: np.ndarray, newer: np.ndarray) -> np.ndarray:
+    """Ratio of the column variances of two windows, newer over older, per column (1 when both are constant)."""
+    older_variance = older.var(axis=0, ddof=1)
+    newer_variance = newer.var(axis=0, ddof=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(older_variance > 0, newer_variance / older_variance, np.where(newer_variance > 0, np.inf, 1.0))
+
+
+class SteadyStateMonitor(Step):
+    """Detect when the species counts reach a steady state.
+
+        Attributes:
+            species:`List[str]`: species to monitor. Defaults to every entry of the count vector.
+            count_species:`List[str]`: the species of the entries of the incoming count vector, which are the
+                `_species` of the `species_counts` port of the process. Needed to pick out `species`, unless
+                `run_until_steady` fills it in from the process.
+            window:`int`: number of updates in the ring buffer. Defaults to 64.
+            drift_threshold:`float`: largest drift statistic of a steady species. Defaults to 2.
+            variance_ratio_limit:`float`: largest ratio (either way) of the half-window variances of a steady species.
+                Defaults to 2.
+            patience:`int`: consecutive steady updates before convergence is reported. Defaults to 5.
+            stretch:`int`: factor by which the output cadence can be stretched after convergence. Defaults to 4.
+    """
+
+    config_schema = {
+        'species': 'list[string]',
+        'count_species': 'list[string]',
+        'window': 'int',
+        'drift_threshold': 'float',
+        'variance_ratio_limit': 'float',
+        'patience': 'int',
+        'stretch': 'int',
+    }
+
+    def __init__(self, config: Dict[str, Any] = None):
+        super().__init__(config)
+        self.species_names: List[str] = self.config.get('species') or []
+        self.count_species: Optional[List[str]] = self.config.get('count_species') or None
+        self.indices: Optional[np.ndarray] = None
+        self.window = self.config.get('window') or 64
+        self.drift_threshold = self.config.get('drift_threshold') or 2.0
+        self.variance_ratio_limit = self.config.get('variance_ratio_limit') or 2.0
+        self.patience = self.config.get('patience') or 5
+        self.stretch = self.config.get('stretch') or 4
+        if self.window < 4:
+            raise ValueError('SteadyStateMonitor needs a `window` of at least 4 updates.')
+
+        self.counts: Optional[RingBuffer] = None
+        self.steady_updates = 0
+        self.update_count = 0
+        self.converged = False
+        self.converged_at: Optional[int] = None
+
+    def schema(self) -> Dict[str, Dict]:
+        array_set = {'_type': 'numpy_array', '_apply': 'set'}
+        return {
+            'inputs': {
+                'species_counts': 'count_vector',
+            },
+            'outputs': {
+                'steady_state': {
+                    'converged': {'_type': 'boolean', '_apply': 'set'},
+                    'drift': array_set,
+                    'variance_ratio': array_set,
+                    'cadence': {'_type': 'int', '_apply': 'set'},
+                },
+            },
+        }
+
+    def update(self, state: Dict) -> Dict:
+        counts = np.asarray(state['species_counts'])
+        if self.counts is None:
+            if self.species_names and self.count_species is None:
+                raise ValueError('SteadyStateMonitor needs the `count_species` order of the count vector to pick out '
+                                 f'the species {self.species_names}.')
+            self.indices = np.array([self.count_species.index(name) for name in self.species_names], dtype=int) \
+                if self.species_names else np.arange(len(counts))
+            self.counts = RingBuffer(self.window, (len(self.indices),))
+        self.counts.append(counts[self.indices])
+        self.update_count += 1
+
+        drift = np.full(len(self.indices), np.nan)
+        ratio = np.full(len(self.indices), np.nan)
+        if self.counts.count >= self.window:
+            counts = self.counts.values()
+            older, newer = counts[:self.window // 2], counts[self.window // 2:]
+            drift = drift_statistic(older, newer)
+            ratio = variance_ratio(older, newer)
+            steady = np.all(drift <= self.drift_threshold) and np.all(
+                (ratio <= self.variance_ratio_limit) & (ratio >= 1 / self.variance_ratio_limit))
+            self.steady_updates = self.steady_updates + 1 if steady else 0
+
+        if not self.converged and self.steady_updates >= self.patience:
+            self.converged = True
+            self.converged_at = self.update_count
+
+        return {
+            'steady_state': {
+                'converged': self.converged,
+                'drift': drift,
+                'variance_ratio': ratio,
+                'cadence': self.stretch if self.converged else 1,
+            }
+        }
+
+
+process_registry.register('steady_state_monitor', SteadyStateMonitor)
+
+
+def run_until_steady(
+        process: SmoldynProcess,
+        monitor: SteadyStateMonitor,
+        stop: float,
+        interval: float,
+        on_steady: str = 'stop') -> Dict[str, Any]:
+    """Run `process` until `stop`, feeding its counts to `monitor` after every update.
+
+        Args:
+            on_steady:`str`: at convergence, `'stop'` the run, or `'stretch'` the molecule output cadence of the
+                process by the monitor's `stretch` and carry on.
+
+        Returns:
+            `Dict[str, Any]`: the `updates` of the process, the `time` run and the time at which the counts
+                `converged` (`None` if they did not).
+    """
+    if on_steady not in ('stop', 'stretch'):
+        raise ValueError(f'unknown steady state action: {on_steady}')
+    if monitor.count_species is None:
+        monitor.count_species = list(process.species_names)
+    state = process.initial_state()
+    schema = types.access(process.schema())
+    updates = []
+    time, converged = 0.0, None
+    while time < stop - 1e-12:
+        step = min(interval, stop - time)
+        update = process.update(state, step)
+        state = types.apply_update(schema, state, update)
+        updates.append(update)
+        time += step
+
+        steady_state = monitor.update({'species_counts': state['species_counts']})['steady_state']
+        if steady_state['converged'] and converged is None:
+            converged = time
+            if on_steady == 'stop':
+                break
+            process.stretch_cadence(steady_state['cadence'])
+    return {'updates': updates, 'time': time, 'converged': converged}
+
+
+def test_steady_state_monitor():
+    rng = np.random.default_rng(0)
+    relaxing = SteadyStateMonitor({'window': 32, 'patience': 3})
+    ramping = SteadyStateMonitor({'window': 32, 'patience': 3})
+    for step in range(300):
+        # one species relaxes to 1000, the other keeps growing
+        noise = rng.normal(0, 10)
+        relaxing.update({'species_counts': np.array([int(1000 - 800 * np.exp(-step / 20) + noise)])})
+        ramping.update({'species_counts': np.array([int(10 * step + noise)])})
+    assert relaxing.converged and 64 < relaxing.converged_at < 200
+    assert not ramping.converged
+
+    # a subset of the species, picked out of the count vector by name
+    subset = SteadyStateMonitor({'species': ['b'], 'count_species': ['a', 'b'], 'window': 4})
+    subset.update({'species_counts': np.array([1, 2])})
+    assert subset.counts.values().tolist() == [[2]]
+    try:
+        SteadyStateMonitor({'species': ['b'], 'window': 4}).update({'species_counts': np.array([1, 2])})
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('the order of the count vector is not known')
+
+
+def test_run_until_steady():
+    process = SmoldynProcess({'model_filepath': 'smoldyn_process/models/model_files/crowding_model.txt'})
+    # the crowding model has no reactions that change the counts, so they are steady from the start
+    result = run_until_steady(process, SteadyStateMonitor({'window': 6, 'patience': 2}), stop=1.0, interval=0.01)
+    assert len(result['updates']) == 7 and np.isclose(result['converged'], 0.07)
+
+    # the monitored species are picked out of the count vector in the order of the process
+    process = SmoldynProcess({'model_filepath': 'smoldyn_process/models/model_files/crowding_model.txt'})
+    red = process.molecule_counts()[process.species_names.index('red')]
+    monitor = SteadyStateMonitor({'species': ['red'], 'window': 6, 'patience': 2})
+    run_until_steady(process, monitor, stop=0.02, interval=0.01)
+    assert monitor.count_species == process.species_names and monitor.counts.values()[:, 0].tolist() == [red, red]
+
+    process = SmoldynProcess({'model_filepath': 'smoldyn_process/models/model_files/crowding_model.txt'})
+    result = run_until_steady(
+        process, SteadyStateMonitor({'window': 6, 'patience': 2}), stop=0.2, interval=0.01, on_steady='stretch')
+    assert len(result['updates']) == 20 and process.molecules_every == 4
+    # snapshots at every update until convergence after the 7th, then at every 4th
+    assert [index for index, update in enumerate(result['updates']) if 'molecules' in update] == \
+        list(range(7)) + [8, 12, 16]
@@ -3,6 +3,8 @@ from abc import ABC, abstractmethod
 import pandas as pd
 import smoldyn as sm
 from biosimulators_simularium.converters.utils import validate_model
+# the DataFrame builders live with the other molecule helpers, which do not need biosimulators-simularium
+from smoldyn_process.library.molecules import create_listmols_dataframe, listmols_columns
 
 
 def get_smoldyn_model_from_file(model_fp: str) -> sm.Simulation:
@@ -147,12 +149,6 @@ def get_reactions(model_fp: str):
     return _reactions
 
 
-def create_listmols_dataframe(model_fp: str = None, values: List[List[float]] = None) -> pd.DataFrame:
-    """TODO: Add simulation read -> output spec -> run -> getData functionality."""
-    cols = ['species_id', 'state', 'x', 'y', 'z', 'serial_number']
-    return pd.DataFrame(data=values, columns=cols)
-
-
 def read_model_file_as_list(fp: str) -> List[str]:
     """Return either a Smoldyn configuration(input) or Smoldyn output model file as a list of strings.
 